@@ -0,0 +1,365 @@
+"""actioncache.py
+
+A local, content-addressed cache of what rule commands produced.  An action
+is keyed on the rule's type, its ground consequent, the contents of its
+input files and its command lines; what is stored is the contents of its
+output files.  When the same action comes up again (say after switching
+back to a branch that was built before), the outputs are copied out of the
+cache instead of running the commands.
+
+The cache is a directory: blobs/ holds file contents named by their sha1,
+and actions/ holds a small json file per action that maps each output path
+to a blob.  Blobs are evicted least recently used first once they take up
+more than max_size bytes, along with the actions that refer to them.
+
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from prolog import Predicate, Rule
+from filestate import file_digest
+
+def _atom_files( terms ):
+    return [arg.name for term in terms for arg in term.args
+            if isinstance(arg, Predicate) and not arg.args]
+
+class ActionCache(object):
+    """Outputs of actions, in the directory root.
+
+    >>> root = tempfile.mkdtemp()
+    >>> cache = ActionCache(os.path.join(root, 'cache'), max_size=10)
+    >>> out = os.path.join(root, 'out')
+    >>> with open(out, 'w') as f:
+    ...     f.write('12345')
+    >>> cache.store('key1', [out])
+    >>> os.remove(out)
+    >>> cache.restore('key1')
+    True
+    >>> open(out).read()
+    '12345'
+    >>> cache.restore('key2')
+    False
+    >>> with open(out, 'w') as f:
+    ...     f.write('6789012')
+    >>> cache.store('key2', [out])
+    >>> cache.size
+    7
+    >>> cache.restore('key1')
+    False
+    >>> os.listdir(cache.actions)
+    ['key2']
+
+    Outputs that were absent are removed on a hit, but directories are not
+    cached, and one is never removed:
+
+    >>> gone = os.path.join(root, 'gone')
+    >>> cache.store('key3', [out, gone])
+    >>> os.mkdir(gone)
+    >>> cache.store('key4', [out, gone])
+    >>> cache.restore('key4')
+    False
+    >>> cache.restore('key3'), os.path.isdir(gone)
+    (False, True)
+    >>> os.rmdir(gone)
+    >>> with open(gone, 'w') as f:
+    ...     f.write('stale')
+    >>> cache.restore('key3'), os.path.exists(gone), open(out).read()
+    (True, False, '6789012')
+    >>> shutil.rmtree(root)
+    """
+    def __init__( self, root, max_size=1 << 30 ):
+        self.root = root
+        self.max_size = max_size
+        self.blobs = os.path.join(root, 'blobs')
+        self.actions = os.path.join(root, 'actions')
+        for path in (self.blobs, self.actions):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self.lock = threading.Lock()
+        self.size = sum(size for path, mtime, size in self._blob_files())
+        self.hits = 0
+        self.misses = 0
+
+    def _blob_files( self ):
+        """Returns (path, mtime, size) for every blob"""
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.blobs):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found.append((path, st.st_mtime, st.st_size))
+        return found
+
+    def _blob_path( self, digest ):
+        return os.path.join(self.blobs, digest[:2], digest)
+
+    def _stage( self, path, copy_from=None, data=None ):
+        """Writes what is to go in path to a new temporary file next to it,
+        and returns the temporary file's name.
+        """
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass
+        fd, temp = tempfile.mkstemp(dir=dirname or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if copy_from is not None:
+                    with open(copy_from, 'rb') as source:
+                        shutil.copyfileobj(source, f)
+                else:
+                    f.write(data)
+            if copy_from is not None:
+                shutil.copymode(copy_from, temp)
+        except:
+            os.remove(temp)
+            raise
+        return temp
+
+    def _write( self, path, copy_from=None, data=None, exclusive=False ):
+        """Writes a file in one step, by renaming a temporary file.  With
+        exclusive set, an existing file is left alone instead; returns
+        whether path was written.
+        """
+        temp = self._stage(path, copy_from, data)
+        try:
+            if not exclusive:
+                os.rename(temp, path)
+                return True
+            # Linking fails if path exists, where renaming would replace it,
+            # so of two jobs storing the same blob only one creates it.
+            try:
+                os.link(temp, path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+                return False
+            finally:
+                os.remove(temp)
+            return True
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+    def restore( self, key ):
+        """Copies the outputs recorded for key into place, and removes the
+        ones that were recorded as absent.  Returns False if key is not in
+        the cache.
+
+        The outputs are copied to temporary files next to them first, and
+        only once they all are, renamed into place.  If anything goes wrong
+        before that (say evict() in another job removes a blob), False is
+        returned without changing any of them.
+        """
+        try:
+            with open(os.path.join(self.actions, key)) as f:
+                outputs = json.load(f)
+        except (IOError, ValueError):
+            self.misses += 1
+            return False
+        blobs = []
+        for path, digest in outputs.iteritems():
+            if os.path.isdir(path):
+                # Something else made a directory there since; it is not
+                # this cache's to replace.
+                self.misses += 1
+                return False
+            if digest is None:
+                blobs.append((path, None))
+                continue
+            blob = self._blob_path(digest)
+            if not os.path.exists(blob):
+                self.misses += 1
+                return False
+            blobs.append((path, blob))
+
+        staged = []
+        try:
+            for path, blob in blobs:
+                if blob is not None:
+                    staged.append((self._stage(path, copy_from=blob), path,
+                                   blob))
+        except (IOError, OSError):
+            for temp, path, blob in staged:
+                os.remove(temp)
+            self.misses += 1
+            return False
+
+        for path, blob in blobs:
+            if blob is None and os.path.lexists(path):
+                os.remove(path)
+        for temp, path, blob in staged:
+            os.rename(temp, path)
+            # Recently used blobs are evicted last.
+            try:
+                os.utime(blob, None)
+            except OSError:
+                pass
+        self.hits += 1
+        return True
+
+    def store( self, key, outputs ):
+        """Records the current contents of the output paths under key, and
+        evicts old blobs if the cache has grown too big.  Outputs that do
+        not exist are recorded as absent.  Only files are cached: if any
+        output is something else, such as a directory, nothing is recorded.
+        """
+        for path in outputs:
+            if os.path.lexists(path) and not os.path.isfile(path):
+                return
+        recorded = {}
+        for path in outputs:
+            if not os.path.lexists(path):
+                recorded[path] = None
+                continue
+            digest = recorded[path] = file_digest(path)
+            blob = self._blob_path(digest)
+            if os.path.exists(blob):
+                os.utime(blob, None)
+                continue
+            # Only the job that creates the blob counts its size.
+            if self._write(blob, copy_from=path, exclusive=True):
+                with self.lock:
+                    self.size += os.path.getsize(path)
+        self._write(os.path.join(self.actions, key),
+                    data=json.dumps(recorded))
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict( self ):
+        """Removes the least recently used blobs until the cache fits in
+        max_size, and the actions that need any of them.  Actions whose
+        blobs are removed by another job meanwhile are treated as misses.
+        """
+        with self.lock:
+            blobs = sorted(self._blob_files(), key=lambda b: b[1])
+            self.size = sum(size for path, mtime, size in blobs)
+            removed = False
+            for path, mtime, size in blobs:
+                if self.size <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self.size -= size
+                removed = True
+            if removed:
+                self._remove_broken_actions()
+
+    def _remove_broken_actions( self ):
+        """Removes the actions that refer to blobs that are gone"""
+        for name in os.listdir(self.actions):
+            path = os.path.join(self.actions, name)
+            try:
+                with open(path) as f:
+                    outputs = json.load(f)
+            except (IOError, ValueError):
+                # Being written, or already removed.
+                continue
+            if any(digest is not None and
+                   not os.path.exists(self._blob_path(digest))
+                   for digest in outputs.itervalues()):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+class CachedRule(Rule):
+    """A rule whose commands are skipped when the cache has the outputs of
+    the same action.  Set action_cache (on the class or an instance) to an
+    ActionCache to turn caching on.
+
+    The outputs are the files named by the atom arguments of the consequent
+    and the inputs those of the antecedents; override output_files() and
+    input_files() for other arrangements.
+
+    >>> root = tempfile.mkdtemp()
+    >>> def path(name):
+    ...     return os.path.join(root, name)
+    >>> def f(name):
+    ...     return Predicate('built', [Predicate(path(name))])
+    >>> runs = []
+    >>> class Copy(CachedRule):
+    ...     action_cache = ActionCache(path('cache'))
+    ...     def pre_test( self ):
+    ...         return False
+    ...     def post_test( self ):
+    ...         return True
+    ...     def commands( self ):
+    ...         runs.append('copy')
+    ...         shutil.copyfile(path('a.c'), path('a.o'))
+    >>> def checkout(text):
+    ...     with open(path('a.c'), 'w') as out:
+    ...         out.write(text)
+    >>> rule = Copy(f('a.o'), [f('a.c')])
+    >>> checkout('branch one')
+    >>> rule.try_to_satisfy()
+    True
+    >>> checkout('branch two')
+    >>> rule.try_to_satisfy()
+    True
+    >>> checkout('branch one')
+    >>> rule.try_to_satisfy()
+    True
+    >>> runs, open(path('a.o')).read()
+    (['copy', 'copy'], 'branch one')
+    >>> Copy.action_cache.hits, Copy.action_cache.misses
+    (1, 2)
+    >>> shutil.rmtree(root)
+    """
+    action_cache = None
+
+    def output_files( self ):
+        return _atom_files([self.consequent])
+
+    def input_files( self ):
+        return _atom_files(self.antecedents)
+
+    def action_key( self ):
+        """The digest that identifies what running this rule's commands
+        now would do.
+        """
+        inputs = []
+        for path in self.input_files():
+            inputs.append((path, file_digest(path)
+                           if os.path.isfile(path) else None))
+        return hashlib.sha1(json.dumps([
+            self.__class__.__name__, str(self.consequent), inputs,
+            self.command_lines()])).hexdigest()
+
+    def try_to_satisfy( self ):
+        cache = self.action_cache
+        if cache is None:
+            return super(CachedRule, self).try_to_satisfy()
+        if self.pre_test():
+            return True
+        key = self.action_key()
+        if cache.restore(key) and self.post_test():
+            return True
+        self.commands()
+        if not self.post_test():
+            return False
+        cache.store(key, self.output_files())
+        return True
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
+
+# vim: et sts=4 sw=4
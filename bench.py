@@ -0,0 +1,1064 @@
+"""bench.py
+
+Rough timing of the hot paths in the prolog engine, on synthetic rule bases
+and file trees.  Run it directly:
+
+    python bench.py [NAME...]
+
+With --json FILE the results are also saved, along with the commit they are
+for, and --compare FILE lists what changed since a saved run:
+
+    python bench.py --json before.json
+    python bench.py --compare before.json
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import engine
+import actioncache
+import buildstate
+import filestate
+import instrument
+import rulebase
+import testdecorator
+import testunify
+from prolog import Predicate, Var, VarMap, Rule, Prolog, Pattern
+import schedule
+
+def timed( func, repeat=3 ):
+    """Returns the best wall-clock time of several calls to func"""
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bound_varmap( num_bindings ):
+    """Returns a VarMap that already holds num_bindings unrelated bindings"""
+    varmap = VarMap()
+    for i in xrange(num_bindings):
+        varmap.add(Var('bound%d' % i), Predicate('value%d' % i))
+    return varmap
+
+def bench_resolution_step( binding_counts=(10, 100, 1000, 10000),
+                           num_facts=200 ):
+    """Time per candidate rule in answer_iter as the binding count grows.
+
+    With a trail the cost of trying a rule does not depend on how many
+    bindings are already in the map.  The cost of the full map copy that each
+    step used to make is shown alongside for comparison.
+    """
+    prolog = Prolog()
+    for i in xrange(num_facts):
+        prolog.add_rule(Rule(Predicate('fact', [Predicate('f%d' % i)])))
+    query = Predicate('fact', [Var('X')])
+
+    results = []
+    for num_bindings in binding_counts:
+        varmap = bound_varmap(num_bindings)
+        def solve():
+            for answer in prolog.answer_iter([query], varmap):
+                pass
+        step = timed(solve) / num_facts
+        copy = timed(varmap.copy)
+        results.append((num_bindings, step, copy))
+    return results
+
+def bench_alias_chain( lengths=(10, 100, 1000, 10000), lookups=1000 ):
+    """Time per dereference of the head of a var -> var -> ... chain.
+
+    The first lookup walks the whole chain and compresses it, so the average
+    over many lookups should not grow with the chain length.
+    """
+    results = []
+    for length in lengths:
+        def chain():
+            varmap = VarMap()
+            names = ['alias%d_%d' % (length, i) for i in xrange(length)]
+            for a, b in zip(names, names[1:]):
+                varmap.add(Var(a), Var(b))
+            varmap.add(Var(names[-1]), Predicate('end'))
+            return varmap, Var(names[0])
+        varmap, head = chain()
+        def lookup():
+            for _ in xrange(lookups):
+                varmap.deep_get(head)
+        results.append((length, timed(lookup, repeat=1) / lookups))
+    return results
+
+def nested_file( depth, leaf ):
+    """Returns file(file(...file(leaf, .o)..., .o), .o) nested depth deep"""
+    term = leaf
+    for _ in xrange(depth):
+        term = Predicate('file', [term, Predicate('.o')])
+    return term
+
+def walk_occurs( term, var, mapping ):
+    """An occurs check that walks every subterm, ground or not"""
+    stack = [term]
+    while stack:
+        term = stack.pop()
+        if mapping.is_var(term):
+            term = mapping[term]
+            if mapping.is_var(term):
+                if term.id == var.id:
+                    return True
+                continue
+        stack.extend(term.args)
+    return False
+
+def bench_occurs_check( depths=(10, 100, 1000), binds=200 ):
+    """Time to bind a variable to file(<deep ground term>, Y).
+
+    Compares the occurs check that skips ground subterms with no check at all
+    and with a check that walks the whole term.
+    """
+    results = []
+    for depth in depths:
+        term = Predicate('file', [nested_file(depth, Predicate('src')),
+                                  Var('Y')])
+        X = Var('X')
+        def bind(check):
+            def run():
+                varmap = VarMap()
+                varmap.occurs_check = check
+                for _ in xrange(binds):
+                    mark = varmap.mark()
+                    X.unify(term, varmap)
+                    varmap.undo(mark)
+            return timed(run) / binds
+        def walk():
+            varmap = VarMap()
+            for _ in xrange(binds):
+                walk_occurs(term, X, varmap)
+        results.append((depth, bind(True), bind(False), timed(walk) / binds))
+    return results
+
+def bench_proof_depth( depths=(10, 100, 1000, 5000), num_answers=2000 ):
+    """Time to the first answer and per further answer for a query whose
+    proofs are depth rules deep.
+
+    Reaching the bottom of the chain is proportional to its depth, but every
+    further answer only backtracks into the facts at the bottom, so the time
+    per further answer should not grow with depth.
+    """
+    results = []
+    for depth in depths:
+        prolog = Prolog()
+        for i in xrange(depth):
+            prolog.add_rule(Rule(
+                Predicate('built', [Predicate('f%d' % i), Var('X')]),
+                [Predicate('built', [Predicate('f%d' % (i + 1)), Var('X')])]))
+        for j in xrange(num_answers + 1):
+            prolog.add_rule(Rule(Predicate('built', [
+                Predicate('f%d' % depth), Predicate('k%d' % j)])))
+        query = Predicate('built', [Predicate('f0'), Var('Out')])
+        best = None
+        for _ in xrange(3):
+            start = time.time()
+            answers = prolog.solve([query], VarMap())
+            answers.next()
+            first = time.time()
+            for answer in answers:
+                pass
+            times = (first - start, (time.time() - first) / num_answers)
+            if best is None or sum(times) < sum(best):
+                best = times
+        results.append((depth,) + best)
+    return results
+
+def bench_parallel( process_counts=(1, 2, 4), branches=8, facts=300 ):
+    """Time to enumerate a query whose top-level rules each join two fact
+    sets, serially and on process pools of different sizes.
+    """
+    prolog = Prolog()
+    for b in xrange(branches):
+        prolog.add_rule(Rule(Predicate('buildable', [Var('X'), Var('Y')]),
+                             [Predicate('left%d' % b, [Var('X'), Var('K')]),
+                              Predicate('right%d' % b, [Var('K'), Var('Y')])]))
+        for i in xrange(facts):
+            prolog.add_rule(Rule(Predicate('left%d' % b, [
+                Predicate('x%d' % i), Predicate('k%d' % (i % 10))])))
+            prolog.add_rule(Rule(Predicate('right%d' % b, [
+                Predicate('k%d' % (i % 10)), Predicate('y%d' % i)])))
+    query = Predicate('buildable', [Var('A'), Var('B')])
+
+    def serial():
+        for answer in prolog.answer_iter([query]):
+            pass
+    results = [('serial', timed(serial, repeat=1))]
+    for processes in process_counts:
+        def parallel():
+            for answer in prolog.parallel_answer_iter([query], processes):
+                pass
+        results.append((processes, timed(parallel, repeat=1)))
+    return results
+
+def bench_clause_lookup( fact_counts=(100, 1000, 10000, 50000) ):
+    """Time to answer a first-argument-bound query among many file facts.
+
+    The clause index narrows the candidates to the matching bucket, so the
+    time should stay roughly flat as the number of facts grows.
+    """
+    results = []
+    for num_facts in fact_counts:
+        prolog = Prolog(index_positions=((0,), (0, 0)))
+        for i in xrange(num_facts):
+            prolog.add_rule(Rule(Predicate('exists', [
+                Predicate('file', [Predicate('f%d' % i), Predicate('.c')])])))
+        query = Predicate('exists', [
+            Predicate('file', [Predicate('f%d' % (num_facts // 2)),
+                               Var('Ext')])])
+        def solve():
+            for answer in prolog.answer_iter([query]):
+                pass
+        results.append((num_facts, timed(solve)))
+    return results
+
+def layered_graph( prolog, layers, width ):
+    """Adds dep/2 facts linking every node in a layer to every node in the
+    next, plus per-layer ready rules that require a node's dependencies to be
+    ready.  Returns the query for the single node at the top.
+    """
+    def node(layer, i):
+        return Predicate('n%d_%d' % (layer, i))
+    for layer in xrange(layers):
+        parents = [0] if layer == 0 else range(width)
+        for i in parents:
+            for j in xrange(width):
+                prolog.add_rule(Rule(Predicate('dep', [
+                    node(layer, i), node(layer + 1, j)])))
+        prolog.add_rule(Rule(Predicate('ready%d' % layer, [Var('N')]),
+                             [Predicate('dep', [Var('N'), Var('D')]),
+                              Predicate('ready%d' % (layer + 1), [Var('D')])]))
+    for j in xrange(width):
+        prolog.add_rule(Rule(Predicate('ready%d' % layers, [node(layers, j)])))
+    return Predicate('ready0', [node(0, 0)])
+
+def c_project( prolog, num_files, rule=Rule ):
+    """Adds the rules of a generated C project like the one in the prolog.py
+    demo: for each of num_files sources a yacc grammar fI.y, a rule making
+    fI.c from it and one making fI.o from that, and a link rule that needs
+    every object.  Returns the query for the program.
+    """
+    def f( base, ext ):
+        return Predicate('file', [Predicate(base), Predicate(ext)])
+    objects = []
+    for i in xrange(num_files):
+        base = 'f%d' % i
+        prolog.add_rule(rule(Predicate('exists', [f(base, '.y')])))
+        prolog.add_rule(rule(Predicate('buildable', [f(base, '.c')]),
+                             [Predicate('exists', [f(base, '.y')])]))
+        prolog.add_rule(rule(Predicate('buildable', [f(base, '.o')]),
+                             [Predicate('buildable', [f(base, '.c')])]))
+        objects.append(Predicate('buildable', [f(base, '.o')]))
+    prolog.add_rule(rule(Predicate('buildable', [f('prog', '')]), objects))
+    return Predicate('buildable', [f('prog', '')])
+
+def bench_c_project( file_counts=(10, 100, 300) ):
+    """Time to resolve the link of a generated C project with answer_iter,
+    and to build it end to end (resolve, then test and run every rule
+    instance with schedule.build).
+    """
+    results = []
+    for num_files in file_counts:
+        prolog = Prolog()
+        query = c_project(prolog, num_files)
+        def solve():
+            for answer in prolog.answer_iter([query]):
+                pass
+        built = timed(lambda: schedule.build(prolog, [query]))
+        results.append((num_files, timed(solve), built))
+    return results
+
+def long_pattern( num_vars ):
+    """A path pattern with num_vars variables, each in its own directory"""
+    return "/".join("d%d-{v%d}" % (i, i) for i in xrange(num_vars)) + ".ext"
+
+def bench_pattern_parse( var_counts=(4, 16, 64), count=1000 ):
+    """Time to parse a path pattern into components, and to realize it with
+    half of its variables filled in, as the number of variables grows.
+    """
+    results = []
+    for num_vars in var_counts:
+        pattern = long_pattern(num_vars)
+        FP = testdecorator.FilePattern
+        def parse():
+            for _ in xrange(count):
+                list(FP._components(FP._tokens(pattern)))
+        fp = FP(pattern)
+        values = dict(('v%d' % i, 'x%d' % i) for i in xrange(0, num_vars, 2))
+        def realize():
+            for _ in xrange(count):
+                fp.realized(**values)
+        results.append((num_vars, timed(parse) / count,
+                        timed(realize) / count))
+    return results
+
+def term_size( term, seen ):
+    """Bytes held by a term's objects that are not already in seen"""
+    if id(term) in seen:
+        return 0
+    seen.add(id(term))
+    size = sys.getsizeof(term)
+    if isinstance(term, Predicate):
+        size += sys.getsizeof(term.args)
+        size += sum(term_size(a, seen) for a in term.args)
+    return size
+
+def bench_fact_memory( num_facts=10000 ):
+    """Bytes per exists(file(Name, Ext)) fact.
+
+    Ground subterms are shared, so the functors and extensions that every
+    fact repeats are only paid for once.
+    """
+    exts = ['.c', '.h', '.o', '.y', '.cc']
+    facts = [Predicate('exists', [Predicate('file', [
+                 Predicate('f%d' % i), Predicate(exts[i % len(exts)])])])
+             for i in xrange(num_facts)]
+    seen = set()
+    total = sum(term_size(fact, seen) for fact in facts)
+    return num_facts, float(total) / num_facts
+
+class SleepRule(Rule):
+    """A rule whose commands take a fixed time, like a compiler would"""
+    seconds = 0.01
+
+    def pre_test( self ):
+        return getattr(self, 'done', False)
+
+    def commands( self ):
+        time.sleep(self.seconds)
+        self.done = True
+
+def bench_build_jobs( job_counts=(1, 2, 4, 8), num_objects=16 ):
+    """Wall time to build a program from independent objects whose commands
+    each take 10ms, with different numbers of parallel jobs.
+    """
+    def built(name):
+        return Predicate('built', [Predicate(name)])
+    objects = ['obj%d.o' % i for i in xrange(num_objects)]
+    results = []
+    for jobs in job_counts:
+        prolog = Prolog()
+        prolog.add_rule(SleepRule(built('prog'), [built(o) for o in objects]))
+        for o in objects:
+            prolog.add_rule(SleepRule(built(o)))
+        start = time.time()
+        schedule.build(prolog, [built('prog')], jobs)
+        results.append((jobs, time.time() - start))
+    return results
+
+class MtimeRule(Rule):
+    """Up to date when its target is newer than its sources; the command
+    just touches the target.
+    """
+    def pre_test( self ):
+        target = self.consequent.args[0].name
+        return (os.path.exists(target) and
+                all(os.path.getmtime(a.args[0].name) <=
+                    os.path.getmtime(target) for a in self.antecedents))
+
+    def commands( self ):
+        open(self.consequent.args[0].name, 'w').close()
+
+def bench_state_build( file_counts=(100, 1000) ):
+    """Time for a no-op build of a program from objects built from
+    sources: resolving it and running every test, and with a BuildState
+    that recorded the previous build.
+    """
+    results = []
+    for num_files in file_counts:
+        root = tempfile.mkdtemp()
+        try:
+            def built( name ):
+                path = os.path.join(root, name)
+                return Predicate('built', [Predicate(path)])
+            prolog = Prolog()
+            prolog.add_rule(MtimeRule(built('prog'),
+                                      [built('f%d.o' % i)
+                                       for i in xrange(num_files)]))
+            for i in xrange(num_files):
+                open(os.path.join(root, 'f%d.c' % i), 'w').close()
+                prolog.add_rule(MtimeRule(built('f%d.o' % i),
+                                          [built('f%d.c' % i)]))
+                prolog.add_rule(MtimeRule(built('f%d.c' % i)))
+            queries = [built('prog')]
+            state = buildstate.BuildState(os.path.join(root, 'state.db'))
+            buildstate.build(prolog, queries, state)
+            rules = buildstate.rules_digest(prolog)
+            tested = timed(lambda: schedule.build(prolog, queries))
+            recorded = timed(lambda: buildstate.build(prolog, queries, state,
+                                                      rules=rules))
+            state.close()
+            results.append((num_files, tested, recorded))
+        finally:
+            shutil.rmtree(root)
+    return results
+
+class CompileRule(actioncache.CachedRule):
+    """Copies its source to its target, taking 10ms like a compiler would.
+    Always out of date, as after a checkout that touched every file.
+    """
+    def pre_test( self ):
+        return False
+
+    def post_test( self ):
+        return True
+
+    def commands( self ):
+        time.sleep(0.01)
+        source, = self.input_files()
+        shutil.copyfile(source, self.output_files()[0])
+
+def bench_action_cache( num_objects=50 ):
+    """Time to compile some objects after switching back to a branch that
+    was built before, running every command and restoring the outputs from
+    an ActionCache.
+    """
+    root = tempfile.mkdtemp()
+    try:
+        def built( name ):
+            return Predicate('built', [Predicate(os.path.join(root, name))])
+        rules = [CompileRule(built('f%d.o' % i), [built('f%d.c' % i)])
+                 for i in xrange(num_objects)]
+        def checkout( branch ):
+            for i in xrange(num_objects):
+                with open(os.path.join(root, 'f%d.c' % i), 'w') as out:
+                    out.write("int f%d = %s;\n" % (i, branch))
+        def build():
+            for rule in rules:
+                rule.try_to_satisfy()
+        times = []
+        for cache in (None, actioncache.ActionCache(os.path.join(root, 'c'))):
+            CompileRule.action_cache = cache
+            checkout('1')
+            build()
+            checkout('2')
+            build()
+            checkout('1')
+            start = time.time()
+            build()
+            times.append(time.time() - start)
+        CompileRule.action_cache = None
+        return times
+    finally:
+        shutil.rmtree(root)
+
+def bench_tabling( layers=5, width=5 ):
+    """Time to prove a goal over a layered dependency graph, with and without
+    tabling.  Without it, shared dependencies are re-proven once per path.
+    """
+    results = []
+    for tabling in (False, True):
+        prolog = Prolog(tabling=tabling)
+        query = layered_graph(prolog, layers, width)
+        def solve():
+            prolog.clear_tables()
+            for answer in prolog.answer_iter([query]):
+                pass
+        results.append((tabling, timed(solve), prolog.table_stats()))
+    return results
+
+def bench_profiler( layers=5, width=5 ):
+    """Time to prove a goal over a layered dependency graph (without
+    tabling), with no profiler and with one.
+    """
+    prolog = Prolog()
+    query = layered_graph(prolog, layers, width)
+    def solve():
+        for answer in prolog.answer_iter([query]):
+            pass
+    plain = timed(solve)
+    prolog.profiler = instrument.Profiler()
+    profiled = timed(solve)
+    return plain, profiled
+
+def bench_reorder( num_nodes=1000, num_sources=10 ):
+    """Time and choicepoints to find the yacc sources among many nodes, with
+    the antecedents as written (broad goal first), reordered when the rules
+    are loaded, and reordered as each rule is used.
+    """
+    results = []
+    for mode in ('off', 'load', 'query'):
+        prolog = Prolog(reorder=(mode == 'query'))
+        B, W = Var('B'), Var('W')
+        prolog.add_rule(Rule(Predicate('source', [B]), [
+            Predicate('node', [B]),
+            Predicate('exists', [Predicate('file', [B, Predicate('.y')])])]))
+        for i in range(num_nodes):
+            prolog.add_rule(Rule(Predicate('node', [Predicate('n%d' % i)])))
+        for i in range(0, num_nodes, num_nodes // num_sources):
+            prolog.add_rule(Rule(Predicate('exists', [Predicate('file', [
+                Predicate('n%d' % i), Predicate('.y')])])))
+        if mode == 'load':
+            prolog.reorder_rules()
+        query = [Predicate('source', [W])]
+        def solve():
+            for answer in prolog.answer_iter(query):
+                pass
+        elapsed = timed(solve)
+        prolog.profiler = profiler = instrument.Profiler()
+        solve()
+        results.append((mode, elapsed, profiler.queries[0].choicepoints))
+    return results
+
+def bench_noop_build( file_counts=(100, 1000, 5000), num_headers=5 ):
+    """Time to check that every object in an up-to-date tree is current,
+    where each object depends on its source and on some shared headers.
+    "stat" stats every file each time a test needs it; "walk" reads the tree
+    once into a StatCache and tests against that.
+    """
+    results = []
+    for num_files in file_counts:
+        root = tempfile.mkdtemp()
+        try:
+            headers = [os.path.join(root, 'h%d.h' % i)
+                       for i in xrange(num_headers)]
+            pairs = [(os.path.join(root, 'f%d.o' % i),
+                      [os.path.join(root, 'f%d.c' % i)] + headers)
+                     for i in xrange(num_files)]
+            for path in headers + [sources[0] for t, sources in pairs]:
+                open(path, 'w').close()
+                os.utime(path, (100, 100))
+            for target, sources in pairs:
+                open(target, 'w').close()
+
+            def stat_each():
+                for target, sources in pairs:
+                    filestate.is_current(target, sources,
+                                         filestate.StatCache())
+            def walk_once():
+                stats = filestate.StatCache([root])
+                stats.refresh()
+                for target, sources in pairs:
+                    filestate.is_current(target, sources, stats)
+            per_stat = timed(stat_each)
+            walk = timed(walk_once)
+            results.append((num_files, per_stat, walk))
+        finally:
+            shutil.rmtree(root)
+    return results
+
+def bench_constraints( num_files=1000, chain=10, depths=(2, 5, 10, 40) ):
+    """Time to bind each of num_files object paths to a chain of aliased
+    variables that share a dir/base.o style constraint: as Assignment does
+    by default, matching every time, and with every match going through the
+    memo.  The paths are depths directories deep.
+    """
+    pattern = r"(?P<dir>(?:[^/]+/)*)(?P<base>[^/.]+)\.o"
+    chain_vars = [engine.Var('V%d' % i, pattern) for i in xrange(chain)]
+    results = []
+    for depth in depths:
+        names = ['/'.join('dir%d' % ((i + d) % 10) for d in xrange(depth)) +
+                 '/file%d.o' % i for i in xrange(num_files)]
+        def bind():
+            engine.match_cache.clear()
+            for name in names:
+                for var in chain_vars:
+                    engine.Assignment(var, name)
+        def with_min_length( min_length ):
+            def run():
+                default = engine.MEMO_MIN_LENGTH
+                engine.MEMO_MIN_LENGTH = min_length
+                try:
+                    bind()
+                finally:
+                    engine.MEMO_MIN_LENGTH = default
+            return run
+        results.append((len(names[0]), timed(bind),
+                        timed(with_min_length(sys.maxint)),
+                        timed(with_min_length(0))))
+    return results
+
+def bench_pattern_rules( pattern_counts=(10, 100, 1000), lookups=1000 ):
+    """Time to find the pattern rules that can produce a file, with all the
+    patterns in a PatternSet and by matching them one at a time.  Each
+    pattern is dir/{base}.ext for its own directory and extension.
+    """
+    results = []
+    for num_patterns in pattern_counts:
+        patterns = ["dir%d/{base}.ext%d" % (i, i % 7)
+                    for i in xrange(num_patterns)]
+        pattern_set = testdecorator.PatternSet()
+        regexes = []
+        for i, pattern in enumerate(patterns):
+            pattern_set.add(pattern, i)
+            fp = testdecorator.FilePattern(pattern)
+            regexes.append(re.compile(
+                testdecorator.pattern_regex(fp.components)))
+        targets = ["dir%d/file%d.ext%d" % (i % num_patterns, i,
+                                           (i % num_patterns) % 7)
+                   for i in xrange(lookups)]
+        def combined():
+            for target in targets:
+                assert pattern_set.matches(target)
+        def one_by_one():
+            for target in targets:
+                [r for r in regexes if r.match(target)]
+        results.append((num_patterns, timed(combined) / lookups,
+                        timed(one_by_one) / lookups))
+    return results
+
+def reparsed_realized( fp, **values ):
+    """FilePattern.realized() as it was before patterns were precompiled:
+    format the result as a pattern string and parse that string again.
+    """
+    pattern_list = []
+    for component in fp.components:
+        s = fp._substitute(component, values)
+        if isinstance(s, testdecorator.Var):
+            pattern_list.append("{%s}" % s.name)
+        else:
+            pattern_list.append(s.replace('{', '{{').replace('}', '}}'))
+    components = list(fp._components(fp._tokens("".join(pattern_list))))
+    variables = [c for c in components if isinstance(c, testdecorator.Var)]
+    consts = [c for c in components if not isinstance(c, testdecorator.Var)]
+    return components, variables, consts
+
+def bench_file_pattern( pattern="src/{dir}/{name}-{version}.{ext}",
+                        count=10000 ):
+    """Time to realize a pattern with one of its variables filled in, from
+    the precompiled components and by re-parsing a formatted string, and to
+    match a path against it.
+    """
+    fp = testdecorator.FilePattern(pattern)
+    names = ["lib%d" % i for i in xrange(count)]
+    def precompiled():
+        for name in names:
+            fp.realized(name=name)
+    def reparsed():
+        for name in names:
+            reparsed_realized(fp, name=name)
+    path = "src/a/b/lib-1.2.tar.gz"
+    def match():
+        for _ in xrange(count):
+            fp.match(path)
+    return (timed(precompiled) / count, timed(reparsed) / count,
+            timed(match) / count)
+
+def bench_walk_match( dir_counts=(10, 100), files_per_dir=50,
+                      pattern="src/{dir}/{base}.c", job_counts=(1, 4) ):
+    """Time to find the files in a tree that match a pattern: with os.walk
+    and a full match of every path, and with FilePattern.walk using some
+    numbers of threads.  Half of the directories are outside of src/, and a
+    third of the files end in .c.
+    """
+    fp = testdecorator.FilePattern(pattern)
+    results = []
+    for num_dirs in dir_counts:
+        root = tempfile.mkdtemp()
+        try:
+            for i in xrange(num_dirs):
+                top = 'src' if i % 2 else 'other'
+                dirpath = os.path.join(root, top, 'd%d' % i)
+                os.makedirs(dirpath)
+                for j in xrange(files_per_dir):
+                    name = 'f%d.%s' % (j, 'cho'[j % 3])
+                    open(os.path.join(dirpath, name), 'w').close()
+            def walked():
+                for dirpath, dirnames, filenames in os.walk(root):
+                    rel = os.path.relpath(dirpath, root)
+                    for name in filenames:
+                        fp.match(os.path.join(rel, name))
+            times = [timed(walked)]
+            for jobs in job_counts:
+                times.append(timed(lambda: list(fp.walk(root, jobs))))
+            results.append((num_dirs * files_per_dir, times))
+        finally:
+            shutil.rmtree(root)
+    return results
+
+def long_path( length ):
+    """A path of about length characters that matches match_pattern"""
+    dirs = "/".join("dir%d" % i for i in xrange(length // 5))
+    return ("src/%s/lib/name-1.2.3.tar.gz" % dirs)[-length:]
+
+def bench_match_matrix( lengths=(50, 200, 800),
+                        pattern="{top}/lib/{name}-{version}.{ext}" ):
+    """Time to build a MatchMatrix for a long path against a pattern with
+    several variables, with each backend (numpy only if it is installed).
+    """
+    results = []
+    for length in lengths:
+        path = long_path(length)
+        python = timed(lambda: testunify.MatchMatrix(path, pattern,
+                                                     backend='python'))
+        vectorized = None
+        if testunify.numpy is not None:
+            vectorized = timed(lambda: testunify.MatchMatrix(
+                path, pattern, backend='numpy'))
+        results.append((len(path), python, vectorized))
+    return results
+
+def bench_first_unifier( lengths=(50, 200, 800, 1600),
+                         pattern="{head}{tail}" ):
+    """Time to get the first and all of the maps of a built MatchMatrix,
+    for a path against a pattern that splits it anywhere (so there are
+    length - 1 maps).
+    """
+    results = []
+    for length in lengths:
+        matrix = testunify.MatchMatrix(long_path(length), pattern)
+        matrix.count()
+        first = timed(lambda: next(matrix.maps()))
+        every = timed(lambda: list(matrix.maps()))
+        results.append((length, matrix.count(), first, every))
+    return results
+
+def bench_pattern_solve( file_counts=(100, 1000, 10000), queries=200 ):
+    """Time to prove built(fileN.o) for a ground file name, from one pattern
+    rule built({base}.o) :- built({base}.c) and a fact per source, and from
+    a concrete rule per object instead.
+    """
+    def built( name ):
+        return Predicate('built', [Pattern(name)])
+    results = []
+    for num_files in file_counts:
+        sources = ['file%d' % i for i in xrange(num_files)]
+        targets = [built('%s.o' % sources[i * num_files // queries])
+                   for i in xrange(queries)]
+        pattern = Prolog()
+        pattern.add_rule(Rule(built('{base}.o'), [built('{base}.c')]))
+        concrete = Prolog()
+        for name in sources:
+            concrete.add_rule(Rule(built(name + '.o'), [built(name + '.c')]))
+        for prolog in (pattern, concrete):
+            for name in sources:
+                prolog.add_rule(Rule(built(name + '.c')))
+        def solve( prolog ):
+            def run():
+                for target in targets:
+                    for answer in prolog.answer_iter([target]):
+                        pass
+            return run
+        results.append((num_files, timed(solve(pattern)) / queries,
+                        timed(solve(concrete)) / queries))
+    return results
+
+def bench_load_rules( rule_counts=(10000, 50000) ):
+    """Time to load a .pdb rule base of objects built from sources and
+    headers: parsing it (and writing the cache), and then from the cache.
+    """
+    results = []
+    for num_rules in rule_counts:
+        root = tempfile.mkdtemp()
+        try:
+            path = os.path.join(root, 'rules.pdb')
+            with open(path, 'w') as f:
+                for i in xrange(num_rules // 2):
+                    f.write("built(file(f%d, '.o')) :- built(file(f%d, '.c')),"
+                            " exists('h%d.h').\n" % (i, i, i % 10))
+                    f.write("built(file(f%d, '.c')).\n" % i)
+            start = time.time()
+            rulebase.load(path)
+            parsed = time.time() - start
+            start = time.time()
+            rulebase.load(path)
+            cached = time.time() - start
+            results.append((num_rules, parsed, cached))
+        finally:
+            shutil.rmtree(root)
+    return results
+
+# The benchmarks run_suite() runs by default, by name, in the order they are
+# printed.  Each name is a bench_ function.
+SUITE = ['resolution_step', 'alias_chain', 'occurs_check', 'proof_depth',
+         'clause_lookup', 'fact_memory', 'parallel', 'build_jobs',
+         'state_build', 'action_cache', 'tabling', 'profiler', 'noop_build',
+         'constraints', 'pattern_rules', 'file_pattern', 'walk_match',
+         'match_matrix', 'pattern_solve', 'first_unifier', 'load_rules',
+         'c_project', 'pattern_parse', 'reorder']
+
+def run_suite( names=SUITE ):
+    """Runs the named benchmarks and returns their results by name"""
+    return dict((name, globals()['bench_' + name]()) for name in names)
+
+def environment():
+    """Describes where the results come from: the Python version, the
+    platform, and the git commit of this tree if it is in a repository.
+    """
+    try:
+        commit = subprocess.Popen(
+            ['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0]
+    except OSError:
+        commit = ''
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'commit': commit.strip() or None,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def compare_results( old, new, threshold=1.2 ):
+    """Returns a line for each time (or other float) in new that is more
+    than threshold times larger or smaller than the same one in old.
+    Integers are taken to be the parameters of a row and are not compared.
+
+    >>> old = {'lookup': [(10, 0.5), (100, 1.0)], 'gone': [(1, 1.0)]}
+    >>> new = {'lookup': [[10, 0.55], [100, 2.0]]}
+    >>> compare_results(old, new)
+    ['lookup[1][1]: 1 -> 2 (2.00x)']
+    """
+    lines = []
+    def walk( path, a, b ):
+        if isinstance(a, float) and isinstance(b, (int, float)):
+            if a > 0 and b > 0 and not (1.0 / threshold <= b / a <=
+                                        threshold):
+                lines.append("%s: %.3g -> %.3g (%.2fx)" % (path, a, b,
+                                                           b / a))
+        elif isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+            for i, (x, y) in enumerate(zip(a, b)):
+                walk("%s[%d]" % (path, i), x, y)
+        elif isinstance(a, dict) and isinstance(b, dict):
+            for key in sorted(set(a) & set(b)):
+                walk("%s[%r]" % (path, key), a[key], b[key])
+    for name in sorted(set(old) & set(new)):
+        walk(name, old[name], new[name])
+    return lines
+
+def print_results( results ):
+    """Prints the results of run_suite() as tables"""
+    if 'resolution_step' in results:
+        print "RESOLUTION STEP (per candidate rule)"
+        print "%10s %14s %14s" % ("bindings", "step (us)", "copy (us)")
+        for num_bindings, step, copy in results['resolution_step']:
+            print "%10d %14.2f %14.2f" % (num_bindings, step * 1e6, copy * 1e6)
+
+    if 'alias_chain' in results:
+        print
+        print "ALIAS CHAIN (per deep_get)"
+        print "%10s %14s" % ("length", "lookup (us)")
+        for length, elapsed in results['alias_chain']:
+            print "%10d %14.2f" % (length, elapsed * 1e6)
+
+    if 'occurs_check' in results:
+        print
+        print "OCCURS CHECK (per bind to a deep file(...) term)"
+        print "%10s %14s %14s %14s" % ("depth", "ground skip", "never",
+                                       "full walk")
+        for depth, skip, never, walk in results['occurs_check']:
+            print "%10d %14.2f %14.2f %14.2f" % (depth, skip * 1e6,
+                                                 never * 1e6, walk * 1e6)
+
+    if 'proof_depth' in results:
+        print
+        print "PROOF DEPTH"
+        print "%10s %14s %14s" % ("depth", "first (us)", "next (us)")
+        for depth, first, rest in results['proof_depth']:
+            print "%10d %14.2f %14.2f" % (depth, first * 1e6, rest * 1e6)
+
+    if 'clause_lookup' in results:
+        print
+        print "CLAUSE LOOKUP (one bound file fact)"
+        print "%10s %14s" % ("facts", "query (us)")
+        for num_facts, elapsed in results['clause_lookup']:
+            print "%10d %14.2f" % (num_facts, elapsed * 1e6)
+
+    if 'fact_memory' in results:
+        print
+        print "FACT MEMORY"
+        num_facts, per_fact = results['fact_memory']
+        print "%10d facts, %.1f bytes per fact" % (num_facts, per_fact)
+
+    if 'parallel' in results:
+        print
+        print "PARALLEL OR-BRANCHES"
+        print "%10s %14s" % ("processes", "query (ms)")
+        for processes, elapsed in results['parallel']:
+            print "%10s %14.2f" % (processes, elapsed * 1e3)
+
+    if 'build_jobs' in results:
+        print
+        print "PARALLEL BUILD (16 objects, 10ms each)"
+        print "%10s %14s" % ("jobs", "build (ms)")
+        for jobs, elapsed in results['build_jobs']:
+            print "%10d %14.2f" % (jobs, elapsed * 1e3)
+
+    if 'state_build' in results:
+        print
+        print "NO-OP BUILD WITH RECORDED STATE (objects from sources)"
+        print "%10s %14s %14s" % ("files", "tested (ms)", "recorded (ms)")
+        for num_files, tested, recorded in results['state_build']:
+            print "%10d %14.2f %14.2f" % (num_files, tested * 1e3,
+                                          recorded * 1e3)
+
+    if 'action_cache' in results:
+        print
+        print "BRANCH SWITCH (50 objects, 10ms each)"
+        run, restored = results['action_cache']
+        print "%10s %14.2f" % ("run (ms)", run * 1e3)
+        print "%10s %14.2f" % ("cached (ms)", restored * 1e3)
+
+    if 'tabling' in results:
+        print
+        print "TABLING (layered dependency graph)"
+        print "%10s %14s %8s %8s" % ("tabling", "query (ms)", "hits", "misses")
+        for tabling, elapsed, stats in results['tabling']:
+            print "%10s %14.2f %8d %8d" % (tabling, elapsed * 1e3,
+                                            stats['hits'], stats['misses'])
+
+    if 'profiler' in results:
+        print
+        print "PROFILER (layered dependency graph)"
+        plain, profiled = results['profiler']
+        print "%10s %14.2f" % ("off (ms)", plain * 1e3)
+        print "%10s %14.2f" % ("on (ms)", profiled * 1e3)
+
+    if 'noop_build' in results:
+        print
+        print "NO-OP BUILD (objects checked against source and 5 headers)"
+        print "%10s %14s %14s" % ("files", "stat (ms)", "walk (ms)")
+        for num_files, per_stat, walk in results['noop_build']:
+            print "%10d %14.2f %14.2f" % (num_files, per_stat * 1e3,
+                                          walk * 1e3)
+
+    if 'constraints' in results:
+        print
+        print "CONSTRAINED BINDINGS (1000 paths, alias chains of 10)"
+        print "%10s %14s %14s %14s" % ("length", "default (ms)",
+                                       "rematch (ms)", "memo (ms)")
+        for length, default, rematch, memo in results['constraints']:
+            print "%10d %14.2f %14.2f %14.2f" % (length, default * 1e3,
+                                                 rematch * 1e3, memo * 1e3)
+
+    if 'pattern_rules' in results:
+        print
+        print "PATTERN RULE LOOKUP (per target)"
+        print "%10s %14s %14s" % ("patterns", "combined (us)", "each (us)")
+        for num_patterns, combined, each in results['pattern_rules']:
+            print "%10d %14.2f %14.2f" % (num_patterns, combined * 1e6,
+                                          each * 1e6)
+
+    if 'file_pattern' in results:
+        print
+        print "FILE PATTERN (src/{dir}/{name}-{version}.{ext})"
+        precompiled, reparsed, match = results['file_pattern']
+        print "%10s %14s %14s" % ("", "realize (us)", "match (us)")
+        print "%10s %14.2f %14.2f" % ("compiled", precompiled * 1e6,
+                                      match * 1e6)
+        print "%10s %14.2f" % ("reparsed", reparsed * 1e6)
+
+    if 'walk_match' in results:
+        print
+        print "TREE MATCH (src/{dir}/{base}.c)"
+        print "%10s %14s %14s %14s" % ("files", "os.walk (ms)", "1 job (ms)",
+                                       "4 jobs (ms)")
+        for num_files, times in results['walk_match']:
+            print "%10d %14.2f %14.2f %14.2f" % ((num_files,) +
+                                                 tuple(t * 1e3 for t in times))
+
+    if 'match_matrix' in results:
+        print
+        print "MATCH MATRIX (path against a pattern with 4 variables)"
+        print "%10s %14s %14s" % ("length", "python (ms)", "numpy (ms)")
+        for length, python, vectorized in results['match_matrix']:
+            if vectorized is None:
+                print "%10d %14.2f %14s" % (length, python * 1e3, "n/a")
+            else:
+                print "%10d %14.2f %14.2f" % (length, python * 1e3,
+                                              vectorized * 1e3)
+
+    if 'pattern_solve' in results:
+        print
+        print "PATTERN RULES (per ground query)"
+        print "%10s %14s %14s" % ("files", "pattern (us)", "concrete (us)")
+        for num_files, pattern, concrete in results['pattern_solve']:
+            print "%10d %14.2f %14.2f" % (num_files, pattern * 1e6,
+                                          concrete * 1e6)
+
+    if 'first_unifier' in results:
+        print
+        print "MATCH MATRIX MAPS ({head}{tail} against a path)"
+        print "%10s %10s %14s %14s" % ("length", "maps", "first (us)",
+                                       "all (ms)")
+        for length, count, first, every in results['first_unifier']:
+            print "%10d %10d %14.2f %14.2f" % (length, count, first * 1e6,
+                                               every * 1e3)
+
+    if 'load_rules' in results:
+        print
+        print "RULE BASE LOADING (.pdb file)"
+        print "%10s %14s %14s" % ("rules", "parse (ms)", "cached (ms)")
+        for num_rules, parsed, cached in results['load_rules']:
+            print "%10d %14.2f %14.2f" % (num_rules, parsed * 1e3,
+                                          cached * 1e3)
+
+    if 'c_project' in results:
+        print
+        print "C PROJECT (.y -> .c -> .o per file, one link rule)"
+        print "%10s %14s %14s" % ("files", "resolve (ms)", "build (ms)")
+        for num_files, resolved, built in results['c_project']:
+            print "%10d %14.2f %14.2f" % (num_files, resolved * 1e3,
+                                          built * 1e3)
+
+    if 'pattern_parse' in results:
+        print
+        print "LONG PATTERNS (d0-{v0}/d1-{v1}/...)"
+        print "%10s %14s %14s" % ("variables", "parse (us)", "realize (us)")
+        for num_vars, parsed, realized in results['pattern_parse']:
+            print "%10d %14.2f %14.2f" % (num_vars, parsed * 1e6,
+                                          realized * 1e6)
+
+    if 'reorder' in results:
+        print
+        print "GOAL REORDERING (10 yacc sources among 1000 nodes)"
+        print "%10s %14s %14s" % ("reorder", "query (ms)", "choicepoints")
+        for mode, elapsed, choicepoints in results['reorder']:
+            print "%10s %14.2f %14d" % (mode, elapsed * 1e3, choicepoints)
+
+
+def main( argv ):
+    parser = argparse.ArgumentParser(description="Times the hot paths of "
+                                     "the engine and prints tables.")
+    parser.add_argument('names', nargs='*', metavar='NAME',
+                        help="benchmarks to run (default: all of %s)" %
+                        ", ".join(SUITE))
+    parser.add_argument('--json', metavar='FILE',
+                        help="also write the results to FILE")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="list the results that changed by more than "
+                        "--threshold from those in FILE (from --json)")
+    parser.add_argument('--threshold', type=float, default=1.2)
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.names if name not in SUITE]
+    if unknown:
+        parser.error("unknown benchmarks: %s" % ", ".join(unknown))
+    results = run_suite(args.names or SUITE)
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f,
+                      indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        # Round trip through json, so both sides have lists for tuples.
+        new = json.loads(json.dumps(results))
+        print
+        print "CHANGES SINCE %s (%s)" % (args.compare,
+                                         old['environment'].get('commit'))
+        for line in compare_results(old['results'], new, args.threshold):
+            print line
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+
+# vim: et sts=4 sw=4
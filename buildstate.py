@@ -0,0 +1,282 @@
+"""buildstate.py
+
+What happened in earlier builds, kept in a SQLite database so that the next
+build can skip the work it already did.
+
+For every ground rule instance that ran, the database holds the command
+lines it ran, whether it succeeded, and the state of the files it is about
+as of then.  An instance whose files and command lines are unchanged, and
+whose dependencies are all in the same position, need not be tested again.
+
+For every set of queries that was built, it also holds the state of all of
+the files in the proof, and what is in the directories that hold them.  If
+none of that has changed (and neither has the rule base) the queries are up
+to date without resolving them at all, which costs one stat per file and
+one listing per directory.  A new file next to the others (a new source
+that some rule would match, say) makes the queries out of date.
+
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import weakref
+
+from prolog import variant_key
+from schedule import consequent_files
+import schedule
+
+_schema = """
+CREATE TABLE IF NOT EXISTS instances (
+    key TEXT PRIMARY KEY,
+    commands TEXT NOT NULL,
+    ok INTEGER NOT NULL,
+    inputs TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS queries (
+    key TEXT PRIMARY KEY,
+    rules TEXT NOT NULL,
+    inputs TEXT NOT NULL
+);
+"""
+
+def instance_key( rule ):
+    """Identifies a ground rule instance across runs"""
+    return "%s %s :- %s" % (rule.__class__.__name__, rule.consequent,
+                            ", ".join(str(a) for a in rule.antecedents))
+
+# Prolog -> (number of rules digested, sha1 object), so that a rule base
+# is only digested once, and after that only the rules added to it since.
+_digests = weakref.WeakKeyDictionary()
+
+def rules_digest( prolog ):
+    """A digest of the rules in a rule base that does not depend on the
+    names their variables happen to have in this process.
+
+    Rules are only ever added to a rule base, so the digest is kept and
+    brought up to date with the new ones.  Pass the digest of the file the
+    rules were loaded from to build() to skip even the first one.
+    """
+    count, digest = _digests.get(prolog, (0, hashlib.sha1()))
+    rules = prolog.rules
+    if count == len(rules):
+        return digest.hexdigest()
+    digest = digest.copy()
+    for rule in rules[count:]:
+        numbering = {}
+        digest.update(repr((rule.__class__.__name__,
+                            variant_key(rule.consequent, None, numbering),
+                            [variant_key(a, None, numbering)
+                             for a in rule.antecedents])))
+    _digests[prolog] = (len(rules), digest)
+    return digest.hexdigest()
+
+class BuildState(object):
+    """The outcome of earlier builds, in a database file (or in memory, for
+    ':memory:').
+
+    files returns the paths that a rule instance is about, and stats, if
+    given, is a filestate.StatCache to look them up in instead of stat'ing
+    them.
+    """
+    def __init__( self, filename=':memory:', files=consequent_files,
+                  stats=None ):
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.executescript(_schema)
+        self.files = files
+        self.stats = stats
+
+    def close( self ):
+        self.db.close()
+
+    def fingerprint( self, path ):
+        """Returns [mtime, size] for path, or None if it is missing"""
+        if self.stats is not None:
+            info = self.stats.lookup(path)
+            return info and [info[0], info[1]]
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_mtime, st.st_size]
+
+    def inputs( self, paths ):
+        return dict((path, self.fingerprint(path)) for path in paths)
+
+    def listing( self, dirname ):
+        """Returns a digest of the names in dirname, or None if it cannot be
+        listed
+        """
+        try:
+            names = sorted(os.listdir(dirname))
+        except OSError:
+            return None
+        return hashlib.sha1("\0".join(names)).hexdigest()
+
+    def current( self, graph ):
+        """Returns the keys of the nodes in graph that succeeded before with
+        the same command lines and files, and whose dependencies are all
+        current too.
+        """
+        current = set()
+        for node in graph:
+            if any(dep.key not in current for dep in node.deps):
+                continue
+            row = self.db.execute(
+                "SELECT commands, ok, inputs FROM instances WHERE key = ?",
+                (instance_key(node.rule),)).fetchone()
+            if (row is not None and row[1] and
+                    json.loads(row[0]) == node.rule.command_lines() and
+                    json.loads(row[2]) ==
+                    self.inputs(self.files(node.rule))):
+                current.add(node.key)
+        return current
+
+    def record( self, graph, succeeded, failed=() ):
+        """Stores the outcome of the nodes in graph whose keys are in
+        succeeded, and of the failed ones.
+        """
+        failed = set(failed)
+        rows = []
+        for node in graph:
+            ok = node.key in succeeded
+            if ok or node in failed:
+                rows.append((instance_key(node.rule),
+                             json.dumps(node.rule.command_lines()), int(ok),
+                             json.dumps(self.inputs(self.files(node.rule)))))
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?)", rows)
+
+    def record_queries( self, queries, rules, graph ):
+        """Remembers that queries were built from the rule base with the
+        given digest, with the files in graph and the directories they are
+        in as they are now.
+        """
+        paths = set()
+        for node in graph:
+            paths.update(self.files(node.rule))
+        inputs = self.inputs(paths)
+        # Directories are told apart from files by their dict fingerprint.
+        for dirname in set(os.path.dirname(p) for p in paths):
+            inputs[dirname] = {'listing': self.listing(dirname)}
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO queries VALUES (?, ?, ?)",
+                (str(queries), rules, json.dumps(inputs)))
+
+    def queries_current( self, queries, rules ):
+        """Whether queries were last built from the rule base with the given
+        digest and none of their files, nor the set of files in their
+        directories, has changed since.
+        """
+        row = self.db.execute(
+            "SELECT rules, inputs FROM queries WHERE key = ?",
+            (str(queries),)).fetchone()
+        if row is None or row[0] != rules:
+            return False
+        for path, fingerprint in json.loads(row[1]).iteritems():
+            if isinstance(fingerprint, dict):
+                if self.listing(path) != fingerprint['listing']:
+                    return False
+            elif self.fingerprint(path) != fingerprint:
+                return False
+        return True
+
+def build( prolog, queries, state, jobs=1, rules=None ):
+    """Builds queries like schedule.build, skipping what state records as
+    done.  Returns True if the queries were built or were already up to
+    date, and False if there was no proof that could be satisfied.
+
+    rules identifies the rule base (for example the digest of the file it
+    was loaded from); by default it is rules_digest(prolog).
+
+    >>> import shutil, tempfile
+    >>> from prolog import Predicate, Rule, Prolog
+    >>> root = tempfile.mkdtemp()
+    >>> def path(name):
+    ...     return os.path.join(root, name)
+    >>> def f(name):
+    ...     return Predicate('built', [Predicate(path(name))])
+    >>> runs = []
+    >>> class Cat(Rule):
+    ...     def pre_test( self ):
+    ...         runs.append('test')
+    ...         target = self.consequent.args[0].name
+    ...         sources = [a.args[0].name for a in self.antecedents]
+    ...         return (os.path.exists(target) and
+    ...                 all(os.path.getmtime(s) <= os.path.getmtime(target)
+    ...                     for s in sources))
+    ...     def commands( self ):
+    ...         runs.append(os.path.basename(self.consequent.args[0].name))
+    ...         with open(self.consequent.args[0].name, 'w') as out:
+    ...             for a in self.antecedents:
+    ...                 out.write(open(a.args[0].name).read())
+    >>> for name in ['a.c', 'b.c']:
+    ...     with open(path(name), 'w') as out:
+    ...         out.write(name)
+    ...     os.utime(path(name), (100, 100))
+    >>> prolog = Prolog()
+    >>> prolog.add_rule(Cat(f('prog'), [f('a.o'), f('b.o')]))
+    >>> prolog.add_rule(Cat(f('a.o'), [f('a.c')]))
+    >>> prolog.add_rule(Cat(f('b.o'), [f('b.c')]))
+    >>> prolog.add_rule(Cat(f('a.c')))
+    >>> prolog.add_rule(Cat(f('b.c')))
+    >>> state = BuildState(path('state.db'))
+    >>> build(prolog, [f('prog')], state)
+    True
+    >>> sorted(r for r in runs if r != 'test')
+    ['a.o', 'b.o', 'prog']
+    >>> del runs[:]
+    >>> state.close()
+
+    Nothing has changed, so nothing is resolved, tested or run:
+
+    >>> state = BuildState(path('state.db'))
+    >>> build(prolog, [f('prog')], state)
+    True
+    >>> runs
+    []
+
+    After a change only the instances on the way from it to the queries are
+    tested:
+
+    >>> with open(path('b.c'), 'w') as out:
+    ...     out.write('changed')
+    >>> build(prolog, [f('prog')], state)
+    True
+    >>> runs
+    ['test', 'test', 'b.o', 'test', 'test', 'prog', 'test']
+    >>> open(path('prog')).read()
+    'a.cchanged'
+
+    A new file might change the proof, so it is resolved again:
+
+    >>> state.queries_current([f('prog')], rules_digest(prolog))
+    True
+    >>> open(path('c.c'), 'w').close()
+    >>> state.queries_current([f('prog')], rules_digest(prolog))
+    False
+    >>> state.close()
+    >>> shutil.rmtree(root)
+    """
+    if rules is None:
+        rules = rules_digest(prolog)
+    if state.queries_current(queries, rules):
+        return True
+    result = schedule.build(prolog, queries, jobs, state)
+    if result is None:
+        return False
+    varmap, graph = result
+    state.record_queries(queries, rules, graph)
+    return True
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
+
+# vim: et sts=4 sw=4
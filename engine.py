@@ -6,22 +6,120 @@ Implements the main logic engine for Hagoth.
 
 import re
 
+import filestate
+from util import LRUCache
+
+class BuildFiles(object):
+    """What the file rules of one build know about the filesystem: the
+    state of the files under roots, read once, and, if hash_file is given,
+    the content digests kept there, so that touching a file without
+    changing it does not make it out of date.  Pass the same one to every
+    rule of a build, and call finish() afterwards to save the digests.
+    """
+    def __init__( self, roots=(), hash_file=None ):
+        self.stats = filestate.StatCache(roots)
+        self.stats.refresh()
+        self.hashes = None
+        if hash_file is not None:
+            self.hashes = filestate.HashStore(hash_file)
+
+    def finish( self ):
+        if self.hashes is not None:
+            self.hashes.save()
+
+def filename( arg ):
+    """The file name that a predicate argument stands for"""
+    if isinstance(arg, Predicate):
+        return arg.name
+    return arg
+
 class Predicate(object):
     def __init__( self, name, args=() ):
         self.name = name
         self.args = args
 
+# Compiled constraints, by pattern.  There are only ever as many of these as
+# there are distinct patterns in the rules, so they are never evicted.
+_compiled = {}
+
+def compile_constraint( constraint ):
+    """Returns a regex that matches all of a value, for a pattern string or
+    a compiled regex.  Compiling the same pattern twice gives the same object.
+
+    >>> compile_constraint(r"(.*)\.o") is compile_constraint(r"(.*)\.o")
+    True
+    >>> compile_constraint(r"(.*)\.o").match("main.o.c") is None
+    True
+    """
+    if isinstance(constraint, basestring):
+        key = (constraint, 0)
+    else:
+        key = (constraint.pattern, constraint.flags)
+    regex = _compiled.get(key)
+    if regex is None:
+        regex = _compiled[key] = re.compile(r"(?:%s)\Z" % key[0], key[1])
+    return regex
+
+# (regex, value) -> (groups, named groups), or None if it does not match,
+# for values of at least MEMO_MIN_LENGTH characters.  Matching a short value
+# again is cheaper than building the key and looking it up; a long one is
+# worth remembering when it is bound along a chain of aliased variables with
+# the same constraint, or to many rules that share a pattern.  See
+# bench.bench_constraints.
+MEMO_MIN_LENGTH = 64
+match_cache = LRUCache(10000)
+
+def match_constraint( regex, value ):
+    """Returns (groups, named groups) if regex matches all of value, or None.
+    Callers match short values themselves; see MEMO_MIN_LENGTH.
+    """
+    key = (regex, value)
+    try:
+        result = match_cache[key]
+    except KeyError:
+        match_cache.misses += 1
+    else:
+        match_cache.hits += 1
+        return result
+    result = None
+    match = regex.match(value)
+    if match is not None:
+        result = (match.groups(), match.groupdict())
+    match_cache[key] = result
+    return result
+
 class Var(object):
-    def __init__( self, name, constraint=re.compile(".*") ):
+    def __init__( self, name, constraint=None ):
         """Create a new variable with the given name and constraints
 
         args:
             name - name of the variable
-            constraint - regular expression intended to match the entire value.
-                If the constraint doesn't match, assignment is impossible.
+            constraint - regular expression (a string or compiled) intended
+                to match the entire value.  If the constraint doesn't match,
+                assignment is impossible.  None accepts any value.
         """
         self.name = name
-        self.regex = regex
+        self.regex = None
+        if constraint is not None:
+            self.regex = compile_constraint(constraint)
+
+    def __repr__( self ):
+        return "%s(%r)" % (self.__class__.__name__, self.name)
+
+    def accepts( self, value ):
+        """Whether value satisfies this variable's constraint"""
+        regex = self.regex
+        if regex is None:
+            return True
+        if len(value) < MEMO_MIN_LENGTH:
+            return regex.match(value) is not None
+        return match_constraint(regex, value) is not None
+
+    def group( self, key ):
+        """Returns the variable standing for a submatch of this one, like
+        file(1) in DESIGN: key is a group number or name.
+        """
+        return Var("%s(%s)" % (self.name, key))
 
 class Assignment(object):
     """A variable assignment containing a variable and its value
@@ -29,6 +127,29 @@ class Assignment(object):
     Holds state pertinent to that assignment, like submatches in the
     constraints.  Currently just implemented as a regex with groups, but a more
     general implementation is needed.
+
+    >>> match_cache.clear()
+    >>> obj = Var('file', r"(?P<base>.*)\.o")
+    >>> a = Assignment(obj, 'main.o')
+    >>> sorted(a.derived().items())
+    [('file(1)', 'main'), ('file(base)', 'main')]
+    >>> a.group(1)
+    'main'
+    >>> alias = Var('target', r"(?P<base>.*)\.o")
+    >>> Assignment(alias, 'main.o').group('base')
+    'main'
+    >>> long_name = 'sub/' * 20 + 'main.o'
+    >>> Assignment(obj, long_name).group('base') == long_name[:-2]
+    True
+    >>> Assignment(alias, long_name).group('base') == long_name[:-2]
+    True
+    >>> match_cache.misses, match_cache.hits
+    (1, 1)
+    >>> try:
+    ...     Assignment(obj, 'main.c')
+    ... except ValueError, e:
+    ...     print e
+    'main.c' does not match the constraint on file
     """
 
     def __init__( self, var, value ):
@@ -45,8 +166,40 @@ class Assignment(object):
         # A full match is expected -- no part of the variable may be left
         # unmatched by the regular expression.  This ensures, among other
         # things, that the group assignments are maximally predictable.
-        self.match = var.regex.match(value)
-        assert self.match is not None
+        self.groups = ()
+        self.groupdict = {}
+        regex = var.regex
+        if regex is not None:
+            if len(value) < MEMO_MIN_LENGTH:
+                match = regex.match(value)
+                if match is not None:
+                    match = match.groups(), match.groupdict()
+            else:
+                match = match_constraint(regex, value)
+            if match is None:
+                raise ValueError("%r does not match the constraint on %s" %
+                                 (value, var.name))
+            self.groups, self.groupdict = match
+
+    def group( self, key ):
+        """Returns a submatch by group number (from 1) or name"""
+        if isinstance(key, basestring):
+            return self.groupdict[key]
+        return self.groups[key - 1]
+
+    def derived( self ):
+        """Returns the bindings that follow from this one: the name of the
+        variable for each submatch (see Var.group) and its value.  Groups
+        that did not take part in the match are left out.
+        """
+        result = {}
+        for i, value in enumerate(self.groups):
+            if value is not None:
+                result[self.var.group(i + 1).name] = value
+        for key, value in self.groupdict.iteritems():
+            if value is not None:
+                result[self.var.group(key).name] = value
+        return result
 
 class Rule(object):
     def __init__( self, consequent, antecedents ):
@@ -80,8 +233,82 @@ class Rule(object):
         raise NotImplementedError()
 
 class FileIsCurrentRule(Rule):
-    # TODO: test and commands
-    pass
+    """FileIsCurrent(target) :- FileIsCurrent(source), ...
+
+    The test passes when the target exists and is newer than all of its
+    sources, or, with content digests (see BuildFiles), when the sources
+    have not changed since the target was last built.  Subclasses provide
+    the commands.
+
+    files is the BuildFiles of the build the rule is part of.  Without one,
+    the rule stats files itself (once each) and keeps no digests.
+
+    >>> import os, shutil, tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> main_c = os.path.join(root, 'main.c')
+    >>> main_o = os.path.join(root, 'main.o')
+    >>> for path, t in [(main_c, 100), (main_o, 200)]:
+    ...     open(path, 'w').close()
+    ...     os.utime(path, (t, t))
+    >>> hashes = os.path.join(root, '.hashes')
+    >>> def rule(files):
+    ...     return FileIsCurrentRule(Predicate('FileIsCurrent', [main_o]),
+    ...                              [Predicate('FileIsCurrent', [main_c])],
+    ...                              files)
+    >>> files = BuildFiles([root], hashes)
+    >>> rule(files).test({})
+    True
+    >>> files.finish()
+    >>> os.utime(main_c, (300, 300))
+    >>> rule(BuildFiles([root], hashes)).test({})
+    True
+    >>> files = BuildFiles([root])
+    >>> rule(files).test({})
+    False
+    >>> ExistsRule(Predicate('Exists', [main_c]), files=files).test({})
+    True
+    >>> files.stats.stat_calls
+    0
+    >>> rule(None).test({})
+    False
+    >>> shutil.rmtree(root)
+    """
+    def __init__( self, consequent, antecedents=(), files=None ):
+        super(FileIsCurrentRule, self).__init__(consequent, antecedents)
+        if files is None:
+            files = BuildFiles()
+        self.files = files
+
+    def target( self ):
+        return filename(self.consequent.args[0])
+
+    def sources( self ):
+        return [filename(a.args[0]) for a in self.antecedents
+                if a.name == 'FileIsCurrent']
+
+    def test( self, assignments ):
+        return filestate.is_current(self.target(), self.sources(),
+                                    self.files.stats, self.files.hashes)
+
+    def built( self ):
+        """Call after the commands have run: the target has changed"""
+        stats = self.files.stats
+        stats.update(self.target())
+        if self.files.hashes is not None:
+            self.files.hashes.record(self.target(), self.sources(), stats)
+
+class ExistsRule(Rule):
+    """Exists(path): a primitive that is true if the file is there.  files
+    is as for FileIsCurrentRule.
+    """
+    def __init__( self, consequent, antecedents=(), files=None ):
+        super(ExistsRule, self).__init__(consequent, antecedents)
+        if files is None:
+            files = BuildFiles()
+        self.files = files
+
+    def test( self, assignments ):
+        return self.files.stats.exists(filename(self.consequent.args[0]))
 
 
 class Engine(object):
@@ -112,4 +339,11 @@ class Engine(object):
     #   - Special handling of variable-to-variable mappings and assignment
     #       collapsing when appropriate.
 
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
+
 # vim: et sts=4 sw=4
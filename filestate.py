@@ -0,0 +1,298 @@
+"""filestate.py
+
+What the file rules know about the filesystem.  A StatCache walks the build
+tree once per build, so a no-op build costs one directory walk instead of a
+stat call per test.  A HashStore remembers file contents on disk, so a file
+that was touched but not changed does not force a rebuild.
+
+"""
+
+import cPickle as pickle
+import hashlib
+import os
+import stat
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+class StatCache(object):
+    """(mtime, size, is_dir) for the files under some root directories.
+
+    With the scandir module, refresh() reads everything under the roots in
+    one walk, and after that a lookup under a root needs no system call at
+    all, even for a file that does not exist.  Python 2's os.listdir does not
+    return stat information, so without scandir directories are listed
+    (once each, when first needed) and a file under a root is only stat'ed
+    the first time it is looked up; files that are never looked up, and
+    files that do not exist, cost no stat call.  Paths outside the roots are
+    stat'ed when first asked for and remembered.  Call update() for a path
+    that a command has just written.
+
+    >>> import shutil, tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> for name in ['a.c', 'b.c']:
+    ...     open(os.path.join(root, name), 'w').close()
+    >>> os.mkdir(os.path.join(root, 'sub'))
+    >>> stats = StatCache([root])
+    >>> stats.refresh()
+    >>> stats.stat_calls
+    0
+    >>> stats.exists(os.path.join(root, 'a.c'))
+    True
+    >>> stats.lookup(os.path.join(root, 'sub'))[2]
+    True
+    >>> stats.exists(os.path.join(root, 'a.o'))
+    False
+    >>> stats.stat_calls
+    0
+    >>> open(os.path.join(root, 'a.o'), 'w').close()
+    >>> stats.exists(os.path.join(root, 'a.o'))
+    False
+    >>> stats.update(os.path.join(root, 'a.o'))
+    >>> stats.exists(os.path.join(root, 'a.o'))
+    True
+    >>> stats.stat_calls
+    1
+    >>> shutil.rmtree(root)
+    """
+    def __init__( self, roots=() ):
+        self.roots = [os.path.abspath(r) for r in roots]
+        # Absolute path -> (mtime, size, is_dir), or None if it is missing.
+        self.entries = {}
+        # Directory under a root -> the set of names in it
+        self.listings = {}
+        # Number of stat calls made for paths outside the roots, and by
+        # update()
+        self.stat_calls = 0
+
+    def refresh( self ):
+        """Forgets everything and reads the roots again"""
+        self.entries.clear()
+        self.listings.clear()
+        for root in self.roots:
+            info = self.entries[root] = self._stat(root)
+            if info is not None and info[2]:
+                if scandir is not None:
+                    self._walk(root)
+                else:
+                    self._list(root)
+
+    def _stat( self, path ):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, stat.S_ISDIR(st.st_mode))
+
+    def _walk( self, root ):
+        stack = [root]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                entries = list(scandir(dirpath))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    info = None
+                else:
+                    info = (st.st_mtime, st.st_size,
+                            stat.S_ISDIR(st.st_mode))
+                self.entries[entry.path] = info
+                if info is not None and info[2]:
+                    stack.append(entry.path)
+            self.listings[dirpath] = set(e.name for e in entries)
+
+    def _list( self, dirpath ):
+        try:
+            names = set(os.listdir(dirpath))
+        except OSError:
+            # Not a directory (any more)
+            names = set()
+        self.listings[dirpath] = names
+        return names
+
+    def _listing( self, dirpath ):
+        """Returns the names in dirpath if it is under a root, or None"""
+        listing = self.listings.get(dirpath)
+        if listing is not None or scandir is not None or not self.listings:
+            return listing
+        parent, name = os.path.split(dirpath)
+        if parent == dirpath:
+            return None
+        listing = self._listing(parent)
+        if listing is None or name not in listing:
+            return None
+        return self._list(dirpath)
+
+    def lookup( self, path ):
+        """Returns (mtime, size, is_dir) for path, or None if it is missing"""
+        path = os.path.abspath(path)
+        try:
+            return self.entries[path]
+        except KeyError:
+            pass
+        dirpath, name = os.path.split(path)
+        listing = self._listing(dirpath)
+        if listing is not None:
+            if name not in listing:
+                return None
+            info = self.entries[path] = self._stat(path)
+            return info
+        self.stat_calls += 1
+        info = self.entries[path] = self._stat(path)
+        return info
+
+    def exists( self, path ):
+        return self.lookup(path) is not None
+
+    def mtime( self, path ):
+        """Returns the modification time of path, or None if it is missing"""
+        info = self.lookup(path)
+        return info and info[0]
+
+    def update( self, path ):
+        """Stats path again, after something may have changed it"""
+        path = os.path.abspath(path)
+        self.stat_calls += 1
+        self.entries[path] = self._stat(path)
+
+def file_digest( path, blocksize=1 << 16 ):
+    """Returns the sha1 hex digest of a file's contents"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+class HashStore(object):
+    """Content digests of files, and of the sources of each target as they
+    were when the target was last built, kept in a file between builds.
+
+    Digests are keyed by (path, mtime, size), so a file is only read again
+    once its stat changes.  Directories are not read; their digest is their
+    mtime.
+
+    >>> import shutil, tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> src = os.path.join(root, 'a.c')
+    >>> with open(src, 'w') as f:
+    ...     f.write('int a;')
+    >>> stats = StatCache([root])
+    >>> stats.refresh()
+    >>> hashes = HashStore(os.path.join(root, '.hashes'))
+    >>> hashes.unchanged('a.o', [src], stats)
+    False
+    >>> hashes.record('a.o', [src], stats)
+    >>> hashes.save()
+    >>> os.utime(src, (0, 0))
+    >>> stats.update(src)
+    >>> hashes = HashStore(os.path.join(root, '.hashes'))
+    >>> hashes.unchanged('a.o', [src], stats)
+    True
+    >>> with open(src, 'w') as f:
+    ...     f.write('int b;')
+    >>> stats.update(src)
+    >>> hashes.unchanged('a.o', [src], stats)
+    False
+    >>> shutil.rmtree(root)
+    """
+    def __init__( self, filename=None ):
+        self.filename = filename
+        # Absolute path -> (mtime, size, digest)
+        self.digests = {}
+        # Target -> {absolute source path: digest}
+        self.built = {}
+        self.dirty = False
+        if filename is not None and os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                self.digests, self.built = pickle.load(f)
+
+    def digest( self, path, stats ):
+        """Returns the digest of path's contents, or None if it is missing"""
+        path = os.path.abspath(path)
+        info = stats.lookup(path)
+        if info is None:
+            return None
+        mtime, size, is_dir = info
+        if is_dir:
+            return repr(mtime)
+        entry = self.digests.get(path)
+        if entry is not None and entry[:2] == (mtime, size):
+            return entry[2]
+        digest = file_digest(path)
+        self.digests[path] = (mtime, size, digest)
+        self.dirty = True
+        return digest
+
+    def sources_digests( self, sources, stats ):
+        return dict((os.path.abspath(s), self.digest(s, stats))
+                    for s in sources)
+
+    def record( self, target, sources, stats ):
+        """Remembers the contents of target's sources, after it is built"""
+        self.built[os.path.abspath(target)] = self.sources_digests(sources,
+                                                                   stats)
+        self.dirty = True
+
+    def unchanged( self, target, sources, stats ):
+        """Whether target's sources have the contents they had when it was
+        last recorded.
+        """
+        recorded = self.built.get(os.path.abspath(target))
+        if recorded is None:
+            return False
+        return recorded == self.sources_digests(sources, stats)
+
+    def save( self ):
+        """Writes the store to its file, if it has one and has changed"""
+        if self.filename is None or not self.dirty:
+            return
+        temp = self.filename + '.tmp'
+        with open(temp, 'wb') as f:
+            pickle.dump((self.digests, self.built), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp, self.filename)
+        self.dirty = False
+
+def is_current( target, sources, stats, hashes=None ):
+    """Whether target exists and is up to date with respect to sources.
+
+    That is the case when it is newer than all of them, or, given a
+    HashStore, when their contents have not changed since it was recorded.
+    A missing source means it is not current.
+    """
+    target_mtime = stats.mtime(target)
+    if target_mtime is None:
+        return False
+    newer = False
+    for source in sources:
+        source_mtime = stats.mtime(source)
+        if source_mtime is None:
+            return False
+        if source_mtime > target_mtime:
+            newer = True
+    if hashes is None:
+        return not newer
+    if newer:
+        return hashes.unchanged(target, sources, stats)
+    if os.path.abspath(target) not in hashes.built:
+        # Up to date by timestamp: remember the sources, so that touching
+        # them later will not cause a rebuild.
+        hashes.record(target, sources, stats)
+    return True
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
+
+# vim: et sts=4 sw=4
@@ -6,7 +6,15 @@ engine work.
 """
 
 from itertools import count, izip
+from heapq import merge
 from copy import copy
+from Queue import Empty
+import cPickle as pickle
+import multiprocessing
+import weakref
+
+from testunify import MatchMatrix, parse_match_string, is_var
+from testdecorator import FilePattern, PatternSet
 
 # This is used to do things like standardizing apart variable names.  Every
 # variable must have a unique name, but it also has a "preferred" name assigned
@@ -18,10 +26,73 @@ def name_generator(prefix):
 
 global_varname_factory = name_generator('v')
 
+def var_id( name ):
+    """Returns the id that bindings of the variable with this name are keyed
+    on: the name itself, interned, so that comparing two ids is usually just
+    an identity check.  Interned strings go away with their last reference,
+    so the names of renamed variables do not pile up in a long-running
+    process.
+
+    >>> var_id('X' + str(1)) is var_id('X1')
+    True
+    """
+    if type(name) is str:
+        return intern(name)
+    return name
+
+class _Missing(object):
+    # Pickles as a reference to the one instance below.
+    def __reduce__( self ):
+        return '_missing'
+
+# Marks a trail entry for a key that was not present before.
+_missing = _Missing()
+
 class Predicate(object):
-    def __init__( self, name, args=() ):
+    """An immutable term: an interned functor name and a tuple of arguments.
+
+    Ground predicates (those without variables) are hash-consed, so building
+    the same ground term twice gives back the same object and ground terms
+    can be compared by identity:
+
+    >>> a = Predicate('file', [Predicate('myfile'), Predicate('.c')])
+    >>> a is Predicate('file', [Predicate('myfile'), Predicate('.c')])
+    True
+    >>> a.ground, Predicate('file', [Var('X'), Predicate('.c')]).ground
+    (True, False)
+    """
+    __slots__ = ('name', 'args', 'ground', '__weakref__')
+
+    # (class, name, args) -> predicate, for ground predicates only.  Ground
+    # arguments are themselves interned, so hashing the args tuple by
+    # identity is the same as hashing it by structure.
+    interned = weakref.WeakValueDictionary()
+
+    def __new__( cls, name, args=() ):
+        name = intern(name)
+        args = tuple(args)
+        ground = True
+        for a in args:
+            if not a.ground:
+                ground = False
+                break
+
+        if ground:
+            key = (cls, name, args)
+            self = cls.interned.get(key)
+            if self is not None:
+                return self
+
+        self = object.__new__(cls)
         self.name = name
-        self.args = [x.copy() for x in args]
+        self.args = args
+        self.ground = ground
+        if ground:
+            cls.interned[key] = self
+        return self
+
+    def __reduce__( self ):
+        return (self.__class__, (self.name, self.args))
 
     def __str__( self ):
         if len(self.args) > 0:
@@ -33,38 +104,66 @@ class Predicate(object):
     __repr__ = __str__
 
     def copy( self ):
-        return self.__class__( self.name, self.args )
+        # Terms are immutable, so there is nothing to copy.
+        return self
 
     def standardize_vars( self, factory, mapping ):
-        for i, a in enumerate(self.args):
+        """Returns this predicate with every variable renamed to a new one.
+
+        The renaming is recorded in (and reused from) mapping.
+        """
+        if self.ground:
+            return self
+        args = []
+        for a in self.args:
             if mapping.is_var(a):
                 if a not in mapping:
                     mapping.add(a, Var(factory.next()))
-                self.args[i] = mapping[a]
+                args.append(mapping[a])
             else:
-                a.standardize_vars(factory, mapping)
+                args.append(a.standardize_vars(factory, mapping))
+        return self.__class__(self.name, args)
 
     def var_within( self, var, mapping ):
-        """Returns True if the variable is somewhere in this predicate"""
+        """Returns True if the variable is somewhere in this predicate.
+
+        Ground subterms cannot contain it, so they are skipped without being
+        walked.  Variables are followed through the mapping.
+
+        >>> X, Y = Var('X'), Var('Y')
+        >>> m = VarMap()
+        >>> m.add(Y, Predicate('g', [X]))
+        >>> Predicate('f', [Predicate('a'), Y]).var_within(X, m)
+        True
+        >>> Predicate('f', [Predicate('a'), Y]).var_within(Var('Z'), m)
+        False
+        """
+        if self.ground:
+            return False
         var = mapping[var]
 
         for a in self.args:
             if mapping.is_var(a):
                 a = mapping[a]
-                if a.name == var.name:
-                    return True
-            else:
-                if a.var_within(var, mapping):
-                    return True
+                if mapping.is_var(a):
+                    if a.id == var.id:
+                        return True
+                    continue
+            if a.var_within(var, mapping):
+                return True
         return False
 
     def unify( self, other, mapping ):
         """Attempts to do unification with the given predicate and given
         variable mapping.  Returns a boolean success value.
 
-        The mapping will be changed when it comes back, so it should be copied
-        before being passed in if rewindability is needed.
+        On success the new bindings are left in the mapping; callers that need
+        to rewind take a mapping.mark() first and undo to it.  On failure any
+        partial bindings have already been undone.
         """
+        if self is other:
+            return True
+
         if mapping.is_var(other):
             other = mapping[other]
 
@@ -73,6 +172,14 @@ class Predicate(object):
         if mapping.is_var(other):
             return other.unify(self, mapping)
 
+        # Ground terms are interned, so two different ground terms can never
+        # unify.
+        if self.ground and other.ground:
+            return self is other
+
+        if isinstance(other, Pattern):
+            return other.unify(self, mapping)
+
         # Other must be a predicate, so do the predicate matching logic: match
         # names and unify args.
         if self.name != other.name or len(self.args) != len(other.args):
@@ -81,27 +188,40 @@ class Predicate(object):
         # Now attempt to do unification on each of the arguments.  This is
         # recursively defined.  Variables know how to do unification, for
         # example.
+        mark = mapping.mark()
         for thisarg, otherarg in izip(self.args, other.args):
             if not thisarg.unify(otherarg, mapping):
+                mapping.undo(mark)
                 return False
         return True
 
     def substitute( self, mapping ):
-        """Returns a copy of this predicate with all variables resolved"""
-        pred = self.copy()
-        for i, a in enumerate(pred.args):
+        """Returns this predicate with all variables resolved"""
+        if self.ground:
+            return self
+        args = []
+        for a in self.args:
             if mapping.is_var(a):
                 a = mapping[a]
             # Vars just get inserted, predicates are recursively substituted
             if mapping.is_var(a):
-                pred.args[i] = a
+                args.append(a)
             else:
-                pred.args[i] = a.substitute(mapping)
-        return pred
+                args.append(a.substitute(mapping))
+        return self.__class__(self.name, args)
 
 class Var(object):
+    __slots__ = ('name', 'id')
+
+    # A variable is never ground.
+    ground = False
+
     def __init__( self, name ):
         self.name = name
+        self.id = var_id(name)
+
+    def __reduce__( self ):
+        return (self.__class__, (self.name,))
 
     def __str__( self ):
         return "_%s" % self.name
@@ -109,7 +229,7 @@ class Var(object):
     __repr__ = __str__
 
     def copy( self ):
-        return self.__class__( self.name )
+        return self
 
     def unify( self, other, mapping ):
         # Are we a variable when the map is queried?
@@ -127,29 +247,390 @@ class Var(object):
         # If it's still a variable, then we just add it to the mapping and move
         # on with life; nothing to see here.
         if mapping.is_var(other):
-            mapping.add(me, other)
+            mapping.bind(me, other)
             return True
 
         # Not a variable?  Must be a predicate!  We can typically just assign
         # these as well, but we first have to ensure that the variable does not
-        # appear (recursively) in any of the predicate's arguments.
-        if other.var_within(me, mapping):
+        # appear (recursively) in any of the predicate's arguments, unless the
+        # mapping has been told to skip that check.
+        if mapping.occurs_check and other.var_within(me, mapping):
             return False
         else:
-            mapping.add(me, other)
+            mapping.bind(me, other)
             return True
 
+class Pattern(Predicate):
+    """A string with variables in it, like "{base}.o", that unifies with
+    atoms and other patterns by matching the strings (see
+    testunify.MatchMatrix).  Each variable matches at least one character.
+
+    The text is parsed once, when the pattern is made.  A pattern without
+    variables is just an atom, and one that is nothing but a variable is
+    that variable:
+
+    >>> Pattern("main.o") is Predicate("main.o")
+    True
+    >>> Pattern("{x}")
+    _x
+    >>> p = Pattern("{dir}/{base}.o")
+    >>> p, p.args
+    ({dir}/{base}.o, (_dir, _base))
+
+    Like any predicate its arguments are its variables (in order, with
+    repeats), and its name is the text with each one replaced by {}.  The
+    two can be put back together with Pattern(name, args):
+
+    >>> p.name
+    '{}/{}.o'
+    >>> Pattern(p.name, [Predicate('src'), Var('b')])
+    src/{b}.o
+
+    A pattern can unify in more than one way.  unify() takes the first;
+    unifiers() yields each of them:
+
+    >>> m = VarMap()
+    >>> for _ in unifiers(Pattern("{a}-{b}"), Predicate("x-y-z"), m):
+    ...     print m[Var('a')], m[Var('b')]
+    x-y z
+    x y-z
+
+    In a rule base this gives make-style pattern rules, and the solver tries
+    every way a goal unifies with a pattern:
+
+    >>> prolog = Prolog()
+    >>> def built(text):
+    ...     return Predicate('built', [Pattern(text)])
+    >>> prolog.add_rule(Rule(built('{base}.o'), [built('{base}.c')]))
+    >>> for name in ['main.c', 'util.c']:
+    ...     prolog.add_rule(Rule(built(name)))
+    >>> q = built('{name}.o')
+    >>> [str(q.substitute(m)) for m, rules in prolog.answer_iter([q])]
+    ['built(main.o)', 'built(util.o)']
+    >>> len(list(prolog.answer_iter([built('util.o')])))
+    1
+    """
+    __slots__ = ('parts', 'tokens')
+
+    def __new__( cls, text, args=None ):
+        if args is None:
+            parts = []
+            for token in parse_match_string(text):
+                if is_var(token):
+                    parts.append(Var(token[1:-1]))
+                else:
+                    parts.append(token)
+        else:
+            parts = _template_parts(text, args)
+        return make_pattern(parts)
+
+    def __reduce__( self ):
+        return (self.__class__, (self.name, self.args))
+
+    def __str__( self ):
+        return "".join("{%s}" % p.name if isinstance(p, Var) else
+                       p.replace('{', '{{').replace('}', '}}')
+                       for p in self.parts)
+
+    __repr__ = __str__
+
+    def substitute( self, mapping ):
+        """Returns this pattern with its bound variables filled in.  A
+        variable bound to a predicate with arguments (which cannot be part of
+        a string) is left as it is.
+        """
+        parts = []
+        changed = False
+        for p in self.parts:
+            if isinstance(p, Var):
+                value = mapping[p]
+                if isinstance(value, Pattern):
+                    parts.extend(value.substitute(mapping).parts)
+                elif isinstance(value, Var):
+                    parts.append(value)
+                elif value.args:
+                    parts.append(p)
+                    continue
+                else:
+                    parts.append(value.name)
+                changed = changed or value is not p
+            else:
+                parts.append(p)
+        if not changed:
+            return self
+        return make_pattern(parts)
+
+    def unify( self, other, mapping ):
+        for _ in self.unifiers(other, mapping):
+            return True
+        return False
+
+    def unifiers( self, other, mapping ):
+        """Yields once for each way that this pattern unifies with other,
+        leaving the bindings for it in mapping.  They are undone before the
+        next one is tried and when the unifiers run out.
+        """
+        mark = mapping.mark()
+        me = self.substitute(mapping)
+        if isinstance(other, Var):
+            other = mapping[other]
+        if not isinstance(other, Var) and other.args:
+            if not isinstance(other, Pattern):
+                # Predicates with arguments are not strings.
+                return
+            other = other.substitute(mapping)
+
+        if not isinstance(me, Pattern) or isinstance(other, Var):
+            # Nothing left to match here: the general case handles it.
+            if not isinstance(me, Pattern) or not isinstance(other, Pattern):
+                if isinstance(other, Pattern):
+                    me, other = other, me
+                if not isinstance(me, Pattern):
+                    if me.unify(other, mapping):
+                        yield
+                    mapping.undo(mark)
+                    return
+                if isinstance(other, Var):
+                    if other.unify(me, mapping):
+                        yield
+                    mapping.undo(mark)
+                    return
+
+        if not isinstance(other, Pattern) and len(me.args) == 1:
+            # One variable against a string: it is whatever is between the
+            # constant prefix and suffix.
+            text = other.name
+            parts = me.parts
+            prefix = parts[0] if isinstance(parts[0], str) else ''
+            suffix = parts[-1] if isinstance(parts[-1], str) else ''
+            if (len(text) > len(prefix) + len(suffix) and
+                text.startswith(prefix) and text.endswith(suffix)):
+                value = Predicate(text[len(prefix):len(text) - len(suffix)])
+                if me.args[0].unify(value, mapping):
+                    yield
+            mapping.undo(mark)
+            return
+
+        row_tokens = me.pattern_tokens('r')
+        if isinstance(other, Pattern):
+            col_tokens = other.pattern_tokens('c')
+        else:
+            col_tokens = list(other.name)
+        for match in MatchMatrix(row_tokens, col_tokens).maps():
+            if me._bind(match, other, mapping):
+                yield
+            mapping.undo(mark)
+
+    def pattern_tokens( self, side ):
+        """Returns this pattern as MatchMatrix tokens, with each variable
+        named by side and its position in args.
+        """
+        if self.tokens is None:
+            self.tokens = {}
+        tokens = self.tokens.get(side)
+        if tokens is None:
+            tokens = self.tokens[side] = []
+            i = 0
+            for p in self.parts:
+                if isinstance(p, Var):
+                    tokens.append("{%s%d}" % (side, i))
+                    i += 1
+                else:
+                    tokens.extend(p)
+        return tokens
+
+    def _bind( self, match, other, mapping ):
+        """Binds the variables as one of MatchMatrix.maps() says"""
+        def term( token ):
+            if is_var(token):
+                args = self.args if token[1] == 'r' else other.args
+                return args[int(token[2:-1])]
+            return token
+        for entry in match:
+            var = term(entry[0])
+            value = make_pattern([term(t) for t in entry[1:]])
+            if not var.unify(value, mapping):
+                return False
+        return True
+
+def _template_parts( template, args ):
+    """Returns the parts of a pattern given as a name and arguments.  Atoms
+    and patterns among the arguments are spliced into the string.
+    """
+    parts = []
+    args = iter(args)
+    i = 0
+    while i < len(template):
+        c = template[i]
+        if c in '{}' and template[i:i + 2] in ('{{', '}}'):
+            parts.append(c)
+            i += 2
+        elif template[i:i + 2] == '{}':
+            arg = args.next()
+            if isinstance(arg, Pattern):
+                parts.extend(arg.parts)
+            elif isinstance(arg, Var):
+                parts.append(arg)
+            elif not arg.args:
+                parts.append(arg.name)
+            else:
+                raise TypeError("%s cannot be part of a pattern" % (arg,))
+            i += 2
+        else:
+            parts.append(c)
+            i += 1
+    return parts
+
+def make_pattern( parts ):
+    """Returns the term for a list of strings and variables: an atom if
+    there are no variables, the variable if there is nothing else, and a
+    Pattern otherwise.
+    """
+    merged = []
+    for p in parts:
+        if merged and isinstance(p, str) and isinstance(merged[-1], str):
+            merged[-1] += p
+        elif not isinstance(p, str) or p:
+            merged.append(p)
+    args = tuple(p for p in merged if isinstance(p, Var))
+    if not args:
+        return Predicate("".join(merged))
+    if len(merged) == 1:
+        return merged[0]
+
+    self = object.__new__(Pattern)
+    self.name = intern("".join("{}" if isinstance(p, Var) else
+                               p.replace('{', '{{').replace('}', '}}')
+                               for p in merged))
+    self.args = args
+    self.ground = False
+    self.parts = tuple(merged)
+    self.tokens = None
+    return self
+
+def contains_pattern( term ):
+    """Whether there is a Pattern anywhere in term"""
+    stack = [term]
+    while stack:
+        term = stack.pop()
+        if isinstance(term, Pattern):
+            return True
+        if not isinstance(term, Var) and not term.ground:
+            stack.extend(term.args)
+    return False
+
+def unifiers( x, y, mapping ):
+    """Yields once for each way that x and y unify, leaving the bindings for
+    it in mapping.  They are undone before the next one is tried and when
+    the unifiers run out.  Only patterns can unify in more than one way.
+    """
+    if isinstance(x, Var):
+        x = mapping[x]
+    if isinstance(y, Var):
+        y = mapping[y]
+    if isinstance(y, Pattern):
+        x, y = y, x
+    if isinstance(x, Pattern):
+        for _ in x.unifiers(y, mapping):
+            yield
+        return
+
+    mark = mapping.mark()
+    if (isinstance(x, Var) or isinstance(y, Var) or
+        (x.ground and y.ground) or not x.args or not y.args):
+        if x.unify(y, mapping):
+            yield
+        mapping.undo(mark)
+        return
+    if x.name != y.name or len(x.args) != len(y.args):
+        return
+    for _ in _unify_args(x.args, y.args, 0, mapping):
+        yield
+    mapping.undo(mark)
+
+def _unify_args( xs, ys, i, mapping ):
+    if i == len(xs):
+        yield
+        return
+    for _ in unifiers(xs[i], ys[i], mapping):
+        for _ in _unify_args(xs, ys, i + 1, mapping):
+            yield
+
 class VarMap(object):
-    """Contains variable assignment pairs"""
+    """Contains variable assignment pairs
+
+    Every binding is recorded on a trail, so instead of copying the whole map
+    to be able to rewind it, callers take a mark and undo back to it when they
+    backtrack:
+
+    >>> m = VarMap()
+    >>> m.add(Var('a'), Predicate('x'))
+    >>> mark = m.mark()
+    >>> m.add(Var('b'), Var('a'))
+    >>> m[Var('b')]
+    x
+    >>> m.undo(mark)
+    >>> Var('b') in m, Var('a') in m
+    (False, True)
+
+    Bindings form a union-find forest keyed on variable ids: unify binds
+    through bind(), which links variable-to-variable aliases by rank, and
+    deep_get compresses the chains it follows.
+    """
     def __init__( self ):
+        # var id -> (var, value)
         self.vardict = {}
+        # var id -> rank, for variables at the root of an alias class
+        self.ranks = {}
+        # (table, key, previous value) for every change, in order.
+        self.trail = []
+        # Whether binding a variable to a predicate first checks that the
+        # variable does not occur in it.
+        self.occurs_check = True
 
     def copy( self ):
+        """Returns an independent copy.  Marks taken before the copy can be
+        undone on either map without affecting the other.
+
+        >>> m = VarMap()
+        >>> mark = m.mark()
+        >>> m.bind(Var('X'), Predicate('a'))
+        >>> c = m.copy()
+        >>> c.undo(mark)
+        >>> m[Var('X')], c[Var('X')]
+        (a, _X)
+        """
         newmap = self.__class__()
         for k, (var, val) in self.vardict.iteritems():
             newmap.vardict[k] = (var.copy(), val.copy())
+        newmap.ranks = dict(self.ranks)
+        # The trail refers to the tables it changed, which must be the
+        # copy's own.
+        tables = {id(self.vardict): newmap.vardict,
+                  id(self.ranks): newmap.ranks}
+        newmap.trail = [(tables[id(table)], key, old)
+                        for table, key, old in self.trail]
+        newmap.occurs_check = self.occurs_check
         return newmap
 
+    def mark( self ):
+        """Returns a mark that undo can later rewind the bindings to"""
+        return len(self.trail)
+
+    def undo( self, mark ):
+        """Removes every binding made since mark was taken"""
+        trail = self.trail
+        while len(trail) > mark:
+            table, key, old = trail.pop()
+            if old is _missing:
+                del table[key]
+            else:
+                table[key] = old
+
+    def _set( self, table, key, value ):
+        self.trail.append((table, key, table.get(key, _missing)))
+        table[key] = value
+
     def reversed( self ):
         map = self.__class__()
         for name, (var, val) in self.vardict.iteritems():
@@ -174,14 +655,42 @@ class VarMap(object):
         """
         if not self.is_var(var):
             raise ValueError("Tried to insert non-var %s into map" % (var,))
-        if var.name in self.vardict:
+        if var.id in self.vardict:
             raise ValueError("%s is already in the mapping" % (var,))
 
-        # No flattening is done at the moment
-        self.vardict[var.name] = (var, value)
+        self._set(self.vardict, var.id, (var, value))
+
+    def bind( self, var, value ):
+        """Binds an unbound variable to a value, as unification does.
+
+        If the value is another unbound variable the two are joined by rank,
+        so either one may end up pointing at the other.
+
+        >>> m = VarMap()
+        >>> a, b, c = Var('a'), Var('b'), Var('c')
+        >>> m.bind(a, b)
+        >>> m.bind(c, a)
+        >>> m[c] is m[a] is b
+        True
+        """
+        if not self.is_var(value):
+            self.add(var, value)
+            return
+        if var.id == value.id:
+            return
+
+        ranks = self.ranks
+        var_rank = ranks.get(var.id, 0)
+        value_rank = ranks.get(value.id, 0)
+        if var_rank > value_rank:
+            self.add(value, var)
+        else:
+            self.add(var, value)
+            if var_rank == value_rank:
+                self._set(ranks, value.id, value_rank + 1)
 
     def __contains__( self, var ):
-        return var.name in self.vardict
+        return var.id in self.vardict
 
     def __getitem__( self, var ):
         return self.deep_get(var)
@@ -190,10 +699,25 @@ class VarMap(object):
         if not self.is_var(var):
             raise ValueError("Got something other than a variable")
 
-        var, val = self.vardict[var.name]
+        var, val = self.vardict[var.id]
         return val
 
     def deep_get( self, var ):
+        """Follows var through the map to its value.
+
+        Every variable passed along the way is re-pointed straight at the end
+        of the chain, so later lookups take a single step:
+
+        >>> m = VarMap()
+        >>> a, b, c = Var('a'), Var('b'), Var('c')
+        >>> m.add(a, b); m.add(b, c); m.add(c, Predicate('x'))
+        >>> m.shallow_get(a)
+        _b
+        >>> m.deep_get(a)
+        x
+        >>> m.shallow_get(a)
+        x
+        """
         if not self.is_var(var):
             raise ValueError("Got something other than a variable")
 
@@ -203,28 +727,53 @@ class VarMap(object):
         # variable.  The purpose of the mapping is to tell us what stuff is
         # assigned to.  This variable is unassigned and therefore is just
         # itself.
-        if var not in self:
+        vardict = self.vardict
+        entry = vardict.get(var.id)
+        if entry is None:
             return var
 
         # If it's in there, then obviously get it and follow the thread.
-        var, val = self.vardict[var.name]
-        while self.is_var(val) and val in self:
-            var, val = self.vardict[val.name]
+        val = entry[1]
+        if not isinstance(val, Var) or val.id not in vardict:
+            return val
+
+        path = [entry[0]]
+        while isinstance(val, Var):
+            entry = vardict.get(val.id)
+            if entry is None:
+                break
+            path.append(entry[0])
+            val = entry[1]
+
+        # The last variable on the path already points at val.
+        for v in path[:-1]:
+            self._set(vardict, v.id, (v, val))
         return val
 
+# Rule class -> whether its instances always satisfy without doing anything
+_always_satisfied = {}
+
 class Rule(object):
+    # The antecedents in the order to prove them in, if not as written (see
+    # Prolog.reorder_rules).
+    ordered = None
+
     def __init__( self,
                   consequent,
                   antecedents = (),
-                  varfactory=global_varname_factory ):
+                  varfactory=global_varname_factory,
+                  occurs_check=False ):
+        # Marks rules that can create cyclic bindings (see example.pdb).
+        # They get an occurs check under the 'flagged' policy.
+        self.occurs_check = occurs_check
 
-        self.varmap = VarMap()
-        self.consequent = consequent.copy()
-        self.consequent.standardize_vars(varfactory, self.varmap)
+        # The rule this one is an instance of (see instance()).
+        self.template = self
 
-        self.antecedents = [a.copy() for a in antecedents]
-        for a in self.antecedents:
-            a.standardize_vars(varfactory, self.varmap)
+        self.varmap = VarMap()
+        self.consequent = consequent.standardize_vars(varfactory, self.varmap)
+        self.antecedents = [a.standardize_vars(varfactory, self.varmap)
+                            for a in antecedents]
 
     def __str__( self ):
         if len(self.antecedents) > 0:
@@ -236,7 +785,31 @@ class Rule(object):
     __repr__ = __str__
 
     def copy( self ):
-        return self.__class__(self.consequent, self.antecedents)
+        return self.__class__(self.consequent, self.antecedents,
+                              occurs_check=self.occurs_check)
+
+    def instance( self, mapping ):
+        """Returns a rule of the same type with the variables bound in mapping
+        filled in.  Once a proof is complete its rule instances are ground,
+        so their tests and commands know exactly what they apply to.
+        """
+        rule = self.__class__(self.consequent.substitute(mapping),
+                              [a.substitute(mapping) for a in self.antecedents],
+                              occurs_check=self.occurs_check)
+        rule.template = self.template
+        return rule
+
+    def always_satisfied( self ):
+        """True if try_to_satisfy is known to succeed without doing anything,
+        which is the case when the class keeps the default test.
+        """
+        cls = self.__class__
+        try:
+            return _always_satisfied[cls]
+        except KeyError:
+            result = (cls.try_to_satisfy.im_func is Rule.try_to_satisfy.im_func
+                      and cls.pre_test.im_func is Rule.pre_test.im_func)
+            return _always_satisfied.setdefault(cls, result)
 
     def try_to_satisfy( self ):
         if not self.pre_test():
@@ -270,64 +843,1212 @@ class Rule(object):
         """
         pass
 
-class Prolog(object):
+    def command_lines( self ):
+        """Returns a description of each command that commands() would run,
+        as a list of strings.  Used for dry runs, so it must not have side
+        effects.
+        """
+        return []
+
+def functor( term ):
+    """Returns the (name, arity) key of a predicate, or None for a variable"""
+    if isinstance(term, Var):
+        return None
+    return (term.name, len(term.args))
+
+def term_at( term, position, mapping=None ):
+    """Follows the argument indices in position down into term.
+
+    Variables met along the way are looked up in mapping (if given).  Returns
+    None if the path runs into an unbound variable or off the end of a
+    predicate's arguments, or into a Pattern.
+
+    >>> t = Predicate('p', [Predicate('file', [Var('X'), Predicate('.o')])])
+    >>> term_at(t, (0, 1))
+    .o
+    >>> term_at(t, (0, 0)) is None
+    True
+    """
+    for i in position:
+        if mapping is not None and isinstance(term, Var):
+            term = mapping[term]
+        if isinstance(term, (Var, Pattern)) or i >= len(term.args):
+            return None
+        term = term.args[i]
+    if mapping is not None and isinstance(term, Var):
+        term = mapping[term]
+    if mapping is not None and isinstance(term, Pattern):
+        # Its variables may be bound by now, leaving just an atom.
+        term = term.substitute(mapping)
+    if isinstance(term, (Var, Pattern)):
+        # Either one can match many functors.
+        return None
+    return term
+
+class ClauseIndex(object):
+    """Rules keyed on consequent name/arity and on argument functors.
+
+    Each entry in positions is a path of argument indices into the
+    consequent: (0,) is the first argument, (0, 1) is the second argument of
+    the first argument, and so on.  For every position the rules are bucketed
+    by the functor found there, with rules that have a variable there kept
+    aside because they can match anything.
+
+    Rules with a Pattern there go in a PatternSet, bucketed by its constant
+    prefix and suffix, so that an atom only brings up the patterns that
+    could match it.
+
+    A lookup picks the most selective position that the query has bound and
+    returns the candidates from that bucket, in the order they were added:
+
+    >>> index = ClauseIndex(positions=((0,), (0, 1)))
+    >>> def f(name, ext):
+    ...     return Predicate('file', [name, Predicate(ext)])
+    >>> for rule in [Rule(Predicate('exists', [f(Predicate('a'), '.c')])),
+    ...              Rule(Predicate('exists', [f(Predicate('a'), '.o')])),
+    ...              Rule(Predicate('exists', [Var('Any')]))]:
+    ...     index.add(rule)
+    >>> list(index.candidates(Predicate('exists', [f(Var('X'), '.o')])))
+    ... # doctest: +ELLIPSIS
+    [exists(file(a, .o))::{}, exists(_v...)::{_Any->_v...}]
+    >>> len(list(index.candidates(Predicate('exists', [Var('X')]))))
+    3
+    >>> list(index.candidates(Predicate('nothing')))
+    []
+    >>> for ext in ['.c', '.o', '.y']:
+    ...     index.add(Rule(Predicate('built', [Pattern('{base}' + ext)])))
+    >>> list(index.candidates(Predicate('built', [Predicate('main.o')])))
+    ... # doctest: +ELLIPSIS
+    [built({v...}.o)::{_base->_v...}]
+    """
+    def __init__( self, positions=((0,),) ):
+        self.positions = tuple(tuple(p) for p in positions)
+        # (name, arity) -> [all clauses, {position: {functor: clauses}},
+        #                   {position: clauses with a variable there},
+        #                   {position: PatternSet of clauses with a Pattern
+        #                              there}]
+        # where each clause list holds (sequence number, rule) pairs, and so
+        # do the values in the PatternSets.
+        self.tables = {}
+        self.num_rules = 0
+
+    def __len__( self ):
+        return self.num_rules
+
+    def add( self, rule ):
+        key = functor(rule.consequent)
+        if key not in self.tables:
+            self.tables[key] = [[],
+                                dict((p, {}) for p in self.positions),
+                                dict((p, []) for p in self.positions),
+                                {}]
+        clauses, keyed, unkeyed, patterns = self.tables[key]
+
+        entry = (self.num_rules, rule)
+        self.num_rules += 1
+        clauses.append(entry)
+        for position in self.positions:
+            term = rule.consequent
+            for i in position:
+                if isinstance(term, (Var, Pattern)) or i >= len(term.args):
+                    term = None
+                    break
+                term = term.args[i]
+            if isinstance(term, Pattern):
+                if position not in patterns:
+                    patterns[position] = PatternSet()
+                patterns[position].add(FilePattern(str(term)), entry)
+            elif term is None or isinstance(term, Var):
+                unkeyed[position].append(entry)
+            else:
+                keyed[position].setdefault(functor(term), []).append(entry)
+
+    def candidates( self, query, mapping=None ):
+        """Returns an iterator over the rules that might unify with query"""
+        table = self.tables.get(functor(query))
+        if table is None:
+            return iter(())
+        clauses, keyed, unkeyed, patterns = table
+
+        best = clauses
+        best_len = len(clauses)
+        best_rest = best_matched = None
+        for position in self.positions:
+            term = term_at(query, position, mapping)
+            if term is None:
+                continue
+            bucket = keyed[position].get(functor(term), ())
+            rest = unkeyed[position]
+            matched = ()
+            if not term.args and position in patterns:
+                # Predicates with arguments are not strings, so only an
+                # atom can match a pattern.
+                matched = [value for order, pattern, value in
+                           patterns[position].candidates(term.name)]
+            size = len(bucket) + len(rest) + len(matched)
+            if size < best_len:
+                best, best_rest, best_matched = bucket, rest, matched
+                best_len = size
+
+        if best_rest or best_matched:
+            # The lists are all in rule order, so a merge keeps that order.
+            entries = merge(best, best_rest or (), best_matched or ())
+        else:
+            entries = best
+        return (rule for _, rule in entries)
+
+    def estimate( self, goal, bound=() ):
+        """Estimates how many candidates a lookup of goal will return once
+        the variables whose ids are in bound have values (but without
+        knowing what they are).  A bound variable at an indexed position is
+        taken to select an average sized bucket.
+
+        >>> index = ClauseIndex()
+        >>> for i in range(6):
+        ...     index.add(Rule(Predicate('dep', [Predicate('n%d' % (i % 3)),
+        ...                                      Predicate('m%d' % i)])))
+        >>> X = Var('X')
+        >>> (index.estimate(Predicate('dep', [X, X])),
+        ...  index.estimate(Predicate('dep', [X, X]), [X.id]),
+        ...  index.estimate(Predicate('dep', [Predicate('n0'), X])),
+        ...  index.estimate(Predicate('nothing')))
+        (6, 2, 2, 0)
+        """
+        table = self.tables.get(functor(goal))
+        if table is None:
+            return 0
+        clauses, keyed, unkeyed, patterns = table
+        best = len(clauses)
+        for position in self.positions:
+            term = goal
+            for i in position:
+                if isinstance(term, (Var, Pattern)) or i >= len(term.args):
+                    break
+                term = term.args[i]
+            if isinstance(term, Pattern):
+                continue
+            rest = len(unkeyed[position])
+            if position in patterns:
+                if isinstance(term, Var):
+                    rest += len(patterns[position])
+                elif not term.args:
+                    rest += len(patterns[position].candidates(term.name))
+            if not isinstance(term, Var):
+                count = len(keyed[position].get(functor(term), ())) + rest
+            elif term.id in bound:
+                buckets = keyed[position]
+                keyed_count = len(clauses) - rest
+                count = keyed_count // max(1, len(buckets)) + rest
+            else:
+                continue
+            best = min(best, count)
+        return best
+
+def variant_key( term, mapping=None, numbering=None ):
+    """Returns a hashable key that is equal for terms that are variants.
+
+    Two terms are variants if they are the same up to a consistent renaming
+    of their variables.
+
+    >>> X, Y = Var('X'), Var('Y')
+    >>> variant_key(Predicate('p', [X, Y, X]))
+    ('p', 0, 1, 0)
+    >>> (variant_key(Predicate('p', [X, Y])) ==
+    ...  variant_key(Predicate('p', [Y, X])))
+    True
+    """
+    if numbering is None:
+        numbering = {}
+    if mapping is not None and isinstance(term, Var):
+        term = mapping[term]
+    if isinstance(term, Var):
+        return numbering.setdefault(term.name, len(numbering))
+    return (term.name,) + tuple(variant_key(a, mapping, numbering)
+                                for a in term.args)
+
+def variables( terms ):
+    """Returns the distinct variables in terms, in order of appearance
+
+    >>> variables([Predicate('p', [Var('X'), Predicate('q', [Var('Y')])]),
+    ...            Var('X')])
+    [_X, _Y]
+    """
+    found = []
+    seen = set()
+    stack = list(reversed(terms))
+    while stack:
+        term = stack.pop()
+        if isinstance(term, Var):
+            if term.id not in seen:
+                seen.add(term.id)
+                found.append(term)
+        elif not term.ground:
+            stack.extend(reversed(term.args))
+    return found
+
+def order_goals( goals, index, bound=(), effectful=() ):
+    """Returns goals in the order that should make the fewest choicepoints:
+    each time, the one with the fewest candidates in index (see
+    ClauseIndex.estimate) given the variables bound so far, whose ids are
+    in bound to begin with.  Ties keep their original order.
+
+    Goals with a functor in effectful may run tests and commands, which
+    must see the same bindings, and only run when the same goals before them
+    have been proven, as in the original order.  So they stay where they
+    are, and the other goals are only reordered among the ones between the
+    same two of them.
+
+    >>> index = ClauseIndex()
+    >>> def p(name, *args):
+    ...     return Predicate(name, [Predicate(a) if a.islower() else Var(a)
+    ...                             for a in args])
+    >>> for i in range(100):
+    ...     index.add(Rule(p('node', 'n%d' % (i % 10))))
+    >>> index.add(Rule(p('yacc', 'n7')))
+    >>> goals = [p('node', 'B'), p('yacc', 'B'), p('built', 'B'),
+    ...          p('node', 'C')]
+    >>> order_goals(goals, index)
+    [built(_B), yacc(_B), node(_B), node(_C)]
+    >>> order_goals(goals, index, effectful=[('built', 1)])
+    [yacc(_B), node(_B), built(_B), node(_C)]
+    """
+    bound = set(bound)
+    ordered = []
+    segment = []
+    for goal in list(goals) + [None]:
+        if goal is not None and functor(goal) not in effectful:
+            segment.append(goal)
+            continue
+        while segment:
+            best = best_cost = None
+            for position, candidate in enumerate(segment):
+                cost = index.estimate(candidate, bound)
+                if best is None or cost < best_cost:
+                    best, best_cost = position, cost
+            chosen = segment.pop(best)
+            ordered.append(chosen)
+            bound.update(var.id for var in variables([chosen]))
+        if goal is not None:
+            ordered.append(goal)
+            bound.update(var.id for var in variables([goal]))
+    return ordered
+
+def renamed( term, factory=global_varname_factory ):
+    """Returns a copy of term with all of its variables replaced by new ones"""
+    return term.standardize_vars(factory, VarMap())
+
+class Proof(object):
+    """How a list of goals was proven.
+
+    rule proved the first goal, ants is the proof of that rule's antecedents
+    and rest the proof of the remaining goals.  Either may be None for an
+    empty list.  Nodes are shared between answers, so they must not be
+    changed once built.
+    """
+    __slots__ = ('rule', 'rest', 'ants')
+
+    def __init__( self, rule, rest, ants ):
+        self.rule = rule
+        self.rest = rest
+        self.ants = ants
+
+    def resolve( self ):
+        return self
+
+    def antecedents( self ):
+        """Returns the proofs of this rule's antecedents, in order"""
+        result = []
+        proof = self.ants
+        while proof is not None:
+            result.append(proof)
+            proof = proof.rest
+        return result
+
+    def instance( self, mapping ):
+        """Returns a copy of this proof with every rule replaced by its
+        instance under mapping.
+        """
+        proofs = list(postorder(self))
+        copies = dict((id(p), Proof(p.rule.instance(mapping), None, None))
+                      for p in proofs)
+        for p in proofs:
+            copy = copies[id(p)]
+            copy.rest = copies.get(id(p.rest))
+            copy.ants = copies.get(id(p.ants))
+        return copies[id(self)]
+
+    def rules( self ):
+        """Returns the rules used, each one followed by the rules for the
+        rest of its goal list and then by those for its antecedents.
+        """
+        result = []
+        stack = [self]
+        while stack:
+            proof = stack.pop()
+            if proof is not None:
+                result.append(proof.rule)
+                stack.append(proof.ants)
+                stack.append(proof.rest)
+        return result
+
+def postorder( proof ):
+    """Yields each Proof node reachable from proof once: first the nodes for
+    its antecedents, then the node itself, then those for the rest of its
+    goal list.
+    """
+    seen = set()
+    stack = [(proof, False)]
+    while stack:
+        proof, expanded = stack.pop()
+        if expanded:
+            yield proof
+        elif proof is not None and id(proof) not in seen:
+            seen.add(id(proof))
+            stack.append((proof.rest, False))
+            stack.append((proof, True))
+            stack.append((proof.ants, False))
+
+class PendingProof(object):
+    """A proof whose outer levels are still held in continuation frames.
+
+    The solver hands these out when nothing is left to prove or test on the
+    way back to the caller, so that an answer costs the same at any depth.
+    The levels are only put together when the proof is looked at.
+    """
+    __slots__ = ('proof', 'cont')
+
+    def __init__( self, proof, cont ):
+        self.proof = proof
+        self.cont = cont
+
+    def resolve( self ):
+        """Returns the finished Proof"""
+        proof = self.proof
+        cont = self.cont
+        while cont is not None:
+            if cont[0] == AFTER_ANTECEDENTS:
+                # The rule's antecedents were the last goals of its list.
+                _, rule, goals, index, cont, quiet = cont
+                proof = Proof(rule, None, proof)
+            else:
+                _, rule, ants, check, cont, quiet = cont
+                proof = Proof(rule, proof, ants)
+        return proof
+
+    def rules( self ):
+        return self.resolve().rules()
+
+class AnswerTable(object):
+    """The answers found so far for one variant-normalized subgoal"""
     def __init__( self ):
+        # (answer term, rule, antecedent proof) in the order they were found
+        self.answers = []
+        self.keys = set()
+        self.complete = False
+        # Set when answers were handed out before the table was complete
+        self.consumed_early = False
+        # While the subgoal is being evaluated, its position on the table
+        # stack.  Otherwise, for a table left incomplete, the position of
+        # the subgoal further up that it depends on (the leader of its
+        # strongly connected component), and the number of answers added
+        # to all tables when it was last evaluated.
+        self.position = None
+        self.lowlink = None
+        self.changes = None
+
+    def add( self, answer, proof, mapping ):
+        """Adds an answer unless a variant of it is already here.  The rules
+        in its proof are stored as instances under mapping, since the
+        bindings they were proven with are not kept anywhere else.
+        """
+        key = variant_key(answer)
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        proof = proof.resolve().instance(mapping)
+        self.answers.append((answer, proof.rule, proof.ants))
+        return True
+
+# Kinds of continuation frame used by Prolog.solve.  A frame is a tuple
+#   (AFTER_ANTECEDENTS, rule, goals, index, next, quiet): the rule's
+#       antecedents are being proven; goals[index:] come next.
+#   (AFTER_REST, rule, ants proof, check, next, quiet): the goals after the
+#       rule's consequent are being proven; then the rule is tested (if
+#       check is set) and the combined proof goes to next.
+# A next of None means the answer goes back to the caller.  quiet is set
+# when neither this frame nor any after it has goals left or a test to run.
+AFTER_ANTECEDENTS = 0
+AFTER_REST = 1
+
+def after_antecedents( rule, goals, index, next, check ):
+    quiet = (index >= len(goals) and
+             (not check or rule.always_satisfied()) and
+             (next is None or next[5]))
+    return (AFTER_ANTECEDENTS, rule, goals, index, next, quiet)
+
+def after_rest( rule, ants, check, next ):
+    quiet = ((not check or rule.always_satisfied()) and
+             (next is None or next[5]))
+    return (AFTER_REST, rule, ants, check, next, quiet)
+
+class Prolog(object):
+    """A rule base that can answer queries.
+
+    With tabling turned on, the answers to every subgoal are stored the first
+    time it is solved and replayed whenever a variant of it comes up again.
+    This also lets left-recursive rules terminate:
+
+    >>> prolog = Prolog(tabling=True)
+    >>> def p(name, *args):
+    ...     return Predicate(name, [Predicate(a) if a.islower() else Var(a)
+    ...                             for a in args])
+    >>> prolog.add_rule(Rule(p('path', 'X', 'Y'),
+    ...                      [p('path', 'X', 'Z'), p('edge', 'Z', 'Y')]))
+    >>> prolog.add_rule(Rule(p('path', 'X', 'Y'), [p('edge', 'X', 'Y')]))
+    >>> for a, b in [('a', 'b'), ('b', 'c'), ('c', 'a')]:
+    ...     prolog.add_rule(Rule(p('edge', a, b)))
+    >>> q = p('path', 'a', 'W')
+    >>> sorted(str(q.substitute(m)) for m, rules in prolog.answer_iter([q]))
+    ['path(a, a)', 'path(a, b)', 'path(a, c)']
+    >>> stats = prolog.table_stats()
+    >>> stats['hits'] > 0, stats['misses'] > 0
+    (True, True)
+
+    The solver keeps its own stack, so proofs can be as deep as memory
+    allows, but each tabled subgoal is evaluated in a nested call that takes
+    two Python stack frames.  With tabling on, a chain of more than about
+    sys.getrecursionlimit() / 2 subgoals, each waiting on the next, raises
+    RuntimeError.  Raise the recursion limit for deeper rule bases, or leave
+    tabling off.
+
+    The occurs check done when a variable is bound to a predicate can be
+    applied 'always' (the default), 'never', or only for rules 'flagged' with
+    occurs_check=True.  Without it a query like the ones in example.pdb
+    produces a cyclic binding instead of failing.
+
+    With reorder set, the antecedents of a rule are proven in the order given
+    by order_goals for the variables its head unification bound, rather than
+    as written.  Goals for rules with tests or commands stay where they are,
+    and so do goals whose rules depend on such rules through their
+    antecedents.
+    reorder_rules() does the same once, up front, for every rule.  Either
+    way rule.antecedents is left as written, since tests and commands (and
+    the build state) use it.
+
+    >>> prolog = Prolog(reorder=True)
+    >>> prolog.add_rule(Rule(p('src', 'X'), [p('file', 'X'), p('yacc', 'X')]))
+    >>> for i in range(20):
+    ...     prolog.add_rule(Rule(p('file', 'f%d' % i)))
+    >>> prolog.add_rule(Rule(p('yacc', 'f7')))
+    >>> q = p('src', 'W')
+    >>> [str(q.substitute(m)) for m, rules in prolog.answer_iter([q])]
+    ['src(f7)']
+    >>> [[goal.name for goal in goals]
+    ...  for goals in prolog.orderings.values()[0][1].values()]
+    [['yacc', 'file']]
+    >>> prolog.reorder_rules()
+    >>> rule = prolog.rules[0]
+    >>> ([goal.name for goal in rule.antecedents],
+    ...  [goal.name for goal in rule.ordered])
+    (['file', 'yacc'], ['yacc', 'file'])
+
+    Here made(X) runs a test only through built(X), but it must not move
+    either, or the test would run for fewer nodes than as written:
+
+    >>> tests = []
+    >>> class Built(Rule):
+    ...     def pre_test( self ):
+    ...         tests.append(self)
+    ...         return True
+    >>> for reorder in [False, True]:
+    ...     prolog = Prolog(reorder=reorder)
+    ...     prolog.add_rule(Rule(p('src', 'X'), [p('node', 'X'),
+    ...                                          p('made', 'X'),
+    ...                                          p('yacc', 'X')]))
+    ...     prolog.add_rule(Rule(p('made', 'X'), [p('built', 'X')]))
+    ...     prolog.add_rule(Built(p('built', 'X')))
+    ...     for i in range(5):
+    ...         prolog.add_rule(Rule(p('node', 'n%d' % i)))
+    ...     prolog.add_rule(Rule(p('yacc', 'n3')))
+    ...     del tests[:]
+    ...     answers = list(prolog.answer_iter([p('src', 'W')]))
+    ...     print reorder, len(answers), len(tests)
+    False 1 5
+    True 1 5
+    """
+    occurs_check_policies = ('always', 'never', 'flagged')
+
+    def __init__( self, index_positions=((0,),), tabling=False,
+                  occurs_check='always', reorder=False ):
+        if occurs_check not in self.occurs_check_policies:
+            raise ValueError("Unknown occurs check policy %r" % (occurs_check,))
+        self.occurs_check = occurs_check
+
         # Contains all of the rules
         self.rules = []
 
-        # Keyed on the name of the consequent predicate, to make searching
-        # faster.
-        self.rules_dict = {}
+        # Keyed on the name/arity of the consequent predicate and the functors
+        # of its arguments, to make searching faster.
+        self.index = ClauseIndex(index_positions)
+
+        self.tabling = tabling
+        self.clear_tables()
+
+        # Set once a rule contains a Pattern.  Until then every unification
+        # has at most one result, and the solver takes the faster route.
+        self.patterns = False
+
+        self.reorder = reorder
+        # Functors with a rule that is not always_satisfied, or with a rule
+        # that has a goal for one of those among its antecedents (and so on),
+        # whose goals order_goals must leave in place.
+        self.effectful = set()
+        # Antecedent functor -> the consequent functors of the rules it is
+        # an antecedent of
+        self.callers = {}
+        # id(rule) -> (the variables of its consequent,
+        #              {which of them are bound: its antecedents in order})
+        self.orderings = {}
+
+        # An instrument.Profiler to report what the solver does to, if any.
+        self.profiler = None
+
+    def __getstate__( self ):
+        # A profiler is particular to this process.
+        state = self.__dict__.copy()
+        state['profiler'] = None
+        # Keyed on ids, which do not survive pickling.
+        state['orderings'] = {}
+        return state
 
     def add_rule( self, rule ):
         self.rules.append(rule)
-        if rule.consequent.name not in self.rules_dict:
-            self.rules_dict[rule.consequent.name] = []
-        self.rules_dict[rule.consequent.name].append(rule)
+        self.index.add(rule)
+        if not self.patterns:
+            self.patterns = any(contains_pattern(t) for t in
+                                [rule.consequent] + list(rule.antecedents))
+        consequent = functor(rule.consequent)
+        for goal in rule.antecedents:
+            self.callers.setdefault(functor(goal), set()).add(consequent)
+        if (not rule.always_satisfied() or
+                any(functor(goal) in self.effectful
+                    for goal in rule.antecedents)):
+            self.add_effectful(consequent)
+        # The estimates the orderings were made from have changed.
+        self.orderings = {}
+        # New rules can produce new answers.
+        self.clear_tables()
+
+    def add_effectful( self, key ):
+        """Adds a functor to effectful, along with every functor whose rules
+        reach it through their antecedents.
+        """
+        stack = [key]
+        while stack:
+            key = stack.pop()
+            if key not in self.effectful:
+                self.effectful.add(key)
+                stack.extend(self.callers.get(key, ()))
+
+    def reorder_rules( self, heads_bound=False ):
+        """Sets the ordered attribute of every rule to the order to prove its
+        antecedents in, for when reorder is not set.  The order assumes that
+        the variables of the consequent are still unbound when the rule is
+        used, which guards against the most costly uses, or with heads_bound
+        set, that the queries bind them all.
+        """
+        for rule in self.rules:
+            if len(rule.antecedents) > 1:
+                bound = []
+                if heads_bound:
+                    bound = [v.id for v in variables([rule.consequent])]
+                rule.ordered = order_goals(rule.antecedents, self.index,
+                                           bound, self.effectful)
+
+    def ordered_antecedents( self, rule, varmap ):
+        """Returns the antecedents of rule in the order to prove them in,
+        now that its consequent has been unified in varmap.
+        """
+        entry = self.orderings.get(id(rule))
+        if entry is None:
+            entry = self.orderings[id(rule)] = (variables([rule.consequent]),
+                                                {})
+        head, orders = entry
+        bound = tuple(not isinstance(varmap[v], Var) for v in head)
+        goals = orders.get(bound)
+        if goals is None:
+            goals = orders[bound] = order_goals(
+                rule.antecedents, self.index,
+                [v.id for v, b in zip(head, bound) if b], self.effectful)
+        return goals
+
+    def clear_tables( self ):
+        """Forgets all tabled answers and resets the hit/miss counts"""
+        # variant key -> AnswerTable
+        self.tables = {}
+        # Keys of the subgoals currently being evaluated, outermost first,
+        # and the lowest stack position each of them has consumed answers
+        # from while that position was still incomplete.
+        self.table_stack = []
+        self.table_lowlinks = []
+        # Keys of the incomplete tables whose evaluation has finished, to be
+        # marked complete along with the leader they depend on.
+        self.table_pending = []
+        # Number of answers added to any table
+        self.table_changes = 0
+        self.table_hits = 0
+        self.table_misses = 0
+
+    def table_stats( self ):
+        """Returns a dict of tabling counters"""
+        return {
+            'hits': self.table_hits,
+            'misses': self.table_misses,
+            'tables': len(self.tables),
+            'answers': sum(len(t.answers) for t in self.tables.itervalues()),
+        }
 
     def answer_iter( self, queries, varmap=None ):
-        """Finds matches for an entire list of queries by finding answers for
-        the first one and for each answer, passing the *rest* of the list into
-        this function.  When the list is empty, simply return the varmap
-        because an empty list is vacuously true.
-        """
+        """Finds matches for an entire list of queries.  Yields a varmap and
+        the list of rules used for each way the whole list can be made true.
 
+        The same varmap is extended and then undone as the search backtracks,
+        so each yielded map is only valid until the iterator is advanced.
+        Copy it if it needs to be kept.
+        """
         if varmap is None:
             varmap = VarMap()
-
+        for answermap, proof in self.solve(queries, varmap):
+            if proof is None:
+                yield answermap, []
+            else:
+                yield answermap, proof.rules()
+
+    def parallel_answer_iter( self, queries, processes=None,
+                              chunk_size=64, chunks_ahead=4 ):
+        """Like answer_iter, but the rules matching the first query are tried
+        in parallel, one task per rule, on worker processes.
+
+        Every call pickles the whole rule base and starts new processes that
+        each load their own copy, so rule tests and commands run in the
+        workers, and tables filled in there are not seen by this object.
+        That costs more than a cheap search saves: it only pays off when
+        the rule tests and commands are what take the time.
+
+        Answers come back in the same order as answer_iter gives them, as
+        they are found.  Each one is a new VarMap binding the variables of
+        the queries, with the list of rules used.  A worker sends its
+        answers in chunks of chunk_size and goes on searching (into its
+        next branch, when one is done) until chunks_ahead of its chunks are
+        waiting to be read.  So a branch with very many (or infinitely many)
+        answers is explored not much further than it is read, while later
+        branches make progress on the other workers.
+
+        If a worker process dies, RuntimeError is raised.
+
+        >>> prolog = Prolog()
+        >>> for ext in ['.c', '.y', '.cc']:
+        ...     prolog.add_rule(Rule(Predicate('exists', [
+        ...         Predicate('file', [Predicate('main'), Predicate(ext)])])))
+        >>> prolog.add_rule(Rule(Predicate('src', [Var('B'), Var('E')]),
+        ...     [Predicate('exists', [Predicate('file', [Var('B'), Var('E')])])]))
+        >>> prolog.add_rule(Rule(Predicate('src', [Var('B'), Predicate('.h')])))
+        >>> q = Predicate('src', [Var('Base'), Var('Ext')])
+        >>> serial = [rules for m, rules in prolog.answer_iter([q])]
+        >>> parallel = []
+        >>> for m, rules in prolog.parallel_answer_iter([q], processes=2,
+        ...                                             chunk_size=2):
+        ...     print q.substitute(m)
+        ...     parallel.append(rules)
+        ... # doctest: +ELLIPSIS
+        src(main, .c)
+        src(main, .y)
+        src(main, .cc)
+        src(_v..., .h)
+        >>> serial == parallel
+        True
+
+        Reading only the first few answers stops the workers early:
+
+        >>> from itertools import islice
+        >>> prolog = Prolog()
+        >>> for i in range(10000):
+        ...     prolog.add_rule(Rule(Predicate('num', [Predicate(str(i))])))
+        >>> prolog.add_rule(Rule(Predicate('big', [Var('N')]),
+        ...                      [Predicate('num', [Var('N')])]))
+        >>> prolog.add_rule(Rule(Predicate('big', [Predicate('many')])))
+        >>> q = Predicate('big', [Var('X')])
+        >>> for m, rules in islice(prolog.parallel_answer_iter(
+        ...         [q], processes=2, chunk_size=2), 3):
+        ...     print q.substitute(m)
+        big(0)
+        big(1)
+        big(2)
+
+        >>> import os, sys
+        >>> module = sys.modules[Prolog.__module__]
+        >>> def crash( pickled_prolog ):
+        ...     os._exit(1)
+        >>> init, module._init_worker = module._init_worker, crash
+        >>> try:
+        ...     list(prolog.parallel_answer_iter([q], processes=2))
+        ... except RuntimeError, e:
+        ...     print e
+        ... finally:
+        ...     module._init_worker = init
+        the worker processes died
+        """
         if not queries:
-            yield varmap, []
+            yield VarMap(), []
             return
 
-        query = queries[0]
-        rest = queries[1:]
-
-        # First, we determine whether the query (the first in the list) matches
-        # any rules.  For each matching rule, there are a number of ways in
-        # which the entire antecedent list for that rule can be made true, and
-        # we have to try them all.  But that's okay, because we can just call
-        # ourselve to get an iterator of all valid mappings for the entire list
-        # (recursion is fun, right?)
-        if query.name not in self.rules_dict:
+        candidates = list(self.index.candidates(queries[0], VarMap()))
+        if not candidates:
             return
+        positions = dict((id(rule), i) for i, rule in enumerate(self.rules))
+        query_vars = variables(queries)
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = max(1, min(processes, len(candidates)))
+        tasks = multiprocessing.Queue()
+        for branch, rule in enumerate(candidates):
+            tasks.put((branch, (queries, query_vars, positions[id(rule)])))
+        for _ in xrange(processes):
+            tasks.put(None)
+        # Workers say which branch they take here, and send its chunks on
+        # their own queue.  Branches are taken in order, so the chunks of
+        # the branch being read are always at the head of its worker's.
+        claims = multiprocessing.Queue()
+        pickled = pickle.dumps(self, 2)
+        workers = []
+        results = []
+        try:
+            for worker in xrange(processes):
+                queue = multiprocessing.Queue(chunks_ahead)
+                process = multiprocessing.Process(
+                    target=_branch_worker,
+                    args=(worker, pickled, chunk_size, tasks, claims, queue))
+                process.daemon = True
+                process.start()
+                workers.append(process)
+                results.append(queue)
+
+            owners = {}
+            current = 0
+            while current < len(candidates):
+                while current not in owners:
+                    try:
+                        branch, worker = claims.get(True, WORKER_POLL_TIME)
+                    except Empty:
+                        if not any(p.is_alive() for p in workers):
+                            raise RuntimeError("the worker processes died")
+                        continue
+                    owners[branch] = worker
+                worker = owners[current]
+                branch, answers, done, error = _next_chunk(workers[worker],
+                                                           results[worker])
+                for values, rule_positions in answers:
+                    # Variables left in the answer are renamed, in one go so
+                    # that they stay shared between the values.
+                    values = Predicate('answer', values)
+                    if not values.ground:
+                        values = renamed(values)
+                    varmap = VarMap()
+                    for var, value in izip(query_vars, values.args):
+                        varmap.add(var, value)
+                    yield varmap, [self.rules[i] for i in rule_positions]
+                if error is not None:
+                    raise error
+                if done:
+                    del owners[current]
+                    current += 1
+        finally:
+            for process in workers:
+                process.terminate()
+
+    def solve( self, goals, varmap, use_tables=True, first_rules=None,
+               satisfy=True ):
+        """Yields (varmap, proof) for each way the goals can be made true.
+
+        This is a loop over an explicit stack of choicepoints and a linked
+        list of continuation frames, so neither the depth of a proof nor the
+        number of answers is limited by Python's recursion limit, and handing
+        back an answer does not pass through one generator per proof level.
+
+        The search visits the same answers in the same order as the plain
+        recursive definition:
+
+            for each rule matching the first goal:
+                for each proof of the rule's antecedents:
+                    for each proof of the remaining goals:
+                        if the rule's test succeeds, that is an answer
+
+        Tabled subgoals are still evaluated by a nested solve, one per
+        distinct subgoal.  If use_tables is False the first goal is always
+        matched against the rules; this is how tables get filled.  If
+        first_rules is given, the first goal is matched against just those
+        rules, in that order.
+
+        If satisfy is False no rule's try_to_satisfy is called; the answers
+        are the proofs that would be attempted, and running their tests and
+        commands is up to the caller.
+
+        If the profiler attribute is set, the query is counted and timed in
+        it.
+        """
+        answers = self._solve(goals, varmap, use_tables, first_rules,
+                              satisfy)
+        if self.profiler is not None:
+            answers = self.profiler.profiled(goals, answers)
+        return answers
+
+    def _solve( self, goals, varmap, use_tables, first_rules, satisfy ):
+        # Each choicepoint is [trail mark, goal, goals, index of the next
+        # goal, continuation, iterator over alternatives, tabled?,
+        # unified?].  Alternatives that are unified come from
+        # unified_alternatives: the goal has already been unified with them.
+        choices = []
+        goals, index, cont = list(goals), 0, None
+        patterns = self.patterns or any(contains_pattern(g) for g in goals)
+        profiler = self.profiler
+
+        while True:
+            # Call: prove goals[index:], then hand the proof to cont.
+            if index < len(goals):
+                goal = goals[index]
+                answers = alternatives = None
+                if first_rules is not None:
+                    alternatives = iter(first_rules)
+                    first_rules = None
+                elif self.tabling and use_tables:
+                    answers = self.tabled_answers(goal, varmap, satisfy)
+                use_tables = True
+                if answers is not None:
+                    alternatives = iter(answers)
+                elif alternatives is None:
+                    alternatives = self.index.candidates(goal, varmap)
+                if patterns:
+                    alternatives = self.unified_alternatives(
+                        goal, alternatives, answers is not None, varmap)
+                choices.append([varmap.mark(), goal, goals, index + 1, cont,
+                                alternatives, answers is not None, patterns])
+                if profiler is not None:
+                    profiler.choicepoint(len(choices))
+            else:
+                # The goal list is empty (vacuously true).  Return the proof
+                # up through the continuation frames until one of them has
+                # more goals to prove.  Once only quiet frames are left the
+                # answer is complete.
+                proof = None
+                while cont is not None and not cont[5]:
+                    frame = cont
+                    if frame[0] == AFTER_ANTECEDENTS:
+                        _, rule, goals, index, next, quiet = frame
+                        cont = after_rest(rule, proof, satisfy, next)
+                        break
+                    _, rule, ants, check, cont, quiet = frame
+                    # It is not quite enough in this system to have true
+                    # antecedents and therefore assume a true consequent.  If
+                    # the following test succeeds, though, we can proceed.
+                    if check:
+                        if profiler is None:
+                            ok = rule.try_to_satisfy()
+                        else:
+                            start = profiler.clock()
+                            ok = rule.try_to_satisfy()
+                            profiler.tested(rule, ok, start,
+                                            profiler.clock() - start)
+                        if not ok:
+                            break
+                    proof = Proof(rule, proof, ants)
+                else:
+                    if cont is not None:
+                        proof = PendingProof(proof, cont)
+                    yield varmap, proof
+                    frame = None
+
+                if frame is not None and frame[0] == AFTER_ANTECEDENTS:
+                    # More goals to prove; go around again.
+                    continue
+
+            # Backtrack: resume the most recent choicepoint with its next
+            # alternative, dropping choicepoints that have run out.
+            while choices:
+                choice = choices[-1]
+                (mark, goal, goals, index, cont, alternatives, tabled,
+                 unified) = choice
+                # Unified alternatives undo their own bindings as they go.
+                if not unified:
+                    varmap.undo(mark)
+                if profiler is not None:
+                    profiler.resumed(choice)
+
+                for alternative in alternatives:
+                    if tabled:
+                        # Replay a stored answer.  It is renamed so that
+                        # variables left in it are not shared between uses.
+                        answer, rule, ants = alternative
+                        if not unified:
+                            varmap.occurs_check = (self.occurs_check !=
+                                                   'never')
+                            if profiler is None:
+                                ok = goal.unify(renamed(answer), varmap)
+                            else:
+                                ok = profiler.unify(rule, goal,
+                                                    renamed(answer), varmap)
+                            if not ok:
+                                continue
+                        cont = after_rest(rule, ants, False, cont)
+                        break
+                    else:
+                        rule = alternative
+                        if not unified:
+                            varmap.occurs_check = self.needs_occurs_check(rule)
+                            if profiler is None:
+                                ok = goal.unify(rule.consequent, varmap)
+                            else:
+                                ok = profiler.unify(rule, goal,
+                                                    rule.consequent, varmap)
+                            if not ok:
+                                continue
+                        cont = after_antecedents(rule, goals, index, cont,
+                                                 satisfy)
+                        goals, index = rule.antecedents, 0
+                        if len(goals) > 1:
+                            if self.reorder:
+                                goals = self.ordered_antecedents(rule, varmap)
+                            elif rule.ordered is not None:
+                                goals = rule.ordered
+                        break
+                else:
+                    varmap.undo(mark)
+                    choices.pop()
+                    continue
+                if profiler is not None:
+                    profiler.chose(choice, rule)
+                break
+            else:
+                return
 
-        for rule in self.rules_dict[query.name]:
-            rulemap = varmap.copy()
-
-            if query.unify(rule.consequent, rulemap):
-                # We found a matching rule.  Now try all of the ways that the
-                # antecedents can be made true.  For each of them, we call this
-                # function again with the *rest* of the query list and yield
-                # all resulting maps.  Neat!
-                for antmap, antrules in self.answer_iter(
-                        rule.antecedents, rulemap):
-                    for finalmap, finalrules in self.answer_iter(rest, antmap):
-                        # It is not quite enough in this system to have true
-                        # antecedents and therefore assume a true consequent.
-                        # If the following test succeeds, though, we can
-                        # proceed.
-                        if rule.try_to_satisfy():
-                            yield finalmap, [rule] + finalrules + antrules
+    def unified_alternatives( self, goal, alternatives, tabled, varmap ):
+        """Yields each rule (or tabled answer) in alternatives once for every
+        way that goal unifies with it, with the bindings for that left in
+        varmap.  This is how the solver handles patterns, which can unify
+        in more than one way.
+        """
+        profiler = self.profiler
+        for alternative in alternatives:
+            if tabled:
+                term = renamed(alternative[0])
+                check = self.occurs_check != 'never'
+            else:
+                term = alternative.consequent
+                check = self.needs_occurs_check(alternative)
+            varmap.occurs_check = check
+            found = False
+            for _ in unifiers(goal, term, varmap):
+                found = True
+                yield alternative
+                # Other choicepoints may have changed this in the meantime.
+                varmap.occurs_check = check
+            if profiler is not None:
+                profiler.unified(alternative[1] if tabled else alternative,
+                                 found, 0.0)
+
+    def needs_occurs_check( self, rule ):
+        """Whether unifying against rule's consequent does an occurs check"""
+        policy = self.occurs_check
+        return policy == 'always' or (policy == 'flagged' and
+                                      rule.occurs_check)
+
+    def tabled_answers( self, query, varmap, satisfy=True ):
+        """Returns the list of (answer, rule, antecedent proof) for a subgoal.
+
+        A complete table is reused as is.  A subgoal that is already being
+        evaluated further up gets the answers found so far; its evaluation is
+        then repeated until no new answers turn up.  Otherwise the subgoal is
+        evaluated here, in a map of its own, and its table filled in.
+
+        A subgoal that depended on one further up (the leader) keeps its
+        incomplete table.  Until the leader has reached its fixpoint, the
+        table is only evaluated again when some table has gained answers
+        since its last evaluation, and then all of them are marked complete
+        together.
+
+        Answers found without running rule tests (satisfy is False) are
+        tabled separately from those found with them.
+
+        >>> prolog = Prolog(tabling=True)
+        >>> def p(name, *args):
+        ...     return Predicate(name, [Predicate(a) if a.islower() else
+        ...                             Var(a) for a in args])
+        >>> prolog.add_rule(Rule(p('odd', 'X', 'Y'),
+        ...                      [p('edge', 'X', 'Z'), p('even', 'Z', 'Y')]))
+        >>> prolog.add_rule(Rule(p('even', 'X', 'Y'),
+        ...                      [p('edge', 'X', 'Z'), p('odd', 'Z', 'Y')]))
+        >>> prolog.add_rule(Rule(p('even', 'X', 'X')))
+        >>> for a, b in [('a', 'b'), ('b', 'c'), ('c', 'a'), ('c', 'd')]:
+        ...     prolog.add_rule(Rule(p('edge', a, b)))
+        >>> q = p('odd', 'a', 'W')
+        >>> sorted(str(q.substitute(m)) for m, rules in prolog.answer_iter([q]))
+        ['odd(a, a)', 'odd(a, b)', 'odd(a, c)', 'odd(a, d)']
+        >>> all(table.complete for table in prolog.tables.values())
+        True
+        """
+        key = (satisfy, variant_key(query, varmap))
+        table = self.tables.get(key)
+        if table is not None and table.complete:
+            self.table_hits += 1
+            return table.answers
+
+        stack = self.table_stack
+        lowlinks = self.table_lowlinks
+        if table is not None:
+            if table.position is not None:
+                # A recursive call to a subgoal that is still being
+                # evaluated.  Everything above it on the stack now depends
+                # on its answers.
+                leader = table.position
+            elif table.changes == self.table_changes:
+                # Evaluated since the last new answer anywhere, so another
+                # evaluation would find nothing new.
+                leader = table.lowlink
+            else:
+                leader = None
+            if leader is not None:
+                self.table_hits += 1
+                self.tables[stack[leader]].consumed_early = True
+                for i in xrange(leader, len(lowlinks)):
+                    lowlinks[i] = min(lowlinks[i], leader)
+                return list(table.answers)
+        else:
+            table = self.tables[key] = AnswerTable()
+        self.table_misses += 1
+        goal = renamed(query.substitute(varmap))
+
+        pos = table.position = len(stack)
+        pending = len(self.table_pending)
+        stack.append(key)
+        lowlinks.append(pos)
+        try:
+            while True:
+                changes = table.changes = self.table_changes
+                table.consumed_early = False
+                for answermap, proof in self.solve([goal], VarMap(),
+                                                   use_tables=False,
+                                                   satisfy=satisfy):
+                    if table.add(goal.substitute(answermap), proof,
+                                 answermap):
+                        self.table_changes += 1
+                # Keep going while recursive consumers may have missed some
+                # of this pass's answers (to this table or another one in
+                # the component).
+                if (not table.consumed_early or
+                        self.table_changes == changes):
+                    break
+        except:
+            # Whatever was found is incomplete, and nothing will finish it.
+            del self.tables[key]
+            raise
+        finally:
+            stack.pop()
+            lowlink = lowlinks.pop()
+            table.position = None
+
+        if lowlink < pos:
+            # Depends on a subgoal further up that is not finished yet, so
+            # this table may still grow.  Let the caller see what we have,
+            # and leave completing it to that subgoal.
+            lowlinks[-1] = min(lowlinks[-1], lowlink)
+            # So do the tables that were waiting for this one.
+            for member in self.table_pending[pending:]:
+                member = self.tables.get(member)
+                if member is not None:
+                    member.lowlink = lowlink
+            table.lowlink = lowlink
+            self.table_pending.append(key)
+        else:
+            # The leader of a component: it and every table that depended
+            # on it are done.
+            table.complete = True
+            for member in self.table_pending[pending:]:
+                member = self.tables.get(member)
+                if member is not None:
+                    member.complete = True
+            del self.table_pending[pending:]
+        return table.answers
+
+# The rule base of a parallel_answer_iter worker process, and the position
+# of each of its rules in the rule list.
+_worker_prolog = None
+_worker_positions = None
+
+def _init_worker( pickled_prolog ):
+    global _worker_prolog, _worker_positions
+    _worker_prolog = pickle.loads(pickled_prolog)
+    _worker_positions = dict((id(rule), i)
+                             for i, rule in enumerate(_worker_prolog.rules))
+
+def _solve_branch( task ):
+    """Yields the answers to queries whose first query uses the given rule,
+    as (values of the query variables, rule positions) pairs.
+    """
+    queries, query_vars, position = task
+    prolog = _worker_prolog
+    for varmap, proof in prolog.solve(
+            queries, VarMap(), first_rules=[prolog.rules[position]]):
+        rules = proof.rules() if proof is not None else []
+        # Rules from tabled answers are instances of the ones in the list.
+        rules = [rule.template for rule in rules]
+        values = []
+        for var in query_vars:
+            value = varmap[var]
+            if not value.ground and not isinstance(value, Var):
+                value = value.substitute(varmap)
+            values.append(value)
+        yield values, [_worker_positions[id(rule)] for rule in rules]
+
+def _branch_worker( worker, pickled_prolog, chunk_size, tasks, claims,
+                    results ):
+    """Solves the branches in tasks until it gets None.  For each one it
+    puts (branch, worker) on claims, then (branch, answers, done, error) on
+    results for every chunk of its answers.
+    """
+    _init_worker(pickled_prolog)
+    for branch, task in iter(tasks.get, None):
+        claims.put((branch, worker))
+        chunk = []
+        try:
+            for answer in _solve_branch(task):
+                chunk.append(answer)
+                if len(chunk) == chunk_size:
+                    results.put((branch, chunk, False, None))
+                    chunk = []
+        except Exception, e:
+            results.put((branch, chunk, True, e))
+        else:
+            results.put((branch, chunk, True, None))
+
+# How long to wait for a worker before checking that it is still running
+WORKER_POLL_TIME = 0.5
+
+def _next_chunk( process, results ):
+    """Returns the next chunk from a worker's results queue, or raises
+    RuntimeError if the worker has died without sending one.
+    """
+    while True:
+        try:
+            return results.get(True, WORKER_POLL_TIME)
+        except Empty:
+            if not process.is_alive():
+                # It may have sent the chunk just before it stopped.
+                try:
+                    return results.get(True, WORKER_POLL_TIME)
+                except Empty:
+                    raise RuntimeError("worker process %d died with exit "
+                                       "code %s" % (process.pid,
+                                                    process.exitcode))
 
 if __name__ == '__main__':
     prolog = Prolog()
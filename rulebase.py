@@ -0,0 +1,272 @@
+"""rulebase.py
+
+Reads rule bases written in the Prolog-like syntax of example.pdb:
+
+    % A comment
+    exists('main.c').
+    built(file(Base, '.o')) :- built(file(Base, '.c')).
+    built("{base}.o") :- built("{base}.c").
+    ?- built(file(main, '.o')).
+
+Names that start with a lower case letter (or are numbers, or are in single
+quotes) are atoms and functors, names that start with an upper case letter
+or an underscore are variables, and double quoted strings are Patterns.
+
+Parsing a large rule base takes a while, so load() keeps the result in a
+cache file next to the source, keyed on a digest of its contents.
+
+"""
+
+import cPickle as pickle
+import gc
+import os
+import re
+
+from prolog import (Predicate, Var, Pattern, Rule, Prolog, name_generator,
+                    global_varname_factory)
+import filestate
+
+# Bump this whenever the parser or the pickled form of the rule base
+# changes, so old cache files are ignored.
+CACHE_VERSION = 4
+
+class ParseError(ValueError):
+    pass
+
+_token = re.compile(r"""
+    (?P<space>\s+|%.*) |
+    (?P<neck>:-) |
+    (?P<query>\?-) |
+    (?P<var>[A-Z_][A-Za-z0-9_]*) |
+    (?P<atom>[a-z][A-Za-z0-9_]*|[0-9]+) |
+    '(?P<quoted>(?:[^'\\]|\\.)*)' |
+    "(?P<pattern>(?:[^"\\]|\\.)*)" |
+    (?P<punct>[(),.])
+    """, re.X)
+
+_escape = re.compile(r"\\(.)")
+
+def _tokens( lines ):
+    """Yields (kind, text, line number) for the tokens in lines, then
+    ('end', '', line number).
+    """
+    number = 0
+    for number, line in enumerate(lines, 1):
+        pos = 0
+        end = len(line)
+        while pos < end:
+            m = _token.match(line, pos)
+            if m is None:
+                raise ParseError("line %d: unexpected %r" %
+                                 (number, line[pos:pos + 10]))
+            pos = m.end()
+            kind = m.lastgroup
+            if kind == 'space':
+                continue
+            text = m.group(kind)
+            if kind == 'punct':
+                kind = text
+            elif kind in ('quoted', 'pattern'):
+                text = _escape.sub(r"\1", text)
+            yield kind, text, number
+    yield 'end', '', number
+
+class _Parser(object):
+    """Recursive descent over a token stream, one clause at a time"""
+    def __init__( self, lines, varfactory ):
+        self.tokens = _tokens(lines)
+        self.varfactory = varfactory
+        self.anonymous = 0
+        self.advance()
+
+    def advance( self ):
+        self.kind, self.text, self.line = next(self.tokens)
+
+    def expect( self, kind ):
+        if self.kind != kind:
+            raise ParseError("line %d: expected %r, found %r" %
+                             (self.line, kind, self.text or self.kind))
+        self.advance()
+
+    def clauses( self ):
+        while self.kind != 'end':
+            if self.kind == 'query':
+                self.advance()
+                self.names = {}
+                goals = self.goals()
+                self.expect('.')
+                yield goals
+            else:
+                self.names = {}
+                consequent = self.term()
+                antecedents = []
+                if self.kind == 'neck':
+                    self.advance()
+                    antecedents = self.goals()
+                self.expect('.')
+                yield Rule(consequent, antecedents,
+                           varfactory=self.varfactory)
+
+    def goals( self ):
+        goals = [self.term()]
+        while self.kind == ',':
+            self.advance()
+            goals.append(self.term())
+        return goals
+
+    def term( self ):
+        kind, text = self.kind, self.text
+        if kind == 'var':
+            self.advance()
+            if text == '_':
+                # Every _ is a different variable, with a name that no
+                # variable in the source can have.
+                self.anonymous += 1
+                return Var('_#%d' % self.anonymous)
+            var = self.names.get(text)
+            if var is None:
+                var = self.names[text] = Var(text)
+            return var
+        if kind == 'pattern':
+            self.advance()
+            return Pattern(text)
+        if kind not in ('atom', 'quoted'):
+            raise ParseError("line %d: expected a term, found %r" %
+                             (self.line, text or kind))
+        self.advance()
+        if self.kind != '(':
+            return Predicate(text)
+        self.advance()
+        args = self.goals()
+        self.expect(')')
+        return Predicate(text, args)
+
+def parse( lines, varfactory=global_varname_factory ):
+    """Yields each clause in lines (any iterable of strings, such as an open
+    file) as soon as it has been read: a Rule for a fact or rule, and a list
+    of goals for a query.
+
+    >>> for clause in parse(["exists('main.c').  % a fact",
+    ...                      "built(X) :- exists(X),",
+    ...                      "            ok.",
+    ...                      "?- built(F), exists(F)."]):
+    ...     print clause  # doctest: +ELLIPSIS
+    exists(main.c)::{}
+    built(_v...)<=exists(_v...), ok::{_X->_v...}
+    [built(_F), exists(_F)]
+    >>> rule, = parse(["p(_, _, _0)."])
+    >>> len(set(str(arg) for arg in rule.consequent.args))
+    3
+    >>> list(parse(["p(X"]))
+    Traceback (most recent call last):
+    ...
+    ParseError: line 1: expected ')', found 'end'
+    """
+    return _Parser(lines, varfactory).clauses()
+
+def cache_filename( filename ):
+    """The file that load() keeps the parsed form of filename in"""
+    return filename + 'c'
+
+def load( filename, prolog=None, cache=True ):
+    """Reads the rule base in filename.  Returns a Prolog with its rules
+    (prolog, if one is given) and the list of its queries, each a list of
+    goals.
+
+    With cache set, the parsed rules are pickled to cache_filename(), along
+    with the digest of filename.  Later loads of the same contents unpickle
+    them instead of parsing.  When no prolog is passed in, the one in the
+    cache is used as it is, clause index and all.
+
+    >>> import shutil, tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> path = os.path.join(root, 'rules.pdb')
+    >>> with open(path, 'w') as f:
+    ...     f.write('''built("{base}.o") :- built("{base}.c").
+    ... built('main.c').
+    ... ?- built("{x}.o").
+    ... ''')
+    >>> prolog, queries = load(path)
+    >>> os.path.exists(cache_filename(path))
+    True
+    >>> prolog, queries = load(path)
+    >>> query, = queries
+    >>> [[str(q.substitute(m)) for q in query]
+    ...  for m, rules in prolog.answer_iter(query)]
+    [['built(main.o)']]
+    >>> shutil.rmtree(root)
+    """
+    # Loading makes a great many objects and no garbage, so the cyclic
+    # collector would only slow it down.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        digest = filestate.file_digest(filename)
+        cached = None
+        if cache:
+            cached = _read_cache(cache_filename(filename), digest)
+        if cached is not None:
+            rules_prolog, queries = cached
+        else:
+            rules_prolog, queries = _parse_file(filename, digest)
+            if cache:
+                _write_cache(cache_filename(filename), digest, rules_prolog,
+                             queries)
+    finally:
+        if enabled:
+            gc.enable()
+
+    if prolog is None:
+        return rules_prolog, queries
+    for rule in rules_prolog.rules:
+        prolog.add_rule(rule)
+    return prolog, queries
+
+def _parse_file( filename, digest ):
+    # Variables get names particular to these contents, so that rules loaded
+    # from the cache never share names with rules made in this process.
+    varfactory = name_generator('%s_' % digest[:8])
+    prolog = Prolog()
+    queries = []
+    with open(filename) as f:
+        for clause in parse(f, varfactory):
+            if isinstance(clause, Rule):
+                prolog.add_rule(clause)
+            else:
+                queries.append(clause)
+    return prolog, queries
+
+def _read_cache( path, digest ):
+    """Returns the (prolog, queries) cached in path for contents with the
+    given digest, or None.
+    """
+    try:
+        with open(path, 'rb') as f:
+            cached = pickle.load(f)
+    except Exception:
+        # Unreadable, truncated, or pickled by an older version of the code
+        # (classes that have been renamed or moved fail in all sorts of
+        # ways); the rule base is just parsed again.
+        return None
+    if (not isinstance(cached, tuple) or len(cached) != 4 or
+            cached[:2] != (CACHE_VERSION, digest) or
+            not isinstance(cached[2], Prolog) or
+            not isinstance(cached[3], list)):
+        return None
+    return cached[2:]
+
+def _write_cache( path, digest, prolog, queries ):
+    temp = path + '.tmp'
+    with open(temp, 'wb') as f:
+        pickle.dump((CACHE_VERSION, digest, prolog, queries), f,
+                    pickle.HIGHEST_PROTOCOL)
+    os.rename(temp, path)
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
+
+# vim: et sts=4 sw=4
@@ -0,0 +1,378 @@
+"""schedule.py
+
+Runs the tests and commands of a finished proof the way make -j does: the
+proof is turned into a graph of ground rule instances, and any instance whose
+antecedents have all been satisfied can run, on a bounded pool of threads.
+
+Resolution and execution are separate steps, so a proof can also be turned
+into a Plan that lists what would run without running anything.
+
+"""
+
+import heapq
+import os
+import Queue
+import sys
+import threading
+
+from prolog import Predicate, VarMap, postorder
+
+def consequent_files( rule ):
+    """The files a rule instance is about: the atoms among the arguments of
+    its consequent, taken as paths.
+    """
+    return [os.path.abspath(arg.name) for arg in rule.consequent.args
+            if isinstance(arg, Predicate) and not arg.args]
+
+class Node(object):
+    """One ground rule instance in a ProofGraph"""
+    def __init__( self, index, key, rule ):
+        # Position in the graph; dependencies always have smaller indices.
+        self.index = index
+        # Identifies the instance across graphs (see ProofGraph.add).
+        self.key = key
+        self.rule = rule
+        self.deps = []
+        self.dependents = []
+
+    def __str__( self ):
+        return str(self.rule.consequent)
+
+    __repr__ = __str__
+
+class ProofGraph(object):
+    """The rule instances from one or more proofs, with an edge from each
+    instance to the instances that proved its antecedents.
+
+    An instance that turns up several times (the same rule proving the same
+    ground consequent from the same antecedents) is only added once.
+    """
+    def __init__( self ):
+        self.nodes = []
+        self.by_key = {}
+
+    def __len__( self ):
+        return len(self.nodes)
+
+    def __iter__( self ):
+        return iter(self.nodes)
+
+    def add( self, rule, deps=() ):
+        """Adds a rule instance that depends on the given nodes and returns
+        its node (an existing one if it is already here).
+        """
+        key = (id(rule.template), rule.consequent, tuple(rule.antecedents))
+        node = self.by_key.get(key)
+        if node is not None:
+            return node
+        node = self.by_key[key] = Node(len(self.nodes), key, rule)
+        self.nodes.append(node)
+        for dep in deps:
+            if dep not in node.deps:
+                node.deps.append(dep)
+                dep.dependents.append(node)
+        return node
+
+    def add_proof( self, proof, mapping ):
+        """Adds the instances (under mapping) of the rules in a proof.
+        Returns the nodes for the goals that the proof was for.
+        """
+        nodes = {}
+        for p in postorder(proof):
+            deps = [nodes[id(ant)] for ant in p.antecedents()]
+            nodes[id(p)] = self.add(p.rule.instance(mapping), deps)
+
+        roots = []
+        while proof is not None:
+            roots.append(nodes[id(proof)])
+            proof = proof.rest
+        return roots
+
+def _worker( tasks, finished, profiler=None ):
+    """Satisfies nodes from tasks until it gets None, reporting each one as
+    (node, success, exception info) on finished.
+    """
+    while True:
+        node = tasks.get()
+        if node is None:
+            return
+        if profiler is not None:
+            start = profiler.clock()
+        ok, exc_info = False, None
+        try:
+            ok = node.rule.try_to_satisfy()
+        except Exception:
+            exc_info = sys.exc_info()
+        if profiler is not None:
+            profiler.ran(node.rule, ok, start, profiler.clock() - start)
+        finished.put((node, ok, exc_info))
+
+def execute( graph, jobs=1, satisfied=None, profiler=None ):
+    """Calls try_to_satisfy on every rule instance in the graph, running up
+    to jobs of them at once, and never before all of an instance's
+    dependencies have succeeded.  Ready instances are started in graph
+    order.  graph may also be a list of some of its nodes in graph order,
+    to run just those.
+
+    satisfied, if given, is a set of keys of nodes that already succeeded;
+    they are skipped, and the keys of the ones that succeed here are added
+    to it.
+
+    Once an instance fails no more are started, as the build as a whole has
+    failed.  Returns the list of nodes that failed.  An exception raised by
+    a rule is re-raised once the instances already running have finished.
+
+    profiler, if given, is an instrument.Profiler that times each instance.
+    """
+    if satisfied is None:
+        satisfied = set()
+    waiting = {}
+    ready = []
+    for node in graph:
+        if node.key in satisfied:
+            continue
+        waiting[node] = len([d for d in node.deps
+                             if d.key not in satisfied])
+        if not waiting[node]:
+            heapq.heappush(ready, (node.index, node))
+
+    tasks = Queue.Queue()
+    finished = Queue.Queue()
+    workers = [threading.Thread(target=_worker,
+                                args=(tasks, finished, profiler))
+               for _ in xrange(max(1, min(jobs, len(waiting))))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    running = 0
+    failed = []
+    error = None
+    try:
+        while ready or running:
+            while ready and not failed:
+                index, node = heapq.heappop(ready)
+                tasks.put(node)
+                running += 1
+            if not running:
+                break
+
+            node, ok, exc_info = finished.get()
+            running -= 1
+            if not ok:
+                failed.append(node)
+                if exc_info is not None and error is None:
+                    error = exc_info
+                continue
+
+            satisfied.add(node.key)
+            for dependent in node.dependents:
+                if dependent in waiting:
+                    waiting[dependent] -= 1
+                    if not waiting[dependent]:
+                        heapq.heappush(ready, (dependent.index, dependent))
+    finally:
+        for worker in workers:
+            tasks.put(None)
+        for worker in workers:
+            worker.join()
+
+    if error is not None:
+        raise error[0], error[1], error[2]
+    return failed
+
+def build( prolog, queries, jobs=1, state=None, profiler=None ):
+    """Resolves queries without running any rule tests, then runs the tests
+    and commands of the first proof in parallel with execute().
+
+    If some instance fails, the next proof is tried; instances that already
+    succeeded are not run again.  Returns a copy of the answer's varmap and
+    its graph, or None if no proof could be satisfied.
+
+    state, if given, is a buildstate.BuildState.  Instances that it records
+    as built from the same inputs are not run at all, and the outcome of the
+    ones that do run is recorded in it.  profiler is passed on to
+    execute().
+
+    >>> import threading
+    >>> from prolog import Predicate, Rule, Prolog
+    >>> lock = threading.Lock()
+    >>> log = []
+    >>> class Compile(Rule):
+    ...     def pre_test( self ):
+    ...         return str(self.consequent) in log
+    ...     def commands( self ):
+    ...         with lock:
+    ...             log.append(str(self.consequent))
+    >>> def f(name):
+    ...     return Predicate('built', [Predicate(name)])
+    >>> prolog = Prolog()
+    >>> prolog.add_rule(Compile(f('prog'), [f('a.o'), f('b.o')]))
+    >>> prolog.add_rule(Compile(f('a.o'), [f('a.c')]))
+    >>> prolog.add_rule(Compile(f('b.o'), [f('b.c')]))
+    >>> for src in ['a.c', 'b.c']:
+    ...     prolog.add_rule(Compile(f(src)))
+    >>> varmap, graph = build(prolog, [f('prog')], jobs=2)
+    >>> sorted(graph.nodes, key=str)
+    [built(a.c), built(a.o), built(b.c), built(b.o), built(prog)]
+    >>> log[-1]
+    'built(prog)'
+    >>> log.index('built(a.c)') < log.index('built(a.o)')
+    True
+    >>> log.index('built(b.c)') < log.index('built(b.o)')
+    True
+    """
+    satisfied = set()
+    for varmap, proof in prolog.solve(queries, VarMap(), satisfy=False):
+        graph = ProofGraph()
+        if proof is not None:
+            graph.add_proof(proof.resolve(), varmap)
+        if state is not None:
+            current = state.current(graph)
+            satisfied.update(current)
+        failed = execute(graph, jobs, satisfied, profiler)
+        if state is not None:
+            state.record(graph, satisfied - current, failed)
+        if not failed:
+            return varmap.copy(), graph
+    return None
+
+class Plan(object):
+    """A dry run: the proof chosen for some queries, as a graph of ground
+    rule instances, and the commands that running it would execute.
+    Nothing is run until execute() is called.
+    """
+    def __init__( self, queries, graph, roots, run_tests=False ):
+        self.queries = queries
+        self.graph = graph
+        # Nodes for the queries themselves
+        self.roots = roots
+
+        # Without tests, assume that everything has to be built.  With them,
+        # an instance runs if its test fails or anything it depends on runs,
+        # as make -n would report it.
+        self.runs = {}
+        for node in graph:
+            self.runs[node] = (not run_tests or
+                               any(self.runs[d] for d in node.deps) or
+                               not node.rule.pre_test())
+
+    def steps( self ):
+        """Returns (node, command lines) for every instance that would run,
+        in an order that respects dependencies.
+        """
+        return [(node, node.rule.command_lines())
+                for node in self.graph if self.runs[node]]
+
+    def commands( self ):
+        """Returns every command line that would run, in order"""
+        return [line for node, lines in self.steps() for line in lines]
+
+    def tree( self ):
+        """Returns the proof as indented text, one rule instance per line"""
+        lines = []
+        stack = [(node, 0) for node in reversed(self.roots)]
+        while stack:
+            node, depth = stack.pop()
+            lines.append("%s%s" % ("  " * depth, node))
+            stack.extend((d, depth + 1) for d in reversed(node.deps))
+        return "\n".join(lines)
+
+    def to_dict( self ):
+        """Returns the plan as plain data (suitable for json), for caching
+        and for diff_plans.
+        """
+        return {
+            'queries': [str(q) for q in self.queries],
+            'steps': [{
+                'rule': node.rule.__class__.__name__,
+                'consequent': str(node.rule.consequent),
+                'antecedents': [str(a) for a in node.rule.antecedents],
+                'deps': [d.index for d in node.deps],
+                'commands': node.rule.command_lines(),
+                'runs': self.runs[node],
+            } for node in self.graph],
+        }
+
+    def execute( self, jobs=1, profiler=None ):
+        """Runs the plan; see execute().  Returns the nodes that failed."""
+        return execute(self.graph, jobs, profiler=profiler)
+
+def plan( prolog, queries, run_tests=False ):
+    """Resolves queries without running any commands and returns a Plan for
+    the first proof found, or None if there is none.
+
+    If run_tests is True the rules' pre_tests are called to leave out the
+    instances that are already satisfied, so they must not have side effects.
+
+    >>> from prolog import Predicate, Rule, Prolog
+    >>> class CC(Rule):
+    ...     def command_lines( self ):
+    ...         target, = self.consequent.args
+    ...         sources = [str(a.args[0]) for a in self.antecedents]
+    ...         return ["cc -o %s %s" % (target, " ".join(sources))]
+    >>> def f(name):
+    ...     return Predicate('built', [Predicate(name)])
+    >>> prolog = Prolog()
+    >>> prolog.add_rule(CC(f('prog'), [f('main.o')]))
+    >>> prolog.add_rule(CC(f('main.o'), [f('main.c')]))
+    >>> prolog.add_rule(Rule(f('main.c')))
+    >>> p = plan(prolog, [f('prog')])
+    >>> print p.tree()
+    built(prog)
+      built(main.o)
+        built(main.c)
+    >>> p.commands()
+    ['cc -o main.o main.c', 'cc -o prog main.o']
+    >>> old = p.to_dict()
+    >>> prolog = Prolog()
+    >>> prolog.add_rule(CC(f('prog'), [f('main.o'), f('util.o')]))
+    >>> prolog.add_rule(CC(f('main.o'), [f('main.c')]))
+    >>> prolog.add_rule(CC(f('util.o'), [f('util.c')]))
+    >>> for src in ['main.c', 'util.c']:
+    ...     prolog.add_rule(Rule(f(src)))
+    >>> for line in diff_plans(old, plan(prolog, [f('prog')])):
+    ...     print line
+    - built(prog): cc -o prog main.o
+    + built(util.o): cc -o util.o util.c
+    + built(prog): cc -o prog main.o util.o
+    """
+    for varmap, proof in prolog.solve(queries, VarMap(), satisfy=False):
+        graph = ProofGraph()
+        roots = []
+        if proof is not None:
+            roots = graph.add_proof(proof.resolve(), varmap)
+        return Plan([q.substitute(varmap) for q in queries], graph, roots,
+                    run_tests)
+    return None
+
+def diff_plans( old, new ):
+    """Compares two plans (or their to_dict() forms) and returns a line for
+    each command that would run in only one of them: "- step: command" for
+    the old plan and "+ step: command" for the new one.
+    """
+    def runs( p ):
+        if isinstance(p, Plan):
+            p = p.to_dict()
+        result = []
+        for step in p['steps']:
+            if step['runs']:
+                for line in step['commands']:
+                    result.append("%s: %s" % (step['consequent'], line))
+        return result
+
+    old_lines = runs(old)
+    new_lines = runs(new)
+    old_set = set(old_lines)
+    new_set = set(new_lines)
+    return (["- " + line for line in old_lines if line not in new_set] +
+            ["+ " + line for line in new_lines if line not in old_set])
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
+
+# vim: et sts=4 sw=4
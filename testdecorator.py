@@ -1,6 +1,19 @@
 """Decorator functions
 """
 
+import os
+import Queue
+import re
+import sys
+import threading
+
+from util import LRUCache
+
+try:
+  from scandir import scandir
+except ImportError:
+  scandir = None
+
 class Var(object):
   """A variable, consisting of a name and potentially an assignment"""
   def __init__( self, name ):
@@ -34,11 +47,27 @@ class Predicate(object):
     - Can be matched with other predicates.
     - Can contain variables.
   """
+  __slots__ = ('vars',)
+
   def __init__( self ):
     self.vars = []
 
+# Pattern string -> components, so that each distinct pattern is only
+# tokenized once.  Realized patterns are made from components and never
+# parsed, but both caches are bounded all the same, since a long running
+# build can see any number of distinct patterns.
+_parsed = LRUCache(10000)
+
+# Pattern string -> (compiled regex, [(variable name, group name)])
+_matchers = LRUCache(10000)
+
+# Guards both caches, which walk() uses from several threads.
+_cache_lock = threading.Lock()
+
 class FilePattern(Predicate):
-  def __init__( self, pattern ):
+  __slots__ = ('pattern', 'components', 'consts')
+
+  def __init__( self, pattern, components=None ):
     """Parses the pattern into an internal representation.
     
       The representation can be used for matching, and contains a list of the
@@ -55,12 +84,52 @@ class FilePattern(Predicate):
       [Var('number'), Var('ext')]
       >>> fp.consts
       ['myfile-', '.']
+
+      The components (constants and variables, alternating) are kept as a
+      tuple that is shared by every FilePattern made from the same string.
+      They can also be passed in, already split, to skip parsing.
     """
     super(FilePattern, self).__init__()
+    if components is None:
+      with _cache_lock:
+        try:
+          components = _parsed[pattern]
+        except KeyError:
+          components = _parsed[pattern] = tuple(
+              self._components(self._tokens(pattern)))
     self.pattern = pattern
-    self.components = list(self._components(self._tokens(pattern)))
-    self.vars = list(c for c in self.components if isinstance(c, Var))
-    self.consts = list(c for c in self.components if not isinstance(c, Var))
+    self.components = components
+    self.vars = []
+    self.consts = []
+    for c in components:
+      if isinstance(c, Var):
+        self.vars.append(c)
+      else:
+        self.consts.append(c)
+
+  @classmethod
+  def from_components( cls, components ):
+    """Makes a pattern from a list of strings and Vars, without parsing.
+    Adjacent strings are joined and empty ones dropped.
+    """
+    merged = []
+    text = []
+    const = False
+    for c in components:
+      if isinstance(c, Var):
+        merged.append(c)
+        text.append("{%s}" % c.name)
+        const = False
+      elif c:
+        if const:
+          merged[-1] += c
+        else:
+          merged.append(c)
+        if '{' in c or '}' in c:
+          c = c.replace('{', '{{').replace('}', '}}')
+        text.append(c)
+        const = True
+    return cls("".join(text), tuple(merged))
 
   def realized( self, **values ):
     """Return a realized version of the pattern, with variables filled in.  It
@@ -72,15 +141,157 @@ class FilePattern(Predicate):
     >>> fp.realized(number = '2', ext = 'hi')
     FilePattern('{{}}my}}file-2.hi')
     """
-    sub = self._substitute
-    pattern_list = []
-    for component in self.components:
-      s = sub(component, values)
-      if isinstance(s, Var):
-        pattern_list.append("{%s}" % s.name)
-      else:
-        pattern_list.append(s.replace('{', '{{').replace('}', '}}'))
-    return FilePattern("".join(pattern_list))
+    return self.from_components([
+        values.get(c.name, c) if isinstance(c, Var) else c
+        for c in self.components])
+
+  def match( self, path ):
+    """Returns a dict of variable values if path matches the whole pattern,
+    or None.  Each variable matches at least one character.
+
+    >>> FilePattern("myfile-{number}.{ext}").match("myfile-12.tar.gz")
+    {'ext': 'gz', 'number': '12.tar'}
+    >>> FilePattern("{base}-{base}").match("a-b") is None
+    True
+    """
+    regex, names = self._matcher()
+    m = regex.match(path)
+    if m is None:
+      return None
+    return dict((name, m.group(group)) for name, group in names)
+
+  def _matcher( self ):
+    """Returns the compiled regex for the pattern and the group name of
+    each variable.
+    """
+    with _cache_lock:
+      try:
+        return _matchers[self.pattern]
+      except KeyError:
+        pass
+    names = {}
+    for i, c in enumerate(self.components):
+      if isinstance(c, Var) and c.name not in names:
+        names[c.name] = 'g%d' % i
+    matcher = (re.compile(pattern_regex(self.components), re.S),
+               names.items())
+    with _cache_lock:
+      _matchers[self.pattern] = matcher
+    return matcher
+
+  def affixes( self ):
+    """Returns the constant prefix and suffix that every matching path has.
+
+    >>> FilePattern("src/{base}.c").affixes()
+    ('src/', '.c')
+    >>> FilePattern("{dir}/{base}").affixes()
+    ('', '')
+    """
+    components = self.components
+    if not components:
+      return '', ''
+    prefix = suffix = ''
+    if not isinstance(components[0], Var):
+      prefix = components[0]
+    if not isinstance(components[-1], Var):
+      suffix = components[-1]
+    return prefix, suffix
+
+  def match_paths( self, paths ):
+    """Yields (path, bindings) for each of paths that matches, as they are
+    read from the iterable.  Paths without the pattern's constant prefix and
+    suffix are passed over without running the full match.
+
+    >>> fp = FilePattern("myfile-{number}.{ext}")
+    >>> for path, bindings in fp.match_paths(
+    ...     ["myfile-1.c", "other-2.c", "myfile-.c", "myfile-3.h"]):
+    ...   print path, sorted(bindings.items())
+    myfile-1.c [('ext', 'c'), ('number', '1')]
+    myfile-3.h [('ext', 'h'), ('number', '3')]
+    """
+    prefix, suffix = self.affixes()
+    regex, names = self._matcher()
+    for path in paths:
+      if path.startswith(prefix) and path.endswith(suffix):
+        m = regex.match(path)
+        if m is not None:
+          yield path, dict((name, m.group(group)) for name, group in names)
+
+  def walk( self, root='.', jobs=1 ):
+    """Yields (path, bindings) for the files under root whose path relative
+    to root matches the pattern.  Paths are yielded relative to root, as
+    the directories are read.
+
+    Only the directory named by the pattern's constant prefix is read.  With
+    jobs > 1 its subdirectories are read on that many threads, one subtree
+    per task, and the order of the results is not fixed.  Symbolic links to
+    directories are not followed.
+
+    >>> import shutil, tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> for d in ['src', 'src/lib', 'doc']:
+    ...   os.mkdir(os.path.join(root, d))
+    >>> for f in ['src/a.c', 'src/lib/b.c', 'src/c.h', 'doc/d.c']:
+    ...   open(os.path.join(root, f), 'w').close()
+    >>> fp = FilePattern("src/{base}.c")
+    >>> for path, bindings in sorted(fp.walk(root)):
+    ...   print path, bindings
+    src/a.c {'base': 'a'}
+    src/lib/b.c {'base': 'lib/b'}
+    >>> sorted(fp.walk(root)) == sorted(fp.walk(root, jobs=4))
+    True
+    >>> sorted(path for path, bindings in FilePattern("{x}.c").walk(root))
+    ['doc/d.c', 'src/a.c', 'src/lib/b.c']
+    >>> list(FilePattern("missing/{x}").walk(root))
+    []
+    >>> shutil.rmtree(root)
+    """
+    prefix, suffix = self.affixes()
+    start = prefix[:prefix.rfind('/') + 1]
+    top = os.path.join(root, start) if start else root
+    if not os.path.isdir(top):
+      return
+    files, dirs = _list_dir(top, start)
+    for match in self.match_paths(files):
+      yield match
+    if jobs <= 1 or len(dirs) <= 1:
+      for match in self.match_paths(_walk_files(dirs)):
+        yield match
+      return
+
+    tasks = Queue.Queue()
+    for d in dirs:
+      tasks.put(d)
+    finished = Queue.Queue()
+    def work():
+      while True:
+        try:
+          d = tasks.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          finished.put((list(self.match_paths(_walk_files([d]))), None))
+        except Exception:
+          finished.put(([], sys.exc_info()))
+    for _ in xrange(min(jobs, len(dirs))):
+      worker = threading.Thread(target=work)
+      worker.daemon = True
+      worker.start()
+
+    try:
+      for _ in dirs:
+        matches, exc_info = finished.get()
+        if exc_info is not None:
+          raise exc_info[0], exc_info[1], exc_info[2]
+        for match in matches:
+          yield match
+    finally:
+      # Stop handing out subtrees if the caller is done early.
+      while True:
+        try:
+          tasks.get_nowait()
+        except Queue.Empty:
+          break
 
   def unify( self, other ):
     pass
@@ -202,6 +413,158 @@ class FilePattern(Predicate):
         if token:
           yield token
 
+def _list_dir( dirpath, relpath ):
+  """Returns the relative paths of the files in a directory, and
+  (path, relative path) for each of its subdirectories.
+  """
+  files = []
+  dirs = []
+  try:
+    if scandir is not None:
+      for entry in scandir(dirpath):
+        if entry.is_dir(follow_symlinks=False):
+          dirs.append((entry.path, relpath + entry.name + '/'))
+        else:
+          files.append(relpath + entry.name)
+    else:
+      for name in os.listdir(dirpath):
+        path = os.path.join(dirpath, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+          dirs.append((path, relpath + name + '/'))
+        else:
+          files.append(relpath + name)
+  except OSError:
+    pass
+  return files, dirs
+
+def _walk_files( dirs ):
+  """Yields the relative paths of all of the files under the given
+  (path, relative path) directories, a directory at a time.
+  """
+  stack = list(dirs)
+  while stack:
+    files, subdirs = _list_dir(*stack.pop())
+    for path in files:
+      yield path
+    stack.extend(subdirs)
+
+def pattern_regex( components ):
+  """Returns an anchored regex source for a list of FilePattern components.
+  Each variable matches a non-empty string (as much as it can) and gets a
+  group named gN, N being the position of its first occurrence in
+  components; a variable that occurs again must match the same text.
+
+  >>> print pattern_regex(FilePattern("{base}-{n}.{base}").components)
+  (?P<g0>.+)\\-(?P<g2>.+)\\.(?P=g0)\\Z
+  """
+  first = {}
+  parts = []
+  for i, component in enumerate(components):
+    if isinstance(component, Var):
+      if component.name in first:
+        parts.append("(?P=g%d)" % first[component.name])
+      else:
+        first[component.name] = i
+        parts.append("(?P<g%d>.+)" % i)
+    else:
+      parts.append(re.escape(component))
+  parts.append(r"\Z")
+  return "".join(parts)
+
+class PatternSet(object):
+  """Many file patterns, each with a value (such as the rule whose
+  consequent it is), that can all be matched against a path at once.
+
+  Patterns are bucketed by their constant suffix and then by their constant
+  prefix, so a lookup tries one dict probe per distinct suffix and prefix
+  length and runs a full match only for the patterns that are left.
+
+  >>> patterns = PatternSet()
+  >>> patterns.add("{base}.o", 'compile')
+  >>> patterns.add("{dir}/{base}.o", 'compile in dir')
+  >>> patterns.add("lib{name}.a", 'archive')
+  >>> patterns.add("main.o", 'main')
+  >>> patterns.add("{base}.c", 'source')
+  >>> for value, bindings in patterns.matches("src/main.o"):
+  ...   print value, sorted(bindings.items())
+  compile [('base', 'src/main')]
+  compile in dir [('base', 'main'), ('dir', 'src')]
+  >>> [value for value, bindings in patterns.matches("main.o")]
+  ['compile', 'main']
+  >>> patterns.matches("libm.a")
+  [('archive', {'name': 'm'})]
+  >>> patterns.matches("README")
+  []
+  """
+  def __init__( self ):
+    # Constant suffix -> constant prefix -> [(order, pattern, value)]
+    self.buckets = {}
+    self.suffix_lengths = set()
+    self.prefix_lengths = {}
+    # Patterns without variables: path -> [(order, value)]
+    self.exact = {}
+    self.count = 0
+
+  def __len__( self ):
+    return self.count
+
+  def add( self, pattern, value ):
+    """Adds a pattern (a FilePattern or a string) and its value"""
+    if not isinstance(pattern, FilePattern):
+      pattern = FilePattern(pattern)
+    order = self.count
+    self.count += 1
+    components = pattern.components
+    if not pattern.vars:
+      self.exact.setdefault("".join(components), []).append((order, value))
+      return
+
+    prefix, suffix = pattern.affixes()
+    entry = (order, pattern, value)
+    self.buckets.setdefault(suffix, {}).setdefault(prefix, []).append(entry)
+    self.suffix_lengths.add(len(suffix))
+    self.prefix_lengths.setdefault(suffix, set()).add(len(prefix))
+
+  def candidates( self, path ):
+    """Returns the (order, pattern, value) entries of the patterns with
+    variables whose constant prefix and suffix fit path, in the order they
+    were added, without matching them.
+
+    >>> patterns = PatternSet()
+    >>> patterns.add("{base}.o", 'compile')
+    >>> patterns.add("{base}.c", 'source')
+    >>> [value for order, pattern, value in patterns.candidates("x.o")]
+    ['compile']
+    """
+    found = []
+    for length in self.suffix_lengths:
+      if length > len(path):
+        continue
+      suffix = path[len(path) - length:]
+      by_prefix = self.buckets.get(suffix)
+      if by_prefix is None:
+        continue
+      for prefix_length in self.prefix_lengths[suffix]:
+        if prefix_length + length > len(path):
+          continue
+        entries = by_prefix.get(path[:prefix_length])
+        if entries is not None:
+          found.extend(entries)
+    found.sort(key=lambda entry: entry[0])
+    return found
+
+  def matches( self, path ):
+    """Returns (value, bindings) for every pattern that matches path, in
+    the order they were added.
+    """
+    found = [(order, value, {}) for order, value in self.exact.get(path, ())]
+    for order, pattern, value in self.candidates(path):
+      bindings = pattern.match(path)
+      if bindings is not None:
+        found.append((order, value, bindings))
+    found.sort(key=lambda item: item[0])
+    return [(value, bindings) for order, value, bindings in found]
+
 def _test():
     import doctest
     doctest.testmod()
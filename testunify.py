@@ -1,6 +1,11 @@
 """Unification functions
 """
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def is_var( v ) :
     return v[0] == '{' and v[-1] == '}'
 
@@ -16,8 +21,16 @@ class PathInfo(object):
     def __repr__( self ):
         return repr(str(self))
 
+# Type codes used by the numpy backend
+TYPES = '-.rc*'
+NONE, CONST, ROW, COL, BOTH = range(len(TYPES))
+
+# The numpy backend is used for matrices with at least this many cells when
+# no backend is asked for; below it the pure Python one is faster.
+NUMPY_MIN_CELLS = 64
+
 class MatchMatrix(object):
-    def __init__( self, s1, s2 ):
+    def __init__( self, s1, s2, backend=None ):
         """ Build a match matrix from the input strings
 
             . : constant-constant match
@@ -36,6 +49,16 @@ class MatchMatrix(object):
 
             The number at the bottom right is the number of matches.
 
+            backend is 'python' (lists of PathInfo objects) or 'numpy'
+            (arrays of type codes and path counts, filled a row at a time);
+            by default numpy is used for large matrices if it is installed.
+            Path counts are 64 bit integers in the numpy backend, so a matrix
+            whose counts could outgrow them is filled by the Python backend
+            instead, and self.backend says which one was used.
+
+            Either string may also be given already parsed, as a list of
+            tokens like parse_match_string returns.
+
         >>> print MatchMatrix("a{b}c{d}e", "abccc{e}e")
         .1 -0 -0 -0 -0 -0 -0
         -0 r1 r1 r1 r1 r1 r1
@@ -51,13 +74,28 @@ class MatchMatrix(object):
         -0 -0 -0 c1 c4 .3
         """
         # TODO: Standardize apart?
-        ps1 = self.ps1 = parse_match_string(s1)
-        ps2 = self.ps2 = parse_match_string(s2)
-
+        ps1 = self.ps1 = tokens(s1)
+        ps2 = self.ps2 = tokens(s2)
+        self.num_rows = len(ps1)
+        self.num_cols = len(ps2)
+
+        if backend is None:
+            backend = 'python'
+            if (numpy is not None and
+                self.num_rows * self.num_cols >= NUMPY_MIN_CELLS):
+                backend = 'numpy'
+        self.matrix = None
+        if backend == 'numpy' and not self._fill_arrays():
+            backend = 'python'
+        if backend != 'numpy':
+            self._fill_lists()
+        self.backend = backend
+
+    def _fill_lists( self ):
+        ps1 = self.ps1
+        ps2 = self.ps2
         matrix = [[PathInfo('-', 0) for col in ps2] for row in ps1]
         self.matrix = matrix
-        self.num_rows = len(matrix)
-        self.num_cols = len(matrix[0])
 
         # Start at the upper left corner and make our way down to the lower
         # right.  Assume that the corner matches.
@@ -123,6 +161,149 @@ class MatchMatrix(object):
                 if info.paths == 0:
                     info.type = '-'
 
+    def _fill_arrays( self ):
+        """Fills self.types and self.counts with the same values that
+        _fill_lists computes, working on a whole row at a time.  The rules
+        are the same with rows and columns swapped (and r and c with them),
+        so the matrix is filled along whichever side is shorter.
+
+        Returns False, leaving them unset, if a path count could overflow.
+
+        Both backends give the same matrix, whichever side is longer:
+
+        >>> pairs = [("a{b}c{d}e", "abccc{e}e"),
+        ...          ("a{b}{c}def", "abc{d}{e}f"),
+        ...          ("{x}/lib{y}-{z}.so.{v}" * 3, "usr/lib/libc-{w}.so.6" * 3),
+        ...          ("src/{dir}/{base}.c" * 4, "src/x{d}y/main.c"),
+        ...          ("".join("{v%d}" % i for i in range(16)), "x" * 200)]
+        >>> if numpy is None:
+        ...     print [True] * len(pairs)
+        ... else:
+        ...     print [str(MatchMatrix(s1, s2, backend='numpy')) ==
+        ...            str(MatchMatrix(s1, s2, backend='python'))
+        ...            for s1, s2 in pairs]
+        [True, True, True, True, True]
+
+        The last pair has more paths than 64 bits can count, so it is left
+        to the Python backend:
+
+        >>> matrix = MatchMatrix("".join("{v%d}" % i for i in range(16)),
+        ...                      "x" * 200, backend='numpy')
+        >>> matrix.backend, matrix.count()
+        ('python', 13532210127282281622264L)
+        """
+        if numpy is None:
+            return False
+        if self.num_rows <= self.num_cols:
+            filled = self._fill_rows(self.ps1, self.ps2)
+            if filled is None:
+                return False
+            self.types, self.counts = filled
+        else:
+            filled = self._fill_rows(self.ps2, self.ps1)
+            if filled is None:
+                return False
+            types, counts = filled
+            swapped = numpy.array([NONE, CONST, COL, ROW, BOTH],
+                                  dtype=numpy.uint8)
+            self.types = swapped[types.T]
+            self.counts = counts.T
+        return True
+
+    @staticmethod
+    def _fill_rows( ps1, ps2 ):
+        """Returns the types and counts arrays, or None if a count could
+        overflow.
+        """
+        num_rows, num_cols = len(ps1), len(ps2)
+        row_vars = [is_var(v) for v in ps1]
+        col_vars = numpy.array([is_var(v) for v in ps2], dtype=bool)
+        any_col_vars = col_vars.any()
+
+        # Constant-constant matches, compared as token ids
+        ids = {}
+        row_ids = numpy.array([ids.setdefault(v, len(ids)) for v in ps1])
+        col_ids = numpy.array([ids.setdefault(v, len(ids)) for v in ps2])
+        const = ((row_ids[:, None] == col_ids[None, :]) &
+                 ~numpy.array(row_vars, dtype=bool)[:, None] &
+                 ~col_vars[None, :])
+
+        # Padded by one row and column of zeros, so that the cells above,
+        # to the left and diagonally up-left of cell (row, col) are at
+        # [row, col+1], [row+1, col] and [row, col].  The padding corner
+        # holds the 1 that the upper left cell inherits diagonally.
+        types = numpy.zeros((num_rows + 1, num_cols + 1), dtype=numpy.uint8)
+        counts = numpy.zeros((num_rows + 1, num_cols + 1), dtype=numpy.int64)
+        counts[0, 0] = 1
+        # A cell adds up at most every diagonal and column source in its
+        # row, so while the row above stays under this, nothing can wrap.
+        limit = numpy.iinfo(numpy.int64).max // (2 * num_cols + 2)
+
+        for row in xrange(num_rows):
+            diag = counts[row, :-1]
+            above = types[row, 1:]
+            col_source = numpy.where(col_vars & ((above == COL) |
+                                                 (above == BOTH)),
+                                     counts[row, 1:], 0)
+            if not row_vars[row]:
+                # Nothing inherits from the left, so every cell depends only
+                # on the row above.
+                paths = numpy.where(const[row], diag,
+                                    numpy.where(col_vars, diag + col_source,
+                                                0))
+                kind = numpy.where(const[row], CONST,
+                                   numpy.where(col_vars & (paths > 0),
+                                               COL, NONE))
+            elif not any_col_vars:
+                # A row variable against constants: each cell adds its
+                # diagonal to the cell on its left.
+                paths = numpy.cumsum(diag)
+                kind = numpy.where(paths > 0, ROW, NONE)
+            else:
+                # Row and column variables meet: go a cell at a time.
+                paths, kind = MatchMatrix._fill_row(ps2, row, diag.tolist(),
+                                                    col_source.tolist())
+            if numpy.max(paths) > limit:
+                return None
+            counts[row + 1, 1:] = paths
+            types[row + 1, 1:] = kind
+
+        return types[1:, 1:], counts[1:, 1:]
+
+    @staticmethod
+    def _fill_row( ps2, row, diag, col_source ):
+        """One row of _fill_rows for a row variable, in the same steps as
+        _fill_lists takes.
+        """
+        paths = []
+        kind = []
+        left_count = 0
+        left_type = NONE
+        for col, cval in enumerate(ps2):
+            row_source = 0
+            if col > 0 and left_type in (ROW, BOTH):
+                row_source = left_count
+            count = 0
+            cell_type = NONE
+            if is_var(cval):
+                if row == 0 and col == 0:
+                    cell_type, count = BOTH, 1
+                elif row_source and col_source[col]:
+                    cell_type = BOTH
+                    count = diag[col] + row_source + col_source[col]
+                elif row_source:
+                    cell_type, count = ROW, diag[col] + row_source
+                elif col_source[col]:
+                    cell_type, count = COL, diag[col] + col_source[col]
+            else:
+                cell_type, count = ROW, diag[col] + row_source
+            if count == 0:
+                cell_type = NONE
+            paths.append(count)
+            kind.append(cell_type)
+            left_count, left_type = count, cell_type
+        return paths, kind
+
     def paths( self, path=None ):
         """ Get all paths through the matrix that end in "path"
 
@@ -147,31 +328,62 @@ class MatchMatrix(object):
         """
 
         # No path to the end, skip out
-        if self[-1, -1].paths == 0:
+        if self.count() == 0:
             return
 
         if path is None:
             path = (self.num_rows - 1, self.num_cols - 1),
 
-        # We have reached the beginning from the end: emit
-        row, col = path[0]
-        if row == 0 and col == 0:
-            yield path
-            return
-
-        info = self[row, col]
-
-        path_prefixes = []
-        if row > 0 and col > 0 and self[row-1, col-1].paths > 0:
-            path_prefixes.append((row-1, col-1))
-        if info.type in 'r*' and col > 0 and self[row, col-1].type in 'r*':
-            path_prefixes.append((row, col-1))
-        if info.type in 'c*' and row > 0 and self[row-1, col].type in 'c*':
-            path_prefixes.append((row-1, col))
-
-        for pos in path_prefixes:
-            for new_path in self.paths((pos,) + path):
-                yield new_path
+        # Paths are found from the end backwards, depth first.  A partial
+        # path is a linked list of (position, rest of the path), so all the
+        # ways of reaching a position share the path that follows it.
+        # Every cell that is visited has a path back to the start, so the
+        # first path takes time linear in its length.
+        grid = self._grid()
+        suffix = None
+        for pos in reversed(path):
+            suffix = (pos, suffix)
+        stack = [suffix]
+        while stack:
+            suffix = stack.pop()
+            row, col = suffix[0]
+
+            # We have reached the beginning from the end: emit
+            if row == 0 and col == 0:
+                found = []
+                while suffix is not None:
+                    found.append(suffix[0])
+                    suffix = suffix[1]
+                yield tuple(found)
+                continue
+
+            info_type = grid[row][col][0]
+            if info_type in 'c*' and row > 0 and grid[row-1][col][0] in 'c*':
+                stack.append(((row-1, col), suffix))
+            if info_type in 'r*' and col > 0 and grid[row][col-1][0] in 'r*':
+                stack.append(((row, col-1), suffix))
+            if row > 0 and col > 0 and grid[row-1][col-1][1] > 0:
+                stack.append(((row-1, col-1), suffix))
+
+    def count( self ):
+        """ The number of paths through the matrix, without finding them
+
+            >>> MatchMatrix("a{b}c{d}e", "abccc{e}e").count()
+            4
+        """
+        return self[-1, -1].paths
+
+    def _grid( self ):
+        """Returns (type, paths) for every cell, as lists of rows"""
+        if getattr(self, '_cells', None) is None:
+            if self.matrix is not None:
+                self._cells = [[(info.type, info.paths) for info in row]
+                               for row in self.matrix]
+            else:
+                self._cells = [[(TYPES[t], n) for t, n in zip(types, counts)]
+                               for types, counts in zip(self.types.tolist(),
+                                                        self.counts.tolist())]
+        return self._cells
 
     def maps( self ):
         """ Build a map for each path through this matrix
@@ -190,76 +402,81 @@ class MatchMatrix(object):
             [['{b}', 'b'], ['{d}', 'cc', '{e}']]
             [['{b}', 'bccc'], ['{e}', 'c', '{d}']]
         """
+        ps1 = self.ps1
+        ps2 = self.ps2
+        grid = self._grid()
+        def part( token ):
+            # Runs of constants are collected as lists of characters and
+            # joined once the map is complete.
+            if is_var(token):
+                return token
+            return [token]
+
         for path in self.paths():
             prev_row = None
             prev_col = None
             map = []
+            last = len(path) - 1
             for i, (row, col) in enumerate(path):
-                # If we move within a row, we need to append to the most recent
-                # row variable match.
-                if row == prev_row:
-                    oldvar = is_var(map[-1][-1])
-                    newvar = is_var(self.ps2[col])
-                    # If we are interfacing with a variable, then we can't make
-                    # a longer string out of the most recent entry.  Otherwise,
-                    # we can.
-                    if oldvar or newvar:
-                        map[-1].append(self.ps2[col])
+                # Moving within a row adds to the most recent row variable
+                # match, and moving within a column to the most recent column
+                # variable match.  A run of constants grows in place, but
+                # next to a variable the token is a new element.
+                if row == prev_row or col == prev_col:
+                    if row == prev_row:
+                        token = ps2[col]
                     else:
-                        map[-1][-1] += self.ps2[col]
-                elif col == prev_col:
-                    oldvar = is_var(map[-1][-1])
-                    newvar = is_var(self.ps1[row])
-                    # If we are interfacing with a variable, then we can't make
-                    # a longer string out of the most recent entry.  Otherwise,
-                    # we can.
-                    if oldvar or newvar:
-                        map[-1].append(self.ps1[row])
+                        token = ps1[row]
+                    entry = map[-1]
+                    if isinstance(entry[-1], list) and not is_var(token):
+                        entry[-1].append(token)
                     else:
-                        map[-1][-1] += self.ps1[row]
+                        entry.append(part(token))
                 else:
-                    # Moving diagonally.  If we have a variable type, create a
-                    # new match.  This is straightforward for 'r' and 'c' type
-                    # matches.
-                    info = self[row, col]
-                    if info.type == 'r':
-                        map.append([self.ps1[row], self.ps2[col]])
-                    elif info.type == 'c':
-                        map.append([self.ps2[col], self.ps1[row]])
-                    elif info.type == '*':
-                        # This is the tricky one.  From here there are three
-                        # possibilities:
-                        #   move down: column var
-                        #   move right: row var
-                        #   move diagonally or end of path: treat like a row var
-                        if i == len(path) - 1:
-                            # end of path, treat like a row var:
-                            map.append([self.ps1[row], self.ps2[col]])
-                        else:
-                            future_row, future_col = path[i+1]
-                            if future_col == col:
-                                map.append([self.ps2[col], self.ps1[row]])
-                            else: # diagonal or over
-                                map.append([self.ps1[row], self.ps2[col]])
+                    # Moving diagonally.  If we have a variable type, create
+                    # a new match.  A '*' match is a column variable match if
+                    # the path moves down from it, and a row variable match
+                    # otherwise.
+                    info_type = grid[row][col][0]
+                    if info_type == '*' and i < last and path[i+1][1] == col:
+                        info_type = 'c'
+                    if info_type in 'r*':
+                        map.append([ps1[row], part(ps2[col])])
+                    elif info_type == 'c':
+                        map.append([ps2[col], part(ps1[row])])
                 prev_row = row
                 prev_col = col
-            yield map
+            yield [[p if not isinstance(p, list) else "".join(p)
+                    for p in entry] for entry in map]
 
     def __iter__( self ):
-        return iter(self.matrix)
+        if self.matrix is not None:
+            return iter(self.matrix)
+        return ([PathInfo(TYPES[t], int(n)) for t, n in zip(types, counts)]
+                for types, counts in zip(self.types.tolist(),
+                                         self.counts.tolist()))
 
     def __getitem__( self, pos ):
         row, col = pos
-        return self.matrix[row][col]
+        if self.matrix is not None:
+            return self.matrix[row][col]
+        return PathInfo(TYPES[self.types[row, col]],
+                        int(self.counts[row, col]))
 
     def __str__( self ):
         slist = []
-        for row in self.matrix:
+        for row in self:
             slist.append(" ".join(str(x) for x in row))
         return "\n".join(slist)
 
     __repr__ = __str__
 
+def tokens( s ):
+    """Returns s parsed into tokens, unless it is already a list of them"""
+    if isinstance(s, list):
+        return s
+    return parse_match_string(s)
+
 def parse_match_string(s):
     """ Parse a match string into a list of tokens
 
@@ -0,0 +1,76 @@
+"""util.py
+
+Small pieces shared by the other modules that do not belong to any of them.
+
+"""
+
+class LRUCache(object):
+    """A dict of at most capacity items that forgets the least recently used
+    one to make room.
+
+    >>> cache = LRUCache(2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache['a']
+    1
+    >>> cache['c'] = 3
+    >>> 'b' in cache, 'a' in cache
+    (False, True)
+    """
+    def __init__( self, capacity ):
+        self.capacity = capacity
+        # Key -> link.  The links form a circular list, most recently used
+        # last, through [previous, next, key, value] lists.
+        self.links = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.hits = 0
+        self.misses = 0
+
+    def __len__( self ):
+        return len(self.links)
+
+    def __contains__( self, key ):
+        return key in self.links
+
+    def __getitem__( self, key ):
+        link = self.links[key]
+        prev, next, _, value = link
+        prev[1] = next
+        next[0] = prev
+        root = self.root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+        return value
+
+    def __setitem__( self, key, value ):
+        link = self.links.get(key)
+        if link is not None:
+            link[3] = value
+            self[key]
+            return
+        root = self.root
+        if len(self.links) >= self.capacity:
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self.links[oldest[2]]
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = root[0] = self.links[key] = link
+
+    def clear( self ):
+        self.links.clear()
+        self.root[:] = [self.root, self.root, None, None]
+        self.hits = self.misses = 0
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
+
+# vim: et sts=4 sw=4
@@ -0,0 +1,500 @@
+"""watch.py
+
+A long-running build: the proof for some queries is resolved and built once
+and kept in memory.  After that, when a file changes, only the rule
+instances that mention it and the ones that depend on them are run again, so
+the cost of a rebuild follows the size of the change rather than the size of
+the tree.
+
+Changes come from inotify where it is available (through ctypes, so nothing
+needs to be installed), and from polling stat() otherwise.
+
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+import schedule
+from schedule import consequent_files
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF)
+
+_event = struct.Struct('iIII')
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.inotify_init
+    _libc.inotify_add_watch
+    _libc.inotify_rm_watch
+except (OSError, AttributeError):
+    _libc = None
+
+def file_state( path ):
+    """Returns what a watcher compares to see that a file changed"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+class PollingWatcher(object):
+    """Finds changed files by stat'ing all of them on every call"""
+    def __init__( self, paths ):
+        self.states = dict((p, file_state(p)) for p in paths)
+
+    def changes( self, timeout=1.0 ):
+        """Waits for timeout seconds and returns the paths that changed"""
+        if timeout:
+            time.sleep(timeout)
+        changed = []
+        for path, old in self.states.iteritems():
+            new = file_state(path)
+            if new != old:
+                self.states[path] = new
+                changed.append(path)
+        return changed
+
+    def close( self ):
+        pass
+
+class InotifyWatcher(object):
+    """Finds changed files by asking the kernel to report changes to the
+    directories that hold them.
+
+    A directory that does not exist yet cannot be watched, so its nearest
+    existing ancestor is watched until it is created.  Files that are
+    already in it by then are reported as changed.  The same goes for a
+    watched directory that is removed, once the kernel drops its watch.
+
+    >>> import shutil, tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> a = os.path.join(root, 'a.c')
+    >>> b = os.path.join(root, 'sub', 'dir', 'b.c')
+    >>> w = (InotifyWatcher if _libc is not None else PollingWatcher)([a, b])
+    >>> with open(a, 'w') as out:
+    ...     out.write('a')
+    >>> w.changes(0) == [a]
+    True
+    >>> os.makedirs(os.path.dirname(b))
+    >>> with open(b, 'w') as out:
+    ...     out.write('b')
+    >>> w.changes(0) == [b]
+    True
+    >>> with open(b, 'w') as out:
+    ...     out.write('b again')
+    >>> w.changes(0) == [b]
+    True
+    >>> w.changes(0)
+    []
+
+    Removing the directory and making it again:
+
+    >>> shutil.rmtree(os.path.join(root, 'sub'))
+    >>> w.changes(0) == [b]
+    True
+    >>> os.makedirs(os.path.dirname(b))
+    >>> w.changes(0)
+    []
+    >>> with open(b, 'w') as out:
+    ...     out.write('b back')
+    >>> w.changes(0) == [b]
+    True
+    >>> with open(b, 'w') as out:
+    ...     out.write('b changed')
+    >>> w.changes(0) == [b]
+    True
+    >>> w.close()
+    >>> shutil.rmtree(root)
+    """
+    def __init__( self, paths ):
+        self.paths = set(paths)
+        self.fd = _libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.dirs = {}
+        # The directories of the watched paths, and those of them that are
+        # not watched themselves yet
+        self.wanted = set(os.path.dirname(p) for p in self.paths)
+        self.missing = set(self.wanted)
+        self._add_watches()
+
+    def _add_watch( self, dirname ):
+        wd = _libc.inotify_add_watch(self.fd, dirname or os.curdir,
+                                     WATCH_MASK)
+        if wd < 0:
+            return False
+        self.dirs[wd] = dirname
+        return True
+
+    def _add_watches( self ):
+        """Watches the missing directories that exist now, and the nearest
+        existing ancestor of each of the others.  Returns the ones that are
+        no longer missing.
+        """
+        found = []
+        for dirname in list(self.missing):
+            if self._add_watch(dirname):
+                self.missing.discard(dirname)
+                found.append(dirname)
+                continue
+            parent = dirname
+            while parent:
+                up = os.path.dirname(parent)
+                if up == parent or self._add_watch(up):
+                    break
+                parent = up
+        return found
+
+    def _created( self, path ):
+        """Returns the watched paths that have turned up because path, a
+        directory that some of them are under, was created.
+        """
+        prefix = os.path.join(path, '')
+        if not any(d == path or d.startswith(prefix) for d in self.missing):
+            return []
+        return self._rewatch()
+
+    def _removed( self, wd ):
+        """Forgets the watch wd, which the kernel has dropped because its
+        directory is gone (or was moved), and watches whatever can be
+        watched instead.  Returns the watched paths that were in it, since
+        they may have gone with it without events of their own.
+        """
+        dirname = self.dirs.pop(wd, None)
+        if dirname is None:
+            return []
+        if dirname in self.wanted:
+            self.missing.add(dirname)
+        found = set(self._add_watches())
+        found.add(dirname)
+        return [p for p in self.paths if os.path.dirname(p) in found]
+
+    def _rewatch( self ):
+        found = set(self._add_watches())
+        return [p for p in self.paths
+                if os.path.dirname(p) in found and os.path.exists(p)]
+
+    def changes( self, timeout=1.0 ):
+        """Waits up to timeout seconds for changes and returns the paths
+        (among the watched ones) that they were to.
+        """
+        changed = set()
+        wait = timeout
+        while True:
+            try:
+                ready, _, _ = select.select([self.fd], [], [], wait)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                return list(changed)
+            data = os.read(self.fd, 65536)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _event.unpack_from(data, offset)
+                offset += _event.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                if mask & IN_MOVE_SELF:
+                    # The watch would follow the directory to its new name.
+                    # Dropping it brings an IN_IGNORED event.
+                    _libc.inotify_rm_watch(self.fd, wd)
+                if mask & IN_IGNORED:
+                    changed.update(self._removed(wd))
+                    continue
+                path = os.path.join(self.dirs.get(wd, ''), name)
+                if path in self.paths:
+                    changed.add(path)
+                elif self.missing and mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.update(self._created(path))
+            # Pick up the rest of a burst of events (an editor saving a file
+            # usually causes several) before returning.
+            wait = 0.01
+
+    def close( self ):
+        os.close(self.fd)
+
+def watcher( paths ):
+    """Returns an InotifyWatcher for paths if inotify can be used, otherwise
+    a PollingWatcher.
+    """
+    if _libc is not None:
+        try:
+            return InotifyWatcher(paths)
+        except OSError:
+            pass
+    return PollingWatcher(paths)
+
+class Watch(object):
+    """Keeps the graph of a finished build and brings it up to date as files
+    change.
+
+    >>> import shutil, tempfile
+    >>> from prolog import Predicate, Rule, Prolog
+    >>> root = tempfile.mkdtemp()
+    >>> def path(name):
+    ...     return os.path.join(root, name)
+    >>> def f(name):
+    ...     return Predicate('built', [Predicate(path(name))])
+    >>> runs = []
+    >>> class Cat(Rule):
+    ...     def pre_test( self ):
+    ...         target = self.consequent.args[0].name
+    ...         sources = [a.args[0].name for a in self.antecedents]
+    ...         return (os.path.exists(target) and
+    ...                 all(os.path.getmtime(s) <= os.path.getmtime(target)
+    ...                     for s in sources))
+    ...     def commands( self ):
+    ...         runs.append(os.path.basename(self.consequent.args[0].name))
+    ...         text = ''.join(open(a.args[0].name).read()
+    ...                        for a in self.antecedents)
+    ...         if 'error' not in text:
+    ...             with open(self.consequent.args[0].name, 'w') as out:
+    ...                 out.write(text)
+    >>> class Source(Cat):
+    ...     def commands( self ):
+    ...         pass
+    >>> for name in ['a.c', 'b.c']:
+    ...     with open(path(name), 'w') as out:
+    ...         out.write(name)
+    ...     os.utime(path(name), (100, 100))
+    >>> prolog = Prolog()
+    >>> prolog.add_rule(Cat(f('prog'), [f('a.o'), f('b.o')]))
+    >>> prolog.add_rule(Cat(f('a.o'), [f('a.c')]))
+    >>> prolog.add_rule(Cat(f('b.o'), [f('b.c')]))
+    >>> prolog.add_rule(Source(f('a.c')))
+    >>> prolog.add_rule(Source(f('b.c')))
+    >>> watch = Watch(prolog, [f('prog')], watcher=PollingWatcher)
+    >>> watch.build()
+    []
+    >>> sorted(runs)
+    ['a.o', 'b.o', 'prog']
+    >>> del runs[:]
+    >>> watch.step(0)
+    >>> with open(path('b.c'), 'w') as out:
+    ...     out.write('changed')
+    >>> nodes, failed = watch.step(0)
+    >>> sorted(nodes, key=str)  # doctest: +ELLIPSIS
+    [built(.../b.c), built(.../b.o), built(.../prog)]
+    >>> runs
+    ['b.o', 'prog']
+    >>> open(path('prog')).read()
+    'a.cchanged'
+    >>> watch.step(0)
+
+    Instances that failed earlier are run again along with what a change
+    affects, since what depends on them cannot run until they succeed:
+
+    >>> with open(path('a.c'), 'w') as out:
+    ...     out.write('error')
+    >>> nodes, failed = watch.step(0)
+    >>> failed  # doctest: +ELLIPSIS
+    [built(.../a.o)]
+    >>> with open(path('b.c'), 'w') as out:
+    ...     out.write('again')
+    >>> nodes, failed = watch.step(0)
+    >>> failed  # doctest: +ELLIPSIS
+    [built(.../a.o)]
+    >>> with open(path('a.c'), 'w') as out:
+    ...     out.write('fixed')
+    >>> nodes, failed = watch.step(0)
+    >>> failed, open(path('prog')).read()
+    ([], 'fixedagain')
+
+    If a file that the rules name appears or disappears, the proof may be
+    different, so the queries are resolved again.  While there is no proof,
+    any change to such a file is another try:
+
+    >>> del runs[:]
+    >>> os.remove(path('b.c'))
+    >>> nodes, failed = watch.step(0)
+    >>> failed
+    [None]
+    >>> with open(path('b.c'), 'w') as out:
+    ...     out.write('back')
+    >>> nodes, failed = watch.step(0)
+    >>> failed, runs
+    ([], ['b.o', 'prog'])
+    >>> open(path('prog')).read()
+    'fixedback'
+    >>> watch.step(0)
+    >>> watch.close()
+    >>> shutil.rmtree(root)
+    """
+    def __init__( self, prolog, queries, jobs=1, watcher=watcher,
+                  files=consequent_files, stats=None ):
+        """args:
+            watcher - called with the paths to watch, returns an object with
+                changes(timeout) and close() methods
+            files - returns the paths that a rule instance is about
+            stats - a filestate.StatCache that the rules test against; it
+                is updated for every path that changes
+        """
+        self.prolog = prolog
+        self.queries = queries
+        self.jobs = jobs
+        self.make_watcher = watcher
+        self.files = files
+        self.stats = stats
+        self.watcher = None
+        self.graph = None
+        # Keys of nodes that are satisfied
+        self.satisfied = set()
+        # Path -> nodes that are about it
+        self.by_file = {}
+        # Path -> file_state() as of the last time it was built or seen
+        self.states = {}
+        # The paths that the rules name themselves
+        self.mentioned = set()
+        # Whether the last build found a proof
+        self.proved = False
+
+    def build( self ):
+        """Builds from scratch and starts watching the files involved, and
+        those the rules name.  Returns the nodes that failed, or [None] if
+        there was no proof.
+        """
+        if self.watcher is not None:
+            self.watcher.close()
+        self.satisfied = set()
+        result = schedule.build(self.prolog, self.queries, self.jobs)
+        self.proved = result is not None
+        if result is None:
+            self.graph = schedule.ProofGraph()
+            failed = [None]
+        else:
+            varmap, self.graph = result
+            self.satisfied = set(node.key for node in self.graph)
+            failed = []
+
+        self.by_file = {}
+        for node in self.graph:
+            for path in self.files(node.rule):
+                self.by_file.setdefault(path, []).append(node)
+        self.mentioned = set()
+        for rule in self.prolog.rules:
+            self.mentioned.update(self.files(rule))
+        paths = set(self.by_file) | self.mentioned
+        self.states = dict((p, file_state(p)) for p in paths)
+        self.watcher = self.make_watcher(list(paths))
+        return failed
+
+    def affected( self, paths ):
+        """Returns the nodes about paths and everything that depends on
+        them, in graph order.
+        """
+        seen = set()
+        stack = [n for p in paths for n in self.by_file.get(p, ())]
+        while stack:
+            node = stack.pop()
+            if node not in seen:
+                seen.add(node)
+                stack.extend(node.dependents)
+        return sorted(seen, key=lambda n: n.index)
+
+    def rebuild( self, paths ):
+        """Runs the nodes affected by changes to paths again, along with
+        any of their dependencies that are not satisfied (because they
+        failed before).  Returns them and the ones that failed.
+        """
+        if self.stats is not None:
+            for path in paths:
+                self.stats.update(path)
+        nodes = self.affected(paths)
+        seen = set(nodes)
+        stack = list(nodes)
+        while stack:
+            for dep in stack.pop().deps:
+                if dep not in seen and dep.key not in self.satisfied:
+                    seen.add(dep)
+                    stack.append(dep)
+        if len(seen) > len(nodes):
+            nodes = sorted(seen, key=lambda n: n.index)
+        for node in nodes:
+            self.satisfied.discard(node.key)
+        failed = schedule.execute(nodes, self.jobs, self.satisfied)
+
+        # The commands that ran will have changed their own files.  Those
+        # are up to date now and should not cause another rebuild.
+        for node in nodes:
+            for path in self.files(node.rule):
+                self.states[path] = file_state(path)
+                if self.stats is not None:
+                    self.stats.update(path)
+        return nodes, failed
+
+    def step( self, timeout=1.0 ):
+        """Waits up to timeout seconds for changes and rebuilds what they
+        affect.  Returns the result of rebuild(), or None if nothing
+        changed.
+
+        When there was no proof, or a file that the rules name has appeared
+        or disappeared, the proof may be different now, so everything is
+        built again with build().  The result is then all of the nodes and
+        the ones that failed.  Other files coming and going (an editor's
+        swap files, say) cannot change the proof.
+        """
+        changed = []
+        reshaped = not self.proved
+        for path in self.watcher.changes(timeout):
+            state = file_state(path)
+            old = self.states.get(path)
+            if state != old:
+                self.states[path] = state
+                changed.append(path)
+                if (path in self.mentioned and
+                        (old is None) != (state is None)):
+                    reshaped = True
+        if not changed:
+            return None
+        if reshaped:
+            if self.stats is not None:
+                self.stats.refresh()
+            failed = self.build()
+            return list(self.graph), failed
+        return self.rebuild(changed)
+
+    def run( self, timeout=1.0, callback=None ):
+        """Builds, then rebuilds after every change until interrupted.
+        callback, if given, is called with each result of step().
+        """
+        self.build()
+        try:
+            while True:
+                result = self.step(timeout)
+                if result is not None and callback is not None:
+                    callback(result)
+        finally:
+            self.close()
+
+    def close( self ):
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
+
+# vim: et sts=4 sw=4